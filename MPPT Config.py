@@ -29,6 +29,7 @@ either expressed or implied, of Dilithium Power Systems LLC.
 """
 
 import logging
+import math
 from Tkinter import *
 import ttk
 import time
@@ -37,80 +38,108 @@ import sys
 sys.path.append('./util')
 sys.path.append('../util')
 
+import bus_worker
 import can_ethernet
+import can_log
 import can_msg_pb2
 import eeprom
 import mppt
+import telemetry
+import tracker_table
 
 from multiprocessing import freeze_support
 
+# how often the ui picks up what the bus worker finished, in ms
+RESULT_POLL_MS = 20
+# seconds to let the worker finish, e.g. a reset, when the window closes
+CLOSE_TIMEOUT = 10
+
 
 class GUI(Frame):
 
   def writeEEPROM(self):
     # see if it's possible to configure
-    #try:
-    if True:
-      self.configChannel = self.selectedChannel.get()
-      ee = self.tracker[self.configChannel].ee
-    #except:
-    #  return
-    nEEPROMValues = len(ee.data)
-
+    tracker = self.selectedTracker()
+    if tracker is None:
+      return
+    self.configAddress = tracker.canAddress
+    nEEPROMValues = len(tracker.ee.schema)
+
+    # take the new values out of the window here, the worker does the rest
+    newValues = []
     for i in range(nEEPROMValues):
-      eeName = ee.data[i][0]
       valueToWrite = self.eepromNewValueVar[i].get()
-      print 'name= {0:s} val= {1:g}'.format(eeName, valueToWrite)
-      ee.writeValue(eeName, valueToWrite)
+      print 'name= {0:s} val= {1:g}'.format(tracker.ee.schema[i].name,
+                                            valueToWrite)
+      newValues.append(valueToWrite)
+    self.startJob('Writing EEPROM', 'discovered', self.writeEEPROMJob,
+                  tracker, newValues, self.baseAddrs(), self.autoSend.get())
+
+  def writeEEPROMJob(self, tracker, newValues, baseAddrs, autoSend):
+    # worker thread: write the values that changed, reset and rediscover
+    ee = tracker.ee
+    for i, valueToWrite in enumerate(newValues):
+      eeName = ee.schema[i].name
+      if not eeprom.approxEqual(ee.getValue(eeName), valueToWrite, 0.00001):
+        ee.setValue(eeName, valueToWrite)
+    # only the values that changed go out on the bus
+    written = ee.flush()
     # reset the mppt
-    self.tracker[self.configChannel].reset()
-    self.discoverMPPTs()
-    ee = self.tracker[self.configChannel].ee
-
-    for i in range(len(ee.data)):
-      eeType = ee.data[i][1] 
-      eeValue = ee.data[i][2] 
-      if(eeType == 'int32'):
-        self.eepromValueVar[i].set('{:d}'.format(eeValue))
-      else:
-        self.eepromValueVar[i].set('{:g}'.format(eeValue))
+    tracker.reset()
+    provisioned = []
+    if 'autoSendRate' in written:
+      provisioned.append(tracker.canAddress)
+    return self.discoverJob(baseAddrs, autoSend, provisioned)
 
   def loadConfigFromFile(self):
     # see if it's possible to configure
-    if True:
-    #try:
-      self.configChannel = self.selectedChannel.get()
-      ee = self.tracker[self.configChannel].ee
-    #except:
-    #  return
+    tracker = self.selectedTracker()
+    if tracker is None:
+      return
+    self.configAddress = tracker.canAddress
     filename = 'configuration.csv'
     sn = int(self.newSN.get())
-    ee.loadConfigurationFromFile(filename, sn)
-
-    # reset the mppt
-    self.tracker[self.configChannel].reset()
-    self.discoverMPPTs()
-
-    # load the new values from the mppt
-    ee = self.tracker[self.configChannel].ee
-
-    # load the values into the gui
-    for i in range(len(ee.data)):
-      eeType = ee.data[i][1] 
-      eeValue = ee.data[i][2] 
+    self.startJob('Loading Configuration', 'discovered',
+                  self.loadConfigJob, tracker, filename, sn,
+                  self.baseAddrs(), self.autoSend.get())
+
+  def loadConfigJob(self, tracker, filename, sn, baseAddrs, autoSend):
+    # worker thread: configure, reset and rediscover, the new values are
+    # loaded into the window when the discovery comes back
+    report = tracker.ee.loadConfigurationFromFile(filename, sn)
+    tracker.reset()
+    provisioned = []
+    if 'autoSendRate' in [key for key, _, _ in report.changed]:
+      provisioned.append(tracker.canAddress)
+    return self.discoverJob(baseAddrs, autoSend, provisioned)
+
+  def showEEPROMValues(self, ee):
+    # load the values into the configuration window if it is still showing
+    # this mppt
+    if self.cw is None or self.configAddress not in self.table:
+      return
+    if ee is not self.table[self.configAddress].tracker.ee:
+      return
+    for i in range(len(ee.schema)):
+      eeType = ee.schema[i].type
+      eeValue = ee.values[i]
       if(eeType == 'int32'):
         self.eepromValueVar[i].set('{:d}'.format(eeValue))
       else:
         self.eepromValueVar[i].set('{:g}'.format(eeValue))
 
+  def readEEPROMJob(self, ee):
+    # worker thread: read whatever the cache does not hold
+    ee.refresh()
+    return ee
+
   def configureMPPT(self):
     # see if it's possible to configure
-    if True:
-    #try:
-      self.configChannel = self.selectedChannel.get()
-      ee = self.tracker[self.configChannel].ee
-    #except:
-    #  return
+    tracker = self.selectedTracker()
+    if tracker is None:
+      return
+    self.configAddress = tracker.canAddress
+    ee = tracker.ee
 
     # disable the button
     self.configureButton.configure(state=DISABLED)
@@ -123,8 +152,8 @@ class GUI(Frame):
 
     # title the window
     cw.wm_title(
-      'MPPT Channel {0:d} Configuration'.format(
-        self.configChannel))
+      'MPPT 0x{0:03X} Configuration'.format(
+        self.configAddress))
 
     px = 2
     py = 2
@@ -141,7 +170,7 @@ class GUI(Frame):
     Label(cw, text='Current Value').grid(row=1, column=2, padx=px, pady=py)
 
     # initialize the individual channel objects
-    nEEPROMValues = len(ee.data)
+    nEEPROMValues = len(ee.schema)
 
     self.eepromName = {}
     self.eepromType = {}
@@ -157,7 +186,7 @@ class GUI(Frame):
     Label(cw, text='SN to Write').grid(row=0, column = 1, padx = px, pady = py)
 
     self.newSN = StringVar()
-    self.newSN.set('{0:d}'.format(ee.data[0][2]))
+    self.newSN.set('{0:d}'.format(ee.getValue('serialNumber')))
 
     vcmd = cw.register(self.validateCANSNEntry)
     self.newSNEntry = Entry(cw, textvariable=self.newSN, validate='key',
@@ -167,8 +196,8 @@ class GUI(Frame):
     for i in range(nEEPROMValues):
       rw = i + 2
 
-      eeName = ee.data[i][0]
-      eeType = ee.data[i][1]
+      eeName = ee.schema[i].name
+      eeType = ee.schema[i].type
 
       # eeprom parameter name
       self.eepromName[i] = Label(cw, text='{0:s}'.format(eeName))
@@ -188,17 +217,8 @@ class GUI(Frame):
         padx=px,
         pady=py)
 
-      #try:
-      if True:
-        eeValue = ee.readValue(eeName)
-      #except:
-      #  eeValue = -1
       # eeprom parameter value
       self.eepromValueVar[i] = StringVar()
-      if(eeType == 'int32'):
-        self.eepromValueVar[i].set('{:d}'.format(eeValue))
-      else:
-        self.eepromValueVar[i].set('{:g}'.format(eeValue))
       self.eepromValue[i] = Label(
         cw,
         textvariable=self.eepromValueVar[i])
@@ -209,9 +229,14 @@ class GUI(Frame):
         padx=px,
         pady=py)
 
+    # show the cached values now and whatever the worker reads later
+    self.showEEPROMValues(ee)
+    self.worker.submit('eeprom', self.readEEPROMJob, ee)
+
   def CloseConfigWindow(self):
     self.configureButton.configure(state=NORMAL)
     self.cw.destroy()
+    self.cw = None
 
   def validateCANSNEntry(self, P):
     try:
@@ -224,161 +249,262 @@ class GUI(Frame):
       return False
 
   def validateCANAddressEntry(self, P):
+    # a list of hex addresses, letting a '0x' be typed before the digits
     try:
-      v = int(P, 16)
-      if v > 0x7ff:
-        raise ValueError
+      for word in P.replace(',', ' ').split():
+        if word.lower() != '0x':
+          tracker_table.parseAddresses(word)
       return True
     except ValueError:
       return False
 
+  def baseAddrs(self):
+    return tracker_table.parseAddresses(self.baseAddr.get())
+
   def configCAN(self):
     self.killThread()
-    self.guiStatus.config(text='Status: Configuring CAN Bus')
     bitrate = int(self.bitrateStr.get())
-    if True:
-      if hasattr(self, 'can'):
-        self.can.Close()
-      self.can = can_ethernet.canEthernet()
-      self.can.Connect(bitrate)
-      self.guiStatus.config(text='Status: Configuring CAN Bus Succeeded')
-      self.bridge.config(text='CAN Bridge: %x' % (self.can.bridgeIP))
-      self.discoverButton.config(state=NORMAL)
-    #except:
-    #  self.guiStatus.config(text='Status: Configuring CAN Bus Failed')
-
-  def setConfigState(self, index, state):
-    assert state == 'NORMAL' or state == 'DISABLED'
-    if(state == 'NORMAL'):
-      self.inputVoltage[index].config(state=NORMAL)
-      self.inputCurrent[index].config(state=NORMAL)
-      self.inputPower[index].config(state=NORMAL)
-      self.outputVoltage[index].config(state=NORMAL)
-      self.temperature[index].config(state=NORMAL)
-      self.channelSelected[index].config(state=NORMAL)
-    else:
-      self.inputVoltage[index].config(state=DISABLED)
-      self.inputCurrent[index].config(state=DISABLED)
-      self.inputPower[index].config(state=DISABLED)
-      self.outputVoltage[index].config(state=DISABLED)
-      self.temperature[index].config(state=DISABLED)
-      self.channelSelected[index].config(state=DISABLED)
-    return
+    self.startJob('Configuring CAN Bus', 'connected', self.connectJob,
+                  bitrate)
 
-  def setValues(self, index, error=False, errorString=''):
-    assert error == True or error == False
-    if error == False:
-      # if theres no error, update the values
-      self.inputVoltageStr[index].set(
-        '{0:g}'.format(
-          self.tracker[index].vin))
-      self.inputCurrentStr[index].set(
-        '{0:g}'.format(
-          self.tracker[index].iin))
-      self.inputPowerStr[index].set(
-        '{0:g}'.format(
-          self.tracker[index].vin *
-          self.tracker[index].iin))
-      self.outputVoltageStr[index].set(
-        '{0:g}'.format(
-          self.tracker[index].vout))
-      self.temperatureStr[index].set(
-        '{0:g}'.format(
-          self.tracker[index].temp))
+  def connectJob(self, bitrate):
+    # worker thread: (re)connect to the bridge
+    if self.listener is not None:
+      # put the auto-send rates back while the old connection is up
+      try:
+        self.listener.disable()
+      except Exception:
+        logging.exception('Could not restore the auto-send rates')
+    # the trackers have to be discovered again on the new connection
+    self.listener = None
+    if self.can is not None:
+      self.can.Close()
+    self.can = can_ethernet.canEthernet()
+    self.can.Connect(bitrate, log_dir=can_log.LOG_DIR)
+    return self.can.bridgeIP
+
+  def connected(self, bridgeIP):
+    self.guiStatus.config(text='Status: Configuring CAN Bus Succeeded')
+    self.bridge.config(text='CAN Bridge: %x' % (bridgeIP))
+    self.discoverButton.config(state=NORMAL)
+
+  def selectedTracker(self):
+    # the mppt selected in the table, None if there's none to configure
+    selection = self.tree.selection()
+    if not selection:
+      return None
+    address = int(selection[0], 16)
+    if address not in self.table:
+      return None
+    return self.table[address].tracker
+
+  def trackerSelected(self, event=None):
+    if self.cw is not None:
+      return
+    if self.selectedTracker() is None:
+      self.configureButton.config(state=DISABLED)
     else:
-      # if theres an error, print the error string
-      self.inputVoltageStr[index].set(errorString)
-      self.inputCurrentStr[index].set(errorString)
-      self.inputPowerStr[index].set(errorString)
-      self.outputVoltageStr[index].set(errorString)
-      self.temperatureStr[index].set(errorString)
-    return
+      self.configureButton.config(state=NORMAL)
+
+  def sortBy(self, column):
+    self.table.setSort(column)
+    self.refreshTable()
+
+  def setFilter(self, *args):
+    try:
+      self.table.setFilter(self.filterField.get(), self.filterText.get())
+    except ValueError:
+      # keep the last filter until the text is a number again
+      return
+    self.refreshTable()
+
+  def refreshTable(self, reorder=True):
+    # puts the rows that pass the filter in order, items are detached
+    # rather than deleted so a row filtered out comes back as it was
+    if reorder:
+      order = self.table.order()
+      if order != self.shownOrder:
+        hidden = set(self.shownOrder).difference(order)
+        if hidden:
+          self.tree.detach(*[self.itemId(address) for address in hidden])
+        for index, address in enumerate(order):
+          item = self.itemId(address)
+          if item in self.items:
+            self.tree.move(item, '', index)
+          else:
+            self.tree.insert('', index, iid=item)
+            self.items.add(item)
+        self.shownOrder = order
+    self.renderRows()
+
+  def itemId(self, address):
+    return '{0:03X}'.format(address)
+
+  def renderRows(self):
+    # only the rows in view are brought up to date, the treeview itself
+    # draws only those, so the cost doesn't grow with the number of mppts
+    n = len(self.shownOrder)
+    if n == 0:
+      return
+    first, last = self.tree.yview()
+    start = int(first * n)
+    stop = min(int(math.ceil(last * n)) + 1, n)
+    for address in self.shownOrder[start:stop]:
+      text = self.table[address].render()
+      if text is not None:
+        self.tree.item(self.itemId(address), values=text)
+
+  def scrolled(self, first, last):
+    self.tableScroll.set(first, last)
+    self.renderRows()
 
   def killThread(self):
-    if self.updateJob is not None:
-      self.w.after_cancel(self.updateJob)
+    # stop the status updates
+    self.worker.setPeriodic(None, None, 0)
+
+  def startJob(self, status, name, fn, *args):
+    # runs fn on the worker, the result comes back to the handler for name
+    self.guiStatus.config(text='Status: ' + status)
+    self.worker.submit(name, fn, *args)
 
   def discoverMPPTs(self):
     logging.info('Discovering MPPTs')
-    first = True
-    baseAddr = int(self.baseAddr.get(), 16)
-    for i in range(16):
-      try:
-        self.tracker[i] = mppt.mppt(i, baseAddr, self.can)
-        
-        try:
-          sn = self.tracker[i].ee.readValue('serialNumber')
-          swRev = self.tracker[i].ee.readValue('SWVersion')
-          self.mpptStatus[i].config(
-            text='SN ' +
-            str(sn) +
-            ' SW ' +
-            str(swRev))
-        except eeprom.MpptEepromError:
-          self.mpptStatus[i].config(text='Error Reading SN')
-        self.setConfigState(i, 'NORMAL')
-        self.trackerFound[i] = 1
-      except mppt.MpptNotPresent:
-        self.mpptStatus[i].config(text='Not Found')
-        self.inputVoltage[i].config
-        self.trackerFound[i] = 0
-        self.setConfigState(i, 'DISABLED')
-      # update the gui
-      self.w.update_idletasks()
+    try:
+      baseAddrs = self.baseAddrs()
+    except ValueError:
+      self.guiStatus.config(text='Status: Bad CAN Base Addr')
+      return
+    self.killThread()
+    self.startJob('Discovering MPPTs', 'discovered', self.discoverJob,
+                  baseAddrs, self.autoSend.get())
+
+  def discoverJob(self, baseAddrs, autoSend, provisioned=()):
+    # worker thread: sweep the whole bus at once rather than channel by
+    # channel, for every base address. The trackers at the addresses in
+    # provisioned were just given an auto-send rate and keep it
+    trackers = {}
+    readFailed = []
+    for baseAddr in baseAddrs:
+      report = mppt.discoverMPPTs(self.can, baseAddr, range(16))
+      logging.info(report.summary())
+      for tracker in report.trackers.itervalues():
+        trackers[tracker.canAddress] = tracker
+      readFailed.extend(baseAddr + channel for channel in report.readFailed)
+    # states come in through the listener from here on, and the rates the
+    # last one has to put back are now its to put back
+    listener = mppt.stateListener(self.can, trackers.values())
+    if self.listener is not None:
+      listener.inherit(self.listener)
+    for address in provisioned:
+      listener.keep(address)
+    self.listener = listener
+    if autoSend:
+      listener.enable(self.updateSpeed)
+    else:
+      listener.disable()
+    return trackers, readFailed
+
+  def discovered(self, result):
+    trackers, readFailed = result
+    for tracker in trackers.itervalues():
+      self.telemetry.track(tracker)
+    # the rows are all new, so are their items
+    if self.items:
+      self.tree.delete(*self.items)
+    self.items = set()
+    self.shownOrder = []
+    self.table.setTrackers(trackers, readFailed)
+    self.refreshTable()
     self.guiStatus.config(
-      text='Status: {0:g} MPPTs found'.format(sum(self.trackerFound)))
-
-    firstChannel = -1
-    for i in range(16):
-      if self.trackerFound[i] == 1:
-        firstChannel = i
-        break
-
-    # if trackers are present then start the update thread
-    if sum(self.trackerFound) > 0:
-      self.configureButton.config(state=NORMAL)
-      self.selectedChannel.set(firstChannel)
+      text='Status: {0:d} MPPTs found'.format(len(trackers)))
+
+    # a configuration window open on a rediscovered mppt shows its new
+    # values
+    if self.cw is not None and self.configAddress in trackers:
+      self.showEEPROMValues(trackers[self.configAddress].ee)
+
+    # if trackers are present then start the updates
+    if trackers:
+      if not self.tree.selection() and self.shownOrder:
+        self.tree.selection_set(self.itemId(self.shownOrder[0]))
+      self.trackerSelected()
       self.updateMPPTStatus()
     else:
       self.configureButton.config(state=DISABLED)
     return
 
-  def updateMPPTStatus(self):
-    # ensure theres only one thread running
-    self.killThread()
+  def setAutoSend(self):
+    # have the mppts send their state at the update rate, or put their own
+    # rates back
+    self.worker.submit('autoSend', self.autoSendJob, self.autoSend.get())
+
+  def autoSendJob(self, autoSend):
+    # worker thread
+    if self.listener is None:
+      return
+    if autoSend:
+      self.listener.enable(self.updateSpeed)
+    else:
+      self.listener.disable()
 
-    # this line make it call itself at the chosen rate
-    self.updateJob = self.w.after(
-      1000 /
-      self.updateSpeed,
-      self.updateMPPTStatus)
-
-    # cycle through the mppts and if it showed up on the but get it's data
-    # and display it
-    for i in range(16):
-      if(self.trackerFound[i] == 1):
-        # try:
-        self.tracker[i].getStateData()
-        self.setValues(i)
-        # except:
-        #	self.setValues(i, True, 'error')
-      else:
-        self.setValues(i, True, '0')
+  def updateMPPTStatus(self):
+    # poll the states on the worker at the chosen rate, they come back to
+    # showStates()
+    self.worker.setPeriodic('states', self.statesJob, 1.0 / self.updateSpeed)
+
+  def statesJob(self):
+    # worker thread: take in the states the mppts sent, polling the ones
+    # that went quiet, and hand back the values of every mppt found
+    self.listener.update()
+    states = []
+    for address, t in self.listener.trackers.iteritems():
+      states.append((address, (t.vin, t.iin, t.vin * t.iin, t.vout, t.temp)))
+    return states
+
+  def showStates(self, states):
+    for address, values in states:
+      self.table.update(address, values)
+    # the order only changes when sorted or filtered by a value
+    self.refreshTable(self.table.live())
 
     # print the update number
-    self.updateRate = 1 / (time.time() - self.lastUpdateTime)
+    self.updateRate = 1 / max(time.time() - self.lastUpdateTime, 1e-6)
     self.lastUpdateTime = time.time()
-    updateRateFail = self.updateRate < self.updateSpeed / 5
+    updateRateFail = self.updateRate < self.updateSpeed / 5.0
     if updateRateFail:
       logging.error('Rate too slow, Update Rate = %0.1fhz' %  self.updateRate)
     else:
-      logging.info('New Update, Update Rate = %0.1fhz' %  self.updateRate)
+      logging.debug('New Update, Update Rate = %0.1fhz' %  self.updateRate)
     self.updateNumber += 1
     return
 
-  def Close(self):
-    if hasattr(self, 'can'):
+  def processResults(self):
+    # hand whatever the worker finished to the ui; of several state
+    # updates only the latest is shown
+    states = None
+    for name, result, error in self.worker.results():
+      if error is not None:
+        self.guiStatus.config(text='Status: {0:s} failed: {1:s}'.format(
+          name, str(error)))
+      elif name == 'states':
+        states = result
+      elif name in self.handlers:
+        self.handlers[name](result)
+    if states is not None:
+      self.showStates(states)
+    self.resultJob = self.w.after(RESULT_POLL_MS, self.processResults)
+
+  def closeJob(self):
+    # worker thread
+    if self.can is not None:
+      if self.listener is not None:
+        self.listener.disable()
       self.can.Close()
+
+  def Close(self):
+    self.killThread()
+    self.worker.submit('closed', self.closeJob)
+    self.worker.close(CLOSE_TIMEOUT)
     self.w.quit()
 
   def __init__(self, w):
@@ -405,38 +531,38 @@ class GUI(Frame):
     w.columnconfigure(4, minsize=50, weight=6)
     w.columnconfigure(5, minsize=50, weight=6)
     w.columnconfigure(6, minsize=50, weight=6)
+    # the table takes whatever room the window has
+    w.rowconfigure(0, weight=1)
 
     # classvars
     self.lastUpdateTime = time.time()
-    self.channelSelected = [None] * 16
-    self.tracker = [None] * 16
-    self.mpptStatus = [None] * 16
-    self.inputVoltage = [None] * 16
-    self.inputVoltageStr = [None] * 16
-    self.inputCurrent = [None] * 16
-    self.inputCurrentStr = [None] * 16
-    self.inputPower = [None] * 16
-    self.inputPowerStr = [None] * 16
-    self.outputVoltage = [None] * 16
-    self.trackerFound = [None] * 16
-    self.outputVoltageStr = [None] * 16
-    self.temperature = [None] * 16
-    self.temperatureStr = [None] * 16
+    # every mppt found, by can address
+    self.table = tracker_table.trackerTable()
+    # addresses in the table as shown, and every item made for them
+    self.shownOrder = []
+    self.items = set()
+    # history of every state polled, kept across rediscovery
+    self.telemetry = telemetry.telemetryStore()
     self.updateNumber = 0
-    self.updateJob = None
-    self.updateSpeed = 2  # hzi
+    self.listener = None
+    self.can = None
+    self.cw = None
+    self.configAddress = None
+    self.updateSpeed = 10  # hz
     self.configWindowOpen = 0
     px = 2
     py = 2
 
     # tkinter object vars
     self.heartbeat = IntVar()
+    self.autoSend = IntVar()
     self.baseAddr = StringVar()
     self.baseAddr.set('0x600')
     self.bitrateStr = StringVar()
     self.bitrateStr.set('125000')
-    self.selectedChannel = IntVar()
-    self.selectedChannel.set(-1)
+    self.filterField = StringVar()
+    self.filterField.set(tracker_table.FILTERS[0])
+    self.filterText = StringVar()
 
     # setting up menubar
     self.menubar = Menu(w)
@@ -444,104 +570,52 @@ class GUI(Frame):
     #self.fileMenu = Menu(self.menubar)
     #self.menubar.add_cascade(label="File", menu=self.fileMenu)
 
-    # column labels
-    Label(w, text='Channel').grid(row=0, column=0, padx=px, pady=py)
-    Label(w, text='Status').grid(row=0, column=1, padx=px, pady=py)
-    Label(w, text='Input Voltage').grid(row=0, column=2, padx=px, pady=py)
-    Label(w, text='Input Current').grid(row=0, column=3, padx=px, pady=py)
-    Label(w, text='Input Power').grid(row=0, column=4, padx=px, pady=py)
-    Label(w, text='Output Voltage').grid(row=0, column=5, padx=px, pady=py)
-    Label(w, text='MPPT Temp').grid(row=0, column=6, padx=px, pady=py)
-
-    # initialize the individual channel objects
-    for i in range(16):
-      rw = i + 1
-      # box for writing the channel number
-      txt = '{0:g}'.format(i)
-      self.channelSelected[i] = Radiobutton(w, text=txt, variable=self.selectedChannel,
-                          value=i, state=DISABLED)
-      self.channelSelected[i].grid(
-        row=rw,
-        column=0,
-        sticky=W,
-        padx=px,
-        pady=py)
-
-      # status box for writing the serial number and software revision
-      self.mpptStatus[i] = Label(w, text='')
-      self.mpptStatus[i].grid(
-        row=rw,
-        column=1,
-        sticky=W,
-        padx=px,
-        pady=py)
-
-      # make handles for the objects for writing to the value cells
-      self.inputVoltageStr[i] = StringVar()
-      self.inputCurrentStr[i] = StringVar()
-      self.inputPowerStr[i] = StringVar()
-      self.outputVoltageStr[i] = StringVar()
-      self.temperatureStr[i] = StringVar()
-
-      self.inputVoltage[i] = Entry(
-        w,
-        state=DISABLED,
-        textvariable=self.inputVoltageStr[i])
-      self.inputVoltage[i].grid(
-        row=rw,
-        column=2,
-        sticky=W,
-        padx=px,
-        pady=py)
-
-      self.inputCurrent[i] = Entry(
-        w,
-        state=DISABLED,
-        textvariable=self.inputCurrentStr[i])
-      self.inputCurrent[i].grid(
-        row=rw,
-        column=3,
-        sticky=W,
-        padx=px,
-        pady=py)
+    # table of the mppts, one item per mppt rather than a row of widgets,
+    # clicking a column heading sorts by it
+    headings = ('Address', 'Status', 'Input Voltage', 'Input Current',
+                'Input Power', 'Output Voltage', 'MPPT Temp')
+    self.tree = ttk.Treeview(
+      w,
+      columns=tracker_table.COLUMNS,
+      show='headings',
+      selectmode='browse',
+      height=16)
+    for column, heading in zip(tracker_table.COLUMNS, headings):
+      self.tree.heading(column, text=heading,
+                        command=lambda c=column: self.sortBy(c))
+      self.tree.column(column, width=100, minwidth=50)
+    self.tree.column('status', width=140)
+    self.tree.grid(
+      row=0,
+      column=0,
+      columnspan=7,
+      sticky=N+S+E+W,
+      padx=px,
+      pady=py)
+    self.tree.bind('<<TreeviewSelect>>', self.trackerSelected)
 
-      self.inputPower[i] = Entry(
-        w,
-        state=DISABLED,
-        textvariable=self.inputPowerStr[i])
-      self.inputPower[i].grid(
-        row=rw,
-        column=4,
-        sticky=W,
-        padx=px,
-        pady=py)
+    self.tableScroll = ttk.Scrollbar(w, orient=VERTICAL,
+                                     command=self.tree.yview)
+    self.tableScroll.grid(row=0, column=7, sticky=N+S)
+    self.tree.configure(yscrollcommand=self.scrolled)
 
-      self.outputVoltage[i] = Entry(
-        w,
-        state=DISABLED,
-        textvariable=self.outputVoltageStr[i])
-      self.outputVoltage[i].grid(
-        row=rw,
-        column=5,
-        sticky=W,
-        padx=px,
-        pady=py)
-
-      self.temperature[i] = Entry(
-        w,
-        state=DISABLED,
-        textvariable=self.temperatureStr[i])
-      self.temperature[i].grid(
-        row=rw,
-        column=6,
-        sticky=W,
-        padx=px,
-        pady=py)
+    # filter for the table
+    Label(w, text='Filter:').grid(row=1, column=0, sticky=W, padx=px, pady=py)
+    self.filterSelect = ttk.Combobox(
+      w,
+      textvariable=self.filterField,
+      values=tracker_table.FILTERS,
+      state='readonly')
+    self.filterSelect.grid(row=1, column=1, sticky=W, padx=px, pady=py)
+    self.filterEntry = Entry(w, textvariable=self.filterText)
+    self.filterEntry.grid(row=1, column=2, sticky=W, padx=px, pady=py)
+    self.filterField.trace('w', self.setFilter)
+    self.filterText.trace('w', self.setFilter)
 
     # footer status labels
     self.guiStatus = Label(w, text='Status: Init')
     self.guiStatus.grid(
-      row=18,
+      row=3,
       column=0,
       columnspan=2,
       sticky=W,
@@ -551,7 +625,7 @@ class GUI(Frame):
     # status for the can bridge
     self.bridge = Label(w, text='CAN Bridge:')
     self.bridge.grid(
-      row=19,
+      row=4,
       column=0,
       columnspan=2,
       sticky=W,
@@ -559,26 +633,34 @@ class GUI(Frame):
       pady=py)
 
     # label for the can address
-    self.canAddrLabel = Label(w, text='CAN Base Addr:')
-    self.canAddrLabel.grid(row=20, column=0, sticky=W, padx=px, pady=py)
+    self.canAddrLabel = Label(w, text='CAN Base Addrs:')
+    self.canAddrLabel.grid(row=5, column=0, sticky=W, padx=px, pady=py)
 
     # button to intialize the can bus
     self.canButton = ttk.Button(w, text='Init CAN', command=self.configCAN)
-    self.canButton.grid(row=17, column=0)
+    self.canButton.grid(row=2, column=0)
 
     # button to discover the mppts
     self.discoverButton = ttk.Button(w, state=DISABLED, text='Discover MPPTs',
                      command=self.discoverMPPTs)
-    self.discoverButton.grid(row=17, column=1)
+    self.discoverButton.grid(row=2, column=1)
 
     # button to configure the mpppt
     self.configureButton = ttk.Button(
       w,
       text='Config MPPT',
       command=self.configureMPPT)
-    self.configureButton.grid(row=17, column=2)
+    self.configureButton.grid(row=2, column=2)
     self.configureButton.configure(state=DISABLED)
 
+    # check box to have the mppts send their state rather than be polled
+    self.autoSendCheck = Checkbutton(
+      w,
+      text='Auto-send',
+      variable=self.autoSend,
+      command=self.setAutoSend)
+    self.autoSendCheck.grid(row=2, column=3, sticky=W)
+
     # entry for the can address - this uses a validator
     vcmd = w.register(self.validateCANAddressEntry)
     self.canAddrEntry = Entry(
@@ -588,16 +670,16 @@ class GUI(Frame):
       validatecommand=(
         vcmd,
         '%P'))
-    self.canAddrEntry.grid(row=20, column=1, sticky=W)
+    self.canAddrEntry.grid(row=5, column=1, sticky=W)
 
     self.bitrateLabel = Label(w, text='CAN Bitrate:')
-    self.bitrateLabel.grid(row=21, column=0, sticky=W, padx=px, pady=py)
+    self.bitrateLabel.grid(row=6, column=0, sticky=W, padx=px, pady=py)
 
     self.bitrateSelect = ttk.Combobox(
       w,
       textvariable=self.bitrateStr,
       state='readonly')
-    self.bitrateSelect.grid(row=21, column=1, sticky=W, padx=px, pady=py)
+    self.bitrateSelect.grid(row=6, column=1, sticky=W, padx=px, pady=py)
     self.bitrateSelect['values'] = (
       '10000',
       '20000',
@@ -607,10 +689,19 @@ class GUI(Frame):
       '500000',
       '1000000')
 
+    # every bus operation runs on the worker, its results come back through
+    # processResults()
+    self.handlers = {
+      'connected': self.connected,
+      'discovered': self.discovered,
+      'eeprom': self.showEEPROMValues}
+    self.worker = bus_worker.busWorker()
+    self.processResults()
+
     logging.info('All GUI Elements Initialized')
 
     #self.heartbeatIndicator = Checkbutton(w, variable=self.heartbeat, onvalue=1, offvalue=0, image=None, bitmap=None, indicatoron=FALSE, text="Heartbeat")
-    #self.heartbeatIndicator.grid(row=17, column = 2)
+    #self.heartbeatIndicator.grid(row=2, column = 2)
 
     # self.configCAN()
     # time.sleep(1)
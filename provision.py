@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'util'))
+
+import can_ethernet
+import can_log
+import config_store
+import eeprom
+import mppt
+
+from multiprocessing import freeze_support
+
+# Headless provisioning of a whole rack of MPPTs, e.g.
+#   python provision.py --base 0x600 --config configuration.csv --expect 16
+# Every MPPT found is matched to its configuration by serial number, the
+# configurations are pushed to all units together, the units that changed
+# are reset together and then read back. Exits non-zero if any unit could
+# not be configured.
+
+
+class unitResult():
+  # what happened to one MPPT
+
+  def __init__(self, tracker, responseTime, readTime):
+    self.tracker = tracker
+    self.serialNumber = tracker.ee.getValue('serialNumber')
+    self.responseTime = responseTime
+    self.readTime = readTime
+    self.report = None
+    self.mismatched = []
+    self.error = None
+
+  def ok(self):
+    return (self.error is None and not self.mismatched and
+            (self.report is None or self.report.ok()))
+
+  def status(self):
+    if self.error is not None:
+      return self.error
+    if self.report is not None and not self.report.ok():
+      if self.report.error is not None:
+        return self.report.error
+      return 'write failed: ' + ', '.join(
+          key for key, wanted, got in self.report.failed)
+    if self.mismatched:
+      return 'mismatch after reset: ' + ', '.join(
+          key for key, wanted, got in self.mismatched)
+    if self.report is not None and self.report.changed:
+      return 'configured, %d changed' % len(self.report.changed)
+    return 'already configured'
+
+
+def provisionRack(can, store, baseid, channels, resetTime, reset=True):
+  '''Configures every MPPT on the bus, returns (discovery report, list of
+  unitResult).'''
+  discovery = mppt.discoverMPPTs(can, baseid, channels)
+  results = []
+  targets = {}
+  for channel in sorted(discovery.trackers):
+    tracker = discovery.trackers[channel]
+    result = unitResult(tracker, discovery.responseTimes[channel],
+                        discovery.readTimes[channel])
+    results.append(result)
+    target = store.lookup(result.serialNumber)
+    if target is None:
+      result.error = 'no configuration for SN %d' % result.serialNumber
+      continue
+    targets[tracker.ee] = target
+
+  # push every configuration at once
+  reports = eeprom.provisionMany(targets)
+  for result in results:
+    result.report = reports.get(result.tracker.ee)
+
+  # reset the units that changed together and read them all back
+  changed = [r for r in results
+             if r.report is not None and r.report.ok() and r.report.changed]
+  if reset and changed:
+    logging.info('Resetting %d MPPTs', len(changed))
+    for result in changed:
+      result.tracker.reset(wait=False)
+    time.sleep(resetTime)
+    read = eeprom.readMany([r.tracker.ee for r in changed])
+    for result in changed:
+      ee = result.tracker.ee
+      if ee not in read:
+        result.error = 'no answer after reset'
+      else:
+        result.mismatched = ee.compare(targets[ee])
+  return discovery, results
+
+
+def printSummary(discovery, results, elapsed):
+  print('%-6s %-6s %-10s %8s %8s %8s  %s' % (
+      'Ch', 'Addr', 'SN', 'RTR ms', 'Read ms', 'Push ms', 'Result'))
+  for result in results:
+    tracker = result.tracker
+    push = result.report.elapsed * 1000 if result.report is not None else 0
+    print('%-6d 0x%03X  %-10d %8.1f %8.1f %8.1f  %s' % (
+        tracker.channel, tracker.canAddress, result.serialNumber,
+        result.responseTime * 1000, result.readTime * 1000, push,
+        result.status()))
+  for channel in discovery.readFailed:
+    print('%-6d 0x%03X  %-10s %8.1f %8s %8s  %s' % (
+        channel, discovery.baseid + channel, '?',
+        discovery.responseTimes[channel] * 1000, '-', '-',
+        'EEPROM read failed'))
+  good = sum(1 for r in results if r.ok())
+  print('%d of %d MPPTs configured in %.2f s' % (
+      good, len(results) + len(discovery.readFailed), elapsed))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Configure every MPPT on a CAN bus from a configuration '
+      'file')
+  parser.add_argument('--base', type=lambda x: int(x, 16), default=0x600,
+                      help='CAN base address in hex')
+  parser.add_argument('--channels', type=int, default=16,
+                      help='number of channels to look for')
+  parser.add_argument('--bitrate', type=int, default=500000,
+                      help='CAN bitrate')
+  parser.add_argument('--log-dir', default=can_log.LOG_DIR,
+                      help="directory to capture the bus to, '' for none")
+  parser.add_argument('--config', default=config_store.DEFAULT_FILE,
+                      help='configuration file')
+  parser.add_argument('--expect', type=int, default=None,
+                      help='fail unless this many MPPTs are found')
+  parser.add_argument('--reset-time', type=float, default=mppt.RESET_TIME,
+                      help='seconds to let the MPPTs boot after a reset')
+  parser.add_argument('--no-reset', dest='reset', action='store_false',
+                      help='do not reset the MPPTs after configuring them')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+  store = config_store.openStore(args.config)
+
+  start = time.time()
+  can = can_ethernet.canEthernet()
+  try:
+    can.Connect(args.bitrate, log_dir=args.log_dir or None)
+    discovery, results = provisionRack(can, store, args.base,
+                                       range(args.channels),
+                                       args.reset_time, args.reset)
+  finally:
+    can.Close()
+  printSummary(discovery, results, time.time() - start)
+
+  failed = discovery.readFailed or [r for r in results if not r.ok()]
+  # every unit that answered counts, whether or not its EEPROM was read
+  found = len(discovery.responseTimes)
+  if args.expect is not None and found != args.expect:
+    print('Expected %d MPPTs, found %d' % (args.expect, found))
+    return 2
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  freeze_support()
+  sys.exit(main())
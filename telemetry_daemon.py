@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'util'))
+
+import can_ethernet
+import can_log
+import mppt
+import telemetry
+
+from multiprocessing import freeze_support
+
+# Headless telemetry: discovers the MPPTs on a bus, keeps their state up to
+# date and serves it over HTTP, e.g.
+#   python telemetry_daemon.py --base 0x600 --rate 2 --port 9105
+#   curl http://127.0.0.1:9105/metrics
+# /metrics is in the Prometheus text format and /json is a JSON snapshot.
+# Both are rendered once per poll and only copied out per request, so
+# scraping costs the bus and the poller nothing.
+
+DEFAULT_PORT = 9105
+# seconds between sweeps for channels that have not answered yet
+REDISCOVER_TIME = 60
+# seconds without a state after which a tracker is reported down
+STALE_TIME = 10
+
+# metric name, help, sample key
+GAUGES = (
+    ('mppt_input_voltage_volts', 'Input voltage.', 'vin'),
+    ('mppt_input_current_amps', 'Input current.', 'iin'),
+    ('mppt_input_power_watts', 'Input power.', 'power'),
+    ('mppt_output_voltage_volts', 'Output voltage.', 'vout'),
+    ('mppt_temperature_celsius', 'MPPT temperature.', 'temp'),
+    ('mppt_last_update_timestamp_seconds',
+     'Receive time of the last state.', 'time'),
+    )
+
+
+class snapshot():
+  # what one poll rendered, handed to the HTTP threads as a whole
+
+  def __init__(self, metrics='', document='{}'):
+    self.metrics = metrics
+    self.document = document
+
+
+class telemetryDaemon():
+  # discovery and polling on a fixed schedule, publishing a snapshot after
+  # every poll
+
+  def __init__(self, can, baseid, channels, rate, autoSend=False,
+               rediscover=REDISCOVER_TIME, depth=telemetry.DEPTH):
+    self.can = can
+    self.baseid = baseid
+    self.channels = list(channels)
+    self.rate = rate
+    self.autoSend = autoSend
+    self.rediscover = rediscover
+    self.store = telemetry.telemetryStore(depth)
+    self.listener = mppt.stateListener(can, [])
+    self.trackers = {}
+    self.stop = threading.Event()
+    self.snapshot = snapshot()
+    self.nPolls = 0
+    self.started = time.time()
+
+  def discover(self):
+    missing = [c for c in self.channels if c not in self.trackers]
+    if not missing:
+      return
+    report = mppt.discoverMPPTs(self.can, self.baseid, missing)
+    for channel, tracker in report.trackers.iteritems():
+      logging.info('Tracking MPPT 0x%03X SN %d', tracker.canAddress,
+                   tracker.ee.getValue('serialNumber'))
+      self.trackers[channel] = tracker
+      self.store.track(tracker)
+      self.listener.add(tracker)
+    if self.autoSend and report.trackers:
+      self.listener.enable(self.rate)
+
+  def run(self):
+    nextDiscovery = time.time()
+    nextPoll = time.time()
+    while not self.stop.is_set():
+      now = time.time()
+      if now >= nextDiscovery:
+        self.discover()
+        nextDiscovery = now + self.rediscover
+      if now >= nextPoll:
+        self.listener.update()
+        self.nPolls += 1
+        self.snapshot = self.render(time.time())
+        # keep to the schedule rather than drift by the poll time
+        nextPoll = max(nextPoll + 1.0 / self.rate, now)
+      self.stop.wait(max(min(nextPoll, nextDiscovery) - time.time(), 0))
+    if self.autoSend:
+      self.listener.disable()
+
+  def samples(self, now):
+    # (labels, sample or None, up) for every tracker
+    latest = self.store.latest()
+    rows = []
+    for channel in sorted(self.trackers):
+      tracker = self.trackers[channel]
+      sample = latest.get(tracker.canAddress)
+      up = sample is not None and now - sample['time'] < STALE_TIME
+      labels = (('channel', str(channel)),
+                ('address', '0x%03X' % tracker.canAddress),
+                ('serial', str(tracker.ee.getValue('serialNumber'))))
+      rows.append((labels, sample, up))
+    return rows
+
+  def stats(self):
+    can = self.can.GetStats()
+    return {'trackers': len(self.trackers),
+            'polls': self.nPolls,
+            'auto_sent': self.listener.nAutoSent,
+            'polled': self.listener.nPolled,
+            'rx_frames': can['rx_frames'],
+            'tx_frames': can['tx_frames'],
+            'unsolicited': can['unsolicited'],
+            'uptime': time.time() - self.started}
+
+  def render(self, now):
+    rows = self.samples(now)
+    stats = self.stats()
+    return snapshot(renderMetrics(rows, stats, now),
+                    renderDocument(rows, stats, now))
+
+
+def labelText(labels):
+  return '{%s}' % ','.join('%s="%s"' % pair for pair in labels)
+
+
+def renderMetrics(rows, stats, now):
+  lines = []
+  for name, doc, key in GAUGES:
+    lines.append('# HELP %s %s' % (name, doc))
+    lines.append('# TYPE %s gauge' % name)
+    for labels, sample, up in rows:
+      if sample is not None:
+        lines.append('%s%s %r' % (name, labelText(labels),
+                                  float(sample[key])))
+  lines.append('# HELP mppt_up Whether the MPPT sent a state in the last '
+               '%d s.' % STALE_TIME)
+  lines.append('# TYPE mppt_up gauge')
+  for labels, sample, up in rows:
+    lines.append('mppt_up%s %d' % (labelText(labels), up))
+  for name, doc, key in (
+      ('mppt_trackers', 'MPPTs found.', 'trackers'),
+      ('mppt_polls_total', 'Polls run.', 'polls'),
+      ('mppt_auto_sent_states_total', 'States the MPPTs sent unasked.',
+       'auto_sent'),
+      ('mppt_polled_states_total', 'States sent in reply to an RTR.',
+       'polled'),
+      ('can_rx_frames_total', 'Frames received from the bridge.',
+       'rx_frames'),
+      ('can_tx_frames_total', 'Frames sent to the bridge.', 'tx_frames'),
+      ('can_unsolicited_frames_total', 'Frames nobody waited for.',
+       'unsolicited')):
+    kind = 'counter' if name.endswith('_total') else 'gauge'
+    lines.append('# HELP %s %s' % (name, doc))
+    lines.append('# TYPE %s %s' % (name, kind))
+    lines.append('%s %d' % (name, stats[key]))
+  lines.append('# HELP mppt_snapshot_timestamp_seconds When this snapshot '
+               'was taken.')
+  lines.append('# TYPE mppt_snapshot_timestamp_seconds gauge')
+  lines.append('mppt_snapshot_timestamp_seconds %r' % now)
+  return '\n'.join(lines) + '\n'
+
+
+def renderDocument(rows, stats, now):
+  trackers = []
+  for labels, sample, up in rows:
+    entry = dict(labels)
+    entry['channel'] = int(entry['channel'])
+    entry['serial'] = int(entry['serial'])
+    entry['up'] = bool(up)
+    if sample is not None:
+      entry.update((key, float(value)) for key, value in sample.iteritems())
+    trackers.append(entry)
+  return json.dumps({'time': now, 'trackers': trackers, 'stats': stats},
+                    sort_keys=True)
+
+
+class snapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # serves the daemon's last snapshot as it stands, nothing is computed
+  # per request
+
+  def do_GET(self):
+    current = self.server.telemetry.snapshot
+    path = self.path.split('?', 1)[0]
+    if path == '/metrics':
+      self.reply('text/plain; version=0.0.4', current.metrics)
+    elif path == '/json':
+      self.reply('application/json', current.document)
+    elif path == '/':
+      self.reply('text/plain', 'MPPT telemetry: /metrics /json\n')
+    else:
+      self.send_error(404)
+
+  def reply(self, contentType, body):
+    self.send_response(200)
+    self.send_header('Content-Type', contentType)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug('%s %s', self.address_string(), format % args)
+
+
+def serve(daemon, bind, port):
+  # starts the HTTP server on a thread of its own, returns the server
+  server = BaseHTTPServer.HTTPServer((bind, port), snapshotHandler)
+  server.telemetry = daemon
+  thread = threading.Thread(target=server.serve_forever, name='http')
+  thread.daemon = True
+  thread.start()
+  logging.info('Serving telemetry on http://%s:%d/',
+               *server.server_address[:2])
+  return server
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Poll the MPPTs on a CAN bus and serve their telemetry '
+      'over HTTP')
+  parser.add_argument('--base', type=lambda x: int(x, 16), default=0x600,
+                      help='CAN base address in hex')
+  parser.add_argument('--channels', type=int, default=16,
+                      help='number of channels to look for')
+  parser.add_argument('--bitrate', type=int, default=500000,
+                      help='CAN bitrate')
+  parser.add_argument('--log-dir', default=can_log.LOG_DIR,
+                      help="directory to capture the bus to, '' for none")
+  parser.add_argument('--rate', type=float, default=2,
+                      help='state updates per second')
+  parser.add_argument('--auto-send', action='store_true',
+                      help='have the MPPTs send their state at the rate '
+                      'rather than be polled, until the daemon stops')
+  parser.add_argument('--rediscover', type=float, default=REDISCOVER_TIME,
+                      help='seconds between sweeps for missing MPPTs')
+  parser.add_argument('--depth', type=int, default=telemetry.DEPTH,
+                      help='samples of history kept per MPPT')
+  parser.add_argument('--bind', default='127.0.0.1',
+                      help='address to serve on')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                      help='port to serve on')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+  can = can_ethernet.canEthernet()
+  server = None
+  try:
+    can.Connect(args.bitrate, log_dir=args.log_dir or None)
+    daemon = telemetryDaemon(can, args.base, range(args.channels), args.rate,
+                             args.auto_send, args.rediscover, args.depth)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop.set())
+    server = serve(daemon, args.bind, args.port)
+    try:
+      daemon.run()
+    except KeyboardInterrupt:
+      daemon.stop.set()
+      if daemon.autoSend:
+        daemon.listener.disable()
+  finally:
+    if server is not None:
+      server.shutdown()
+      server.server_close()
+    can.Close()
+  return 0
+
+
+if __name__ == '__main__':
+  freeze_support()
+  sys.exit(main())
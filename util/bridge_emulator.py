@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import select
+import socket
+import struct
+import time
+
+import can_ethernet
+import can_msg_pb2
+import eeprom_schema
+
+# A stand-in for a Tritium CAN-Ethernet bridge with a string of Photon MPPTs
+# behind it, speaking the same UDP multicast framing, e.g.
+#   python bridge_emulator.py --count 16 --latency 0.002 --jitter 0.001
+
+HEARTBEAT_INTERVAL = 1.0
+RESET_TIME = 0.5
+EMULATOR_MAC = 0x02dc00000000
+
+# EEPROM contents every emulated unit starts out with
+DEFAULT_EEPROM = {
+    'hardOutputVoltage': 160, 'minOutputVoltage': 0,
+    'maxOutputVoltage': 125, 'constOutputVoltage': 124,
+    'maxTemperature': 110, 'hardCurrent': 12, 'maxCurrent': 12,
+    'scaleAmpsIn': 16.5, 'offsetAmpsIn': 0, 'scaleAmpsOut': 16.5,
+    'offsetAmpsOut': 0, 'scaleVoltsIn': 200, 'offsetVoltsIn': 0,
+    'scaleVoltsOut': 200, 'offsetVoltsOut': 0, 'constVoltageHyst': 0.2,
+    'safetyVoltageHyst': 2, 'safetyCurrentHyst': 0.25,
+    'safetyTemperatureHyst': 5, 'thermistorBeta': 4150,
+    'thermistorRo': 50000, 'thermistorRbias': 8060, 'thermistorTo': 25,
+    'canBitrate': 500000, 'testMode': 0, 'POseconds': 2,
+    'INCseconds': 20, 'TRACKseconds': 300, 'SWVersion': 1005,
+    'syncCurrentHi': 3, 'syncCurrentLow': 2, 'autoSendRate': 0,
+    }
+
+# EEPROM magic number carried in bytes 4-6 of writes and resets
+MAGIC = (45, 78, 69)
+RESET_INDEX = 0xfe
+
+STATE = struct.Struct('<HHHH')
+
+
+class photonEmulator():
+  '''One simulated Photon MPPT.
+
+  Answers status RTRs at canAddress, EEPROM reads at canAddress + 0x20 and
+  EEPROM writes and resets at canAddress + 0x30. Read replies carry the
+  value little endian in bytes 0-3 and, when echo_index is set, the index
+  in byte 7. With autoSendRate set the state is also sent at canAddress
+  that many times a second without being asked; a write to it takes effect
+  straight away.
+  '''
+
+  def __init__(self, canAddress, serial, baseid, echo_index=True,
+               auto_send=0):
+    self.canAddress = canAddress
+    self.echo_index = echo_index
+    self.schema = eeprom_schema.DEFAULT
+    self.values = [DEFAULT_EEPROM.get(f.name, 0) for f in self.schema]
+    self.values[self.schema.index['serialNumber']] = serial
+    self.values[self.schema.index['canBaseAddress']] = baseid
+    self.values[self.schema.index['autoSendRate']] = auto_send
+    self.next_auto_send = None
+    self.asleep_until = 0
+    self.vin = random.uniform(40, 60)
+    self.iin = random.uniform(3, 6)
+    self.temp = random.uniform(25, 40)
+
+  def Handle(self, frame, now):
+    '''Returns the (id, flags, data) frames the unit sends in reply.'''
+    if now < self.asleep_until:
+      return []
+    _, can_id, pkt_type, dlc, data = frame
+    if can_id == self.canAddress and pkt_type == can_msg_pb2.STD_RTR:
+      return [(self.canAddress, 0, self.StateData())]
+    if pkt_type != can_msg_pb2.STD or dlc != 8:
+      return []
+    data = bytearray(data)
+    idx = data[7]
+    if can_id == self.canAddress + 0x20:
+      if idx >= len(self.values):
+        return []
+      value = self.schema[idx].encode(self.values[idx])
+      return [(can_id, 0, value + ('\0' * 3) +
+               chr(idx if self.echo_index else 0))]
+    if can_id == self.canAddress + 0x30 and tuple(data[4:7]) == MAGIC:
+      if idx == RESET_INDEX:
+        self.asleep_until = now + RESET_TIME
+      elif idx < len(self.values):
+        self.values[idx] = self.schema[idx].decode(data)
+    return []
+
+  def AutoSendPeriod(self):
+    rate = self.values[self.schema.index['autoSendRate']]
+    if rate <= 0:
+      return None
+    return 1.0 / rate
+
+  def AutoSend(self, now):
+    '''Returns the state frame if one is due, and when the next one is.'''
+    period = self.AutoSendPeriod()
+    if period is None:
+      self.next_auto_send = None
+      return [], None
+    if self.next_auto_send is None:
+      # units are not in step with each other
+      self.next_auto_send = now + random.uniform(0, period)
+    if now < self.next_auto_send:
+      return [], self.next_auto_send
+    self.next_auto_send = max(self.next_auto_send + period, now)
+    if now < self.asleep_until:
+      return [], self.next_auto_send
+    return [(self.canAddress, 0, self.StateData())], self.next_auto_send
+
+  def StateData(self):
+    # Wander a little so pollers see changing values
+    self.vin = min(max(self.vin + random.uniform(-0.2, 0.2), 0), 120)
+    self.iin = min(max(self.iin + random.uniform(-0.05, 0.05), 0), 10)
+    vout = self.vin * 2.2
+    self.temp = min(max(self.temp + random.uniform(-0.1, 0.1), 0), 90)
+    return STATE.pack(int(self.vin * 100), int(self.iin * 1000),
+                      int(vout * 100), int(self.temp * 100))
+
+
+class bridgeEmulator():
+  '''Serves emulated MPPTs over the bridge's UDP multicast protocol.
+
+  Requests from any other host on the group are answered after latency
+  plus up to jitter seconds, each reply frame being lost with probability
+  loss. Replies on one id keep their order. Replies that fall due together
+  share a datagram, as they would coming off a busy bus.
+  '''
+
+  def __init__(self, count=16, baseid=0x600, latency=0.0, jitter=0.0,
+               loss=0.0, bus_number=0, bitrate=500000, echo_index=True,
+               mac=EMULATOR_MAC, first_serial=1000, auto_send=0):
+    self.latency = latency
+    self.jitter = jitter
+    self.loss = loss
+    self.bus_number = bus_number
+    self.bitrate = bitrate
+    # bridges on different buses need different MACs
+    self.mac = mac | bus_number
+    self.units = {}
+    self.unit_list = []
+    for channel in xrange(count):
+      unit = photonEmulator(baseid + channel, first_serial + channel, baseid,
+                            echo_index, auto_send)
+      self.unit_list.append(unit)
+      for can_id in (unit.canAddress, unit.canAddress + 0x20,
+                     unit.canAddress + 0x30):
+        self.units[can_id] = unit
+    self.pending = []
+    self.last_due = {}
+    self.sequence = itertools.count()
+    self.n_requests = 0
+    self.n_replies = 0
+    self.n_lost = 0
+    self.n_auto_sent = 0
+    self.rx_buf = bytearray(can_ethernet.BUFFER_SIZE)
+    self.Connect()
+
+  def Connect(self):
+    self.rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    mreq = struct.pack('=4sl', socket.inet_aton(can_ethernet.MCAST_GRP),
+                       socket.INADDR_ANY)
+    self.rx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    self.rx_sock.bind(('', can_ethernet.MCAST_PORT))
+    self.rx_sock.setblocking(0)
+    self.tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+
+  def Close(self):
+    self.rx_sock.close()
+    self.tx_sock.close()
+
+  def Heartbeat(self):
+    bitrate = self.bitrate // 1000
+    return (0, can_ethernet.FLAG_HEARTBEAT, chr(bitrate >> 8) +
+            chr(bitrate & 0xff))
+
+  def run(self, kill=None, duration=None):
+    end = None if duration is None else time.time() + duration
+    next_heartbeat = time.time()
+    while not (kill is not None and kill.value):
+      now = time.time()
+      if end is not None and now >= end:
+        break
+      if now >= next_heartbeat:
+        self.Schedule(now, [self.Heartbeat()], lossless=True)
+        next_heartbeat = now + HEARTBEAT_INTERVAL
+      wake = min(next_heartbeat, self.AutoSend(now))
+      self.SendDue(now)
+      if self.pending:
+        wake = min(wake, self.pending[0][0])
+      try:
+        readable = select.select([self.rx_sock], [], [],
+                                 max(wake - time.time(), 0))[0]
+      except select.error:
+        continue
+      if readable:
+        self.Receive()
+    self.Close()
+
+  def AutoSend(self, now):
+    # schedules the state frames due, returns when the next one is
+    wake = now + HEARTBEAT_INTERVAL
+    frames = []
+    for unit in self.unit_list:
+      due, next_due = unit.AutoSend(now)
+      frames.extend(due)
+      if next_due is not None:
+        wake = min(wake, next_due)
+    if frames:
+      self.n_auto_sent += len(frames)
+      self.Schedule(now, frames)
+    return wake
+
+  def Receive(self):
+    while True:
+      try:
+        n = self.rx_sock.recv_into(self.rx_buf)
+      except socket.error:
+        return
+      if n < can_ethernet.HEADER_SIZE:
+        continue
+      mac_lo, mac_hi = can_ethernet.MAC.unpack_from(self.rx_buf, 10)
+      if mac_lo | (mac_hi << 32) == self.mac:
+        continue
+      if self.rx_buf[7] & 0x0F != self.bus_number:
+        # For another bridge
+        continue
+      now = time.time()
+      replies = []
+      for frame in can_ethernet.DecodeFrames(self.rx_buf,
+                                             can_ethernet.HEADER_SIZE, n):
+        self.n_requests += 1
+        if frame[2] == can_msg_pb2.TRITIUM_SETTINGS:
+          data = bytearray(frame[4])
+          if len(data) == 3 and data[0] == 0x85:
+            self.bitrate = (data[1] * 0x100 + data[2]) * 1000
+          replies.append(self.Heartbeat())
+          continue
+        unit = self.units.get(frame[1])
+        if unit is not None:
+          replies.extend(unit.Handle(frame, now))
+      if replies:
+        self.Schedule(now, replies)
+
+  def Schedule(self, now, frames, lossless=False):
+    for frame in frames:
+      if not lossless and self.loss and random.random() < self.loss:
+        self.n_lost += 1
+        continue
+      due = now + self.latency + random.uniform(0, self.jitter)
+      # a node answers in order however long each reply takes
+      due = max(due, self.last_due.get(frame[0], 0))
+      self.last_due[frame[0]] = due
+      heapq.heappush(self.pending, (due, next(self.sequence), frame))
+
+  def SendDue(self, now):
+    frames = []
+    while self.pending and self.pending[0][0] <= now:
+      frames.append(heapq.heappop(self.pending)[2])
+    for i in xrange(0, len(frames), can_ethernet.MAX_BATCH):
+      self.Send(frames[i:i + can_ethernet.MAX_BATCH])
+
+  def Send(self, frames):
+    msg = bytearray(can_ethernet.HEADER_SIZE +
+                    len(frames) * can_ethernet.FRAME_SIZE)
+    can_ethernet.BUS_ID.pack_into(msg, 0,
+                                  0x0054726974697560 | self.bus_number)
+    can_ethernet.MAC.pack_into(msg, 10, self.mac & 0xffffffff,
+                               self.mac >> 32)
+    offset = can_ethernet.HEADER_SIZE
+    for can_id, flags, data in frames:
+      can_ethernet.FRAME.pack_into(msg, offset, can_id, flags, len(data),
+                                   data)
+      offset += can_ethernet.FRAME_SIZE
+    self.tx_sock.sendto(msg, (can_ethernet.MCAST_GRP, can_ethernet.MCAST_PORT))
+    self.n_replies += len(frames)
+
+
+def RunEmulator(kill, *args, **kwargs):
+  '''multiprocessing.Process target, runs until kill.value is set.'''
+  bridgeEmulator(*args, **kwargs).run(kill)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Emulate a CAN-Ethernet bridge with Photon MPPTs behind it')
+  parser.add_argument('--count', type=int, default=16,
+                      help='number of emulated MPPTs')
+  parser.add_argument('--base', type=lambda x: int(x, 0), default=0x600,
+                      help='CAN base address of the first MPPT')
+  parser.add_argument('--bus', type=int, default=0, help='bus number')
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='reply latency in seconds')
+  parser.add_argument('--jitter', type=float, default=0.0,
+                      help='extra random latency of up to this many seconds')
+  parser.add_argument('--loss', type=float, default=0.0,
+                      help='probability of dropping each reply frame')
+  parser.add_argument('--no-echo', dest='echo_index', action='store_false',
+                      help='do not echo the index in EEPROM read replies')
+  parser.add_argument('--auto-send', type=float, default=0,
+                      help='initial autoSendRate of every unit, in Hz')
+  parser.add_argument('--duration', type=float, default=None,
+                      help='seconds to run for, forever if omitted')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  emulator = bridgeEmulator(args.count, args.base, args.latency, args.jitter,
+                            args.loss, args.bus, echo_index=args.echo_index,
+                            auto_send=args.auto_send)
+  logging.info('Emulating %d MPPTs at 0x%03x on bus %d', args.count,
+               args.base, args.bus)
+  try:
+    emulator.run(duration=args.duration)
+  except KeyboardInterrupt:
+    pass
+  logging.info('Requests: %d Replies: %d Lost: %d Auto-sent: %d',
+               emulator.n_requests, emulator.n_replies, emulator.n_lost,
+               emulator.n_auto_sent)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+"""Copyright (c) 2014, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import logging
+import Queue
+import threading
+import time
+
+
+class busWorker():
+  '''Runs every blocking bus operation on a thread of its own.
+
+  Jobs are functions run one at a time in the order submitted, plus at
+  most one periodic job run every period seconds in between. Whatever a
+  job returns, or the exception it raised, is posted to a results queue
+  that the UI drains with results() from its own loop, so neither a slow
+  reply nor a reset ever holds up the UI. Only the worker thread may touch
+  the bus objects while it runs.
+  '''
+
+  def __init__(self):
+    self.jobs = Queue.Queue()
+    self.resultQueue = Queue.Queue()
+    # (name, function, period) or None
+    self.periodic = None
+    self.nextPeriodic = 0
+    # name of the job running, None when idle
+    self.busy = None
+    self.thread = threading.Thread(target=self.run, name='busWorker')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, name, fn, *args, **kwargs):
+    self.jobs.put((name, fn, args, kwargs))
+
+  def setPeriodic(self, name, fn, period):
+    # replaces the periodic job, fn None stops it
+    if fn is None:
+      self.periodic = None
+    else:
+      self.periodic = (name, fn, period)
+      self.nextPeriodic = time.time()
+    # wake the worker so the change takes effect straight away
+    self.jobs.put(None)
+
+  def results(self):
+    '''Returns the (name, result, error) of every job finished since the
+    last call, oldest first. error is the exception a job raised.'''
+    done = []
+    while True:
+      try:
+        done.append(self.resultQueue.get_nowait())
+      except Queue.Empty:
+        return done
+
+  def pending(self):
+    return self.jobs.qsize()
+
+  def close(self, timeout=None):
+    self.periodic = None
+    self.jobs.put(False)
+    self.thread.join(timeout)
+
+  def run(self):
+    while True:
+      periodic = self.periodic
+      if periodic is not None and time.time() >= self.nextPeriodic:
+        name, fn, period = periodic
+        # keep to the schedule rather than drift by the time the job takes
+        self.nextPeriodic = max(self.nextPeriodic + period, time.time())
+        self.call(name, fn, (), {})
+      if periodic is None:
+        timeout = None
+      else:
+        timeout = max(self.nextPeriodic - time.time(), 0)
+      try:
+        job = self.jobs.get(True, timeout)
+      except Queue.Empty:
+        continue
+      if job is False:
+        return
+      if job is not None:
+        self.call(*job)
+
+  def call(self, name, fn, args, kwargs):
+    self.busy = name
+    try:
+      result = fn(*args, **kwargs)
+    except Exception as e:
+      logging.exception('%s failed', name)
+      self.resultQueue.put((name, None, e))
+    else:
+      self.resultQueue.put((name, result, None))
+    finally:
+      self.busy = None
@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+
+import bridge_emulator
+import can_bus
+import can_client
+import can_ethernet
+import can_log
+import can_msg_pb2
+import can_replay
+import can_ring
+import latency
+import mppt
+
+# Microbenchmarks for the CAN ethernet stack, e.g.
+#   python can_bench.py decode --frames 8
+#   python can_bench.py ipc --count 100000
+#   python can_bench.py rtt --count 2000 [--trace]
+#   python can_bench.py fleet --count 16 --latency 0.002
+#   python can_bench.py buses --buses 2
+#   python can_bench.py client --count 16 --depth 16
+#   python can_bench.py states --frames 100000
+#   python can_bench.py replay [capture] [--trace]
+
+MAX_CHANNELS = 16
+
+
+def LegacyParsePacket(msg):
+  # The hex string round trip CanInterface.ParsePacket used to do per frame,
+  # kept here as the baseline.
+  pkt = can_msg_pb2.CanMessage()
+  pkt.timestamp = int(time.time() * 1000)
+  pkt.id = int(''.join('{:02x}'.format(x) for x in msg[0:4]), 16)
+  pkt.dlc = int('{:02x}'.format(msg[5]), 16)
+  pkt.type = can_ethernet.FlagsToType(msg[4])
+  data_str = ''.join('{:02x}'.format(x) for x in msg[6:14])
+  for i in xrange(pkt.dlc):
+    pkt.data.append(int(data_str[2 * i:2 * i + 2], 16))
+  return pkt
+
+
+def LegacyParsePackets(msg, idx):
+  pkts = []
+  while (idx + 14) <= len(msg):
+    pkts.append(LegacyParsePacket(msg[idx:idx + 14]))
+    idx += 14
+  return pkts
+
+
+def MakeDatagram(n_frames):
+  msg = bytearray(
+      can_ethernet.HEADER_SIZE + n_frames * can_ethernet.FRAME_SIZE)
+  struct.pack_into('>Q', msg, 0, 0x0054726974697560)
+  for i in xrange(n_frames):
+    data = [random.randint(0, 0xff) for _ in xrange(8)]
+    can_ethernet.FRAME.pack_into(
+        msg, can_ethernet.HEADER_SIZE + i * can_ethernet.FRAME_SIZE,
+        0x600 + (i % 16), 0, 8, str(bytearray(data)))
+  return msg
+
+
+def Rate(fn, n_frames, duration):
+  count = 0
+  start = time.time()
+  while time.time() - start < duration:
+    fn()
+    count += n_frames
+  return count / (time.time() - start)
+
+
+def BenchDecode(args):
+  msg = MakeDatagram(args.frames)
+  idx = can_ethernet.HEADER_SIZE
+
+  def Legacy():
+    LegacyParsePackets(msg, idx)
+
+  def Decode():
+    for frame in can_ethernet.DecodeFrames(msg, idx):
+      can_ethernet.FrameToPkt(frame)
+
+  def DecodeOnly():
+    can_ethernet.DecodeFrames(msg, idx)
+
+  print('%d frames per datagram' % args.frames)
+  before = Rate(Legacy, args.frames, args.duration)
+  print('  hex string parse   : %10.0f frames/s' % before)
+  after = Rate(Decode, args.frames, args.duration)
+  print('  struct + CanMessage: %10.0f frames/s (%.1fx)' % (
+      after, after / before))
+  raw = Rate(DecodeOnly, args.frames, args.duration)
+  print('  struct tuples only : %10.0f frames/s (%.1fx)' % (raw, raw / before))
+
+
+def ManagerProducer(q, frames):
+  # What CanInterface did before the shared memory rings
+  for frame in frames:
+    q.put(can_ethernet.FrameToPkt(frame).SerializeToString())
+
+
+def RingProducer(ring, frames):
+  batch = 8
+  for i in xrange(0, len(frames), batch):
+    chunk = frames[i:i + batch]
+    while ring.capacity - ring.Pending() < len(chunk):
+      # Only happens if the consumer falls a full ring behind
+      time.sleep(0.0001)
+    ring.PutMany(chunk)
+
+
+def BenchIpc(args):
+  msg = MakeDatagram(args.count)
+  frames = can_ethernet.DecodeFrames(msg, can_ethernet.HEADER_SIZE)
+
+  manager = multiprocessing.Manager()
+  q = manager.Queue(1000)
+  producer = multiprocessing.Process(target=ManagerProducer, args=(q, frames))
+  start = time.time()
+  producer.start()
+  for _ in xrange(args.count):
+    pkt = can_msg_pb2.CanMessage()
+    pkt.ParseFromString(q.get())
+  before = args.count / (time.time() - start)
+  producer.join()
+  manager.shutdown()
+  print('%d frames between processes' % args.count)
+  print('  Manager queue + protobuf: %10.0f frames/s' % before)
+
+  ring = can_ring.FrameRing()
+  producer = multiprocessing.Process(target=RingProducer, args=(ring, frames))
+  start = time.time()
+  producer.start()
+  received = 0
+  while received < args.count:
+    got = ring.GetAll()
+    if not got:
+      time.sleep(0.0001)
+    for frame in got:
+      can_ethernet.FrameToPkt(frame)
+    received += len(got)
+  after = args.count / (time.time() - start)
+  producer.join()
+  print('  shared memory ring      : %10.0f frames/s (%.1fx), %d overruns' % (
+      after, after / before, ring.Overruns()))
+
+
+def ProcessCpu(pid):
+  # CPU seconds used by another process, None where /proc is unavailable
+  try:
+    with open('/proc/%d/stat' % pid) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+  except IOError:
+    return None
+  return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def SelfCpu():
+  t = os.times()
+  return t[0] + t[1]
+
+
+def BenchRtt(args):
+  logging.disable(logging.INFO)
+  kill = multiprocessing.RawValue('b', False)
+  responder = multiprocessing.Process(target=bridge_emulator.RunEmulator,
+                                      args=(kill, 1))
+  responder.start()
+  time.sleep(0.2)
+
+  can = can_ethernet.canEthernet()
+  try:
+    can.Connect(500000)
+    can.EnableLatency(args.trace, None)
+    RunRtt(args, can)
+  finally:
+    can.Close()
+    kill.value = True
+    responder.join()
+
+
+def RunRtt(args, can):
+  iface_pid = can.iface.pid
+
+  tx = can_msg_pb2.CanMessage()
+  tx.id = 0x600
+  tx.type = can_msg_pb2.STD_RTR
+  tx.data.extend([0] * 8)
+
+  start = time.time()
+  cpu = SelfCpu()
+  iface_cpu = ProcessCpu(iface_pid)
+  for _ in xrange(args.count):
+    can.SendPkt(tx)
+    can.WaitForPacket(tx, 1)
+  elapsed = time.time() - start
+  cpu = SelfCpu() - cpu
+  print('%d RTR round trips on loopback' % args.count)
+  print('  latency          : %8.3f ms' % (elapsed / args.count * 1000))
+  print('  consumer CPU     : %8.3f ms per round trip' % (
+      cpu / args.count * 1000))
+  if iface_cpu is not None:
+    iface_cpu = ProcessCpu(iface_pid) - iface_cpu
+    print('  interface CPU    : %8.3f ms per round trip' % (
+        iface_cpu / args.count * 1000))
+  if args.trace:
+    PrintLatency(can.GetLatency())
+
+  # Idle: nothing on the bus, nobody waiting for long
+  cpu = SelfCpu()
+  iface_cpu = ProcessCpu(iface_pid)
+  start = time.time()
+  try:
+    can.WaitForPacket(can_msg_pb2.CanMessage(id=0x7ff), args.idle)
+  except can_ethernet.TimeoutError:
+    pass
+  elapsed = time.time() - start
+  print('  idle consumer CPU: %8.1f %%' % (
+      (SelfCpu() - cpu) / elapsed * 100))
+  if iface_cpu is not None:
+    print('  idle interface   : %8.1f %%' % (
+        (ProcessCpu(iface_pid) - iface_cpu) / elapsed * 100))
+
+
+def PrintLatency(summary):
+  print('  stage latency (ms)  %s' % ' '.join(
+      '%8s' % name for name in ['mean'] +
+      ['p%g' % p for p in latency.PERCENTILES] + ['max']))
+  for stage in latency.STAGES:
+    if stage not in summary or not summary[stage]['count']:
+      continue
+    s = summary[stage]
+    print('    %-17s %s' % (stage, ' '.join(
+        '%8.3f' % (s[key] * 1000) for key in ['mean'] +
+        ['p%g' % p for p in latency.PERCENTILES] + ['max'])))
+
+
+def BenchFleet(args):
+  logging.disable(logging.INFO)
+  kill = multiprocessing.RawValue('b', False)
+  emulator = multiprocessing.Process(
+      target=bridge_emulator.RunEmulator,
+      args=(kill, args.count, 0x600, args.latency, args.jitter, args.loss),
+      kwargs={'echo_index': args.echo_index})
+  emulator.start()
+  time.sleep(0.2)
+
+  can = can_ethernet.canEthernet()
+  try:
+    can.Connect(500000)
+    RunFleet(args, can)
+  finally:
+    can.Close()
+    kill.value = True
+    emulator.join()
+
+
+def RunFleet(args, can):
+  # Discovery and EEPROM read of every channel one at a time
+  start = time.time()
+  found = 0
+  for channel in xrange(MAX_CHANNELS):
+    try:
+      mppt.mppt(channel, 0x600, can)
+      found += 1
+    except mppt.MpptNotPresent:
+      pass
+  elapsed = time.time() - start
+  print('Discovered %d of %d emulated MPPTs (%.1f ms latency)' % (
+      found, args.count, args.latency * 1000))
+  print('  sequential discovery   : %8.3f s' % elapsed)
+
+  # The same in one sweep of the bus
+  report = mppt.discoverMPPTs(can, 0x600, range(MAX_CHANNELS))
+  print('  swept discovery        : %8.3f s (%d found)' % (
+      report.elapsed, len(report.trackers)))
+  if args.verbose:
+    print(report.summary())
+
+  # Status polling of the trackers found
+  tx = can_msg_pb2.CanMessage()
+  tx.type = can_msg_pb2.STD_RTR
+  tx.data.extend([0] * 8)
+  start = time.time()
+  for _ in xrange(args.polls):
+    for channel in xrange(found):
+      tx.id = 0x600 + channel
+      can.SendPkt(tx)
+      can.WaitForPacket(tx, 1)
+  elapsed = time.time() - start
+  print('  status poll of all     : %8.3f ms' % (
+      elapsed / args.polls * 1000))
+
+
+def BenchBuses(args):
+  logging.disable(logging.INFO)
+  kill = multiprocessing.RawValue('b', False)
+  emulators = []
+  for bus in xrange(args.buses):
+    emulator = multiprocessing.Process(
+        target=bridge_emulator.RunEmulator,
+        args=(kill, args.count, 0x600, args.latency),
+        kwargs={'bus_number': bus})
+    emulator.start()
+    emulators.append(emulator)
+  time.sleep(0.2)
+
+  manager = can_bus.busManager()
+  try:
+    manager.Connect(500000, range(args.buses))
+    RunBuses(args, manager)
+  finally:
+    manager.Close()
+    kill.value = True
+    for emulator in emulators:
+      emulator.join()
+
+
+def RunBuses(args, manager):
+  # Status RTR to every tracker on every bus at once, then wait for all the
+  # replies
+  tx = can_msg_pb2.CanMessage()
+  tx.type = can_msg_pb2.STD_RTR
+  tx.data.extend([0] * 8)
+  expected = args.buses * args.count
+  received = 0
+  start = time.time()
+  for _ in xrange(args.polls):
+    for bus in xrange(args.buses):
+      for channel in xrange(args.count):
+        tx.id = 0x600 + channel
+        manager.SendPkt(bus, tx)
+    got = 0
+    overtime = time.time() + 1
+    while got < expected and time.time() < overtime:
+      pkts = manager.GrabAll()
+      got += sum(1 for _, pkt in pkts if pkt.type == can_msg_pb2.STD)
+      if not pkts:
+        manager.WaitForRx(overtime - time.time())
+    received += got
+  elapsed = time.time() - start
+  print('%d buses of %d emulated MPPTs' % (args.buses, args.count))
+  print('  poll of every bus      : %8.3f ms' % (
+      elapsed / args.polls * 1000))
+  print('  replies                : %8.0f frames/s, %d of %d' % (
+      received / elapsed, received, expected * args.polls))
+  stats = manager.GetStats()
+  for bus in xrange(args.buses):
+    print('  bus %d                  : %8d rx %8d tx' % (
+        bus, stats[bus]['rx_frames'], stats[bus]['tx_frames']))
+
+
+def BenchClient(args):
+  logging.disable(logging.INFO)
+  kill = multiprocessing.RawValue('b', False)
+  emulator = multiprocessing.Process(
+      target=bridge_emulator.RunEmulator,
+      args=(kill, args.count, 0x600, args.latency, args.jitter, args.loss),
+      kwargs={'echo_index': args.echo_index})
+  emulator.start()
+  time.sleep(0.2)
+
+  can = can_ethernet.canEthernet()
+  client = can_client.canClient(can)
+  try:
+    can.Connect(500000)
+    client.Start()
+    RunClient(args, client)
+  finally:
+    client.Close()
+    can.Close()
+    kill.value = True
+    emulator.join()
+
+
+def RunClient(args, client):
+  # Detection and EEPROM read of every channel, all in flight at once
+  start = time.time()
+  futures = [mppt.requestMPPT(client, channel, 0x600)
+             for channel in xrange(MAX_CHANNELS)]
+  trackers = []
+  for future in futures:
+    try:
+      trackers.append(future.Result())
+    except can_ethernet.TimeoutError:
+      pass
+  print('Found %d of %d emulated MPPTs (%.1f ms latency)' % (
+      len(trackers), args.count, args.latency * 1000))
+  print('  concurrent discovery   : %8.3f s' % (time.time() - start))
+
+  # depth status polls of every tracker outstanding at a time
+  failed = 0
+  start = time.time()
+  for _ in xrange(args.polls):
+    futures = [tracker.requestStateData(client, 1, 1)
+               for tracker in trackers for _ in xrange(args.depth)]
+    for future in futures:
+      if future.Error() is not None:
+        failed += 1
+  elapsed = time.time() - start
+  n_requests = args.polls * args.depth * len(trackers)
+  print('  %4d requests in flight : %8.0f replies/s, %d failed' % (
+      args.depth * len(trackers), (n_requests - failed) / elapsed, failed))
+  print('  stats                  : %s' % client.GetStats())
+
+
+def LegacyParseState(pkt):
+  # mppt.parseStatePacket as it was, one byte at a time
+  return (float(pkt.data[1] * 0x100 + pkt.data[0]) / 100.0,
+          float(pkt.data[3] * 0x100 + pkt.data[2]) / 1000.0,
+          float(pkt.data[5] * 0x100 + pkt.data[4]) / 100.0,
+          float(pkt.data[7] * 0x100 + pkt.data[6]) / 100.0)
+
+
+def BenchStates(args):
+  frames = [(i, 0x600 + i % MAX_CHANNELS, can_msg_pb2.STD, 8,
+             struct.pack('<HHHH', random.randint(0, 12000),
+                         random.randint(0, 10000), random.randint(0, 30000),
+                         random.randint(0, 9000)))
+            for i in xrange(args.frames)]
+  pkts = [can_ethernet.FrameToPkt(frame) for frame in frames]
+  tracker = mppt.mppt(0, 0x600, None, detect=False, read=False)
+
+  start = time.time()
+  for pkt in pkts:
+    LegacyParseState(pkt)
+  legacy = time.time() - start
+
+  start = time.time()
+  for pkt in pkts:
+    tracker.canAddress = pkt.id
+    tracker.parseStatePacket(pkt)
+  wrapped = time.time() - start
+
+  start = time.time()
+  data = ''.join(frame[4] for frame in frames)
+  ids = [frame[1] for frame in frames]
+  states = mppt.decodeStates(data, ids)
+  batch = time.time() - start
+
+  assert abs(states['vin'][-1] - tracker.vin) < 1e-9
+  print('Decoded %d state frames' % args.frames)
+  for name, elapsed in (('per frame, bytewise', legacy),
+                        ('parseStatePacket', wrapped),
+                        ('decodeStates batch', batch)):
+    print('  %-20s: %8.3f us per frame' % (
+        name, elapsed / args.frames * 1e6))
+
+
+def MakeCapture(directory, n_frames):
+  # Synthetic capture of 16 trackers answering state RTRs every 50 ms
+  writer = can_log.CanLogWriter(directory)
+  msg = MakeDatagram(16)
+  for i in xrange(0, n_frames, 16):
+    writer.Write(can_ethernet.DecodeFrames(
+        msg, can_ethernet.HEADER_SIZE, timestamp=i / 16 * 50))
+  writer.Close()
+
+
+def BenchReplay(args):
+  logging.disable(logging.INFO)
+  tmp = None
+  capture = args.capture
+  if capture is None:
+    tmp = tempfile.mkdtemp()
+    capture = tmp
+    MakeCapture(capture, args.frames)
+  try:
+    can = can_replay.canReplay(capture, speed=args.speed)
+    can.Connect()
+    received = 0
+    start = time.time()
+    cpu = SelfCpu()
+    while not can.Finished():
+      can.GrabAllPackets()
+      for pkt_id in can.buffers.keys():
+        while can.GetPacketFromQueueDict(pkt_id) is not None:
+          received += 1
+    elapsed = time.time() - start
+    cpu = SelfCpu() - cpu
+    can.Close()
+    if args.trace:
+      can = can_replay.canReplay(capture, speed=args.speed)
+      can.Connect()
+      can.EnableLatency(True, None)
+      requests = RunTracedReplay(can)
+      can.Close()
+  finally:
+    if tmp is not None:
+      shutil.rmtree(tmp)
+  print('Replayed %d frames from %s' % (received, args.capture or 'synthetic'))
+  print('  %10.0f frames/s, %.2f us CPU per frame' % (
+      received / elapsed, cpu / max(received, 1) * 1e6))
+  if args.trace:
+    print('  %d traced requests, answered by the frames replayed' % requests)
+    PrintLatency(can.GetLatency())
+
+
+def RunTracedReplay(can):
+  # Asks for whatever id the replay delivers next, so every request is
+  # answered by a frame going through the traced receive path rather than
+  # one already buffered
+  tx = can_msg_pb2.CanMessage()
+  tx.type = can_msg_pb2.STD_RTR
+  requests = 0
+  while not can.Finished():
+    tx.id = can.next_frame[1]
+    can.buffers.pop(tx.id, None)
+    can.SendPkt(tx)
+    try:
+      can.WaitForPacket(tx, 1)
+    except can_ethernet.TimeoutError:
+      continue
+    requests += 1
+  return requests
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Microbenchmarks for the CAN ethernet stack')
+  sub = parser.add_subparsers()
+
+  decode = sub.add_parser('decode', help='datagram decode throughput')
+  decode.add_argument('--frames', type=int, default=8,
+                      help='frames per datagram')
+  decode.add_argument('--duration', type=float, default=2.0,
+                      help='seconds per measurement')
+  decode.set_defaults(func=BenchDecode)
+
+  ipc = sub.add_parser('ipc', help='interface to consumer frame transfer')
+  ipc.add_argument('--count', type=int, default=20000,
+                   help='frames to move between the processes')
+  ipc.set_defaults(func=BenchIpc)
+
+  rtt = sub.add_parser('rtt', help='CPU time per RTR round trip')
+  rtt.add_argument('--count', type=int, default=1000,
+                   help='round trips to time')
+  rtt.add_argument('--idle', type=float, default=2.0,
+                   help='seconds to measure idle CPU for')
+  rtt.add_argument('--trace', action='store_true',
+                   help='trace and print the latency of every stage')
+  rtt.set_defaults(func=BenchRtt)
+
+  fleet = sub.add_parser('fleet', help='discovery and polling of emulated '
+                         'MPPTs')
+  fleet.add_argument('--count', type=int, default=16,
+                     help='number of emulated MPPTs')
+  fleet.add_argument('--latency', type=float, default=0.002,
+                     help='emulated reply latency in seconds')
+  fleet.add_argument('--jitter', type=float, default=0.0,
+                     help='emulated reply jitter in seconds')
+  fleet.add_argument('--loss', type=float, default=0.0,
+                     help='emulated reply loss probability')
+  fleet.add_argument('--polls', type=int, default=20,
+                     help='status polls of the whole fleet to time')
+  fleet.add_argument('--no-echo', dest='echo_index', action='store_false',
+                     help='emulate firmware that does not echo the EEPROM '
+                     'index')
+  fleet.add_argument('--verbose', action='store_true',
+                     help='print the discovery report')
+  fleet.set_defaults(func=BenchFleet)
+
+  buses = sub.add_parser('buses', help='status polling across several '
+                         'emulated bridges')
+  buses.add_argument('--buses', type=int, default=2,
+                     help='number of emulated bridges')
+  buses.add_argument('--count', type=int, default=16,
+                     help='emulated MPPTs per bus')
+  buses.add_argument('--latency', type=float, default=0.002,
+                     help='emulated reply latency in seconds')
+  buses.add_argument('--polls', type=int, default=200,
+                     help='status polls of every bus to time')
+  buses.set_defaults(func=BenchBuses)
+
+  client = sub.add_parser('client', help='concurrent requests to emulated '
+                          'MPPTs through can_client')
+  client.add_argument('--count', type=int, default=16,
+                      help='number of emulated MPPTs')
+  client.add_argument('--latency', type=float, default=0.002,
+                      help='emulated reply latency in seconds')
+  client.add_argument('--jitter', type=float, default=0.0,
+                      help='emulated reply jitter in seconds')
+  client.add_argument('--loss', type=float, default=0.0,
+                      help='emulated reply loss probability')
+  client.add_argument('--depth', type=int, default=16,
+                      help='status requests outstanding per MPPT')
+  client.add_argument('--polls', type=int, default=20,
+                      help='rounds of status requests to time')
+  client.add_argument('--no-echo', dest='echo_index', action='store_false',
+                      help='emulate firmware that does not echo the EEPROM '
+                      'index')
+  client.set_defaults(func=BenchClient)
+
+  states = sub.add_parser('states', help='MPPT state frame decoding')
+  states.add_argument('--frames', type=int, default=100000,
+                      help='state frames to decode')
+  states.set_defaults(func=BenchStates)
+
+  replay = sub.add_parser('replay', help='receive stack throughput on a '
+                          'replayed capture')
+  replay.add_argument('capture', nargs='?',
+                      help='capture directory, segment or can_log.bin; '
+                      'a synthetic capture is used if omitted')
+  replay.add_argument('--frames', type=int, default=200000,
+                      help='size of the synthetic capture')
+  replay.add_argument('--speed', type=float, default=0,
+                      help='replay speed, 0 for as fast as possible')
+  replay.add_argument('--trace', action='store_true',
+                      help='also trace requests answered from the replay and '
+                      'print the latency of every stage')
+  replay.set_defaults(func=BenchReplay)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
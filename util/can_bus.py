@@ -0,0 +1,166 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import time
+
+import can_ethernet
+
+# Seconds to listen for bridge heartbeats when the buses are not given;
+# bridges heartbeat about once a second.
+FIND_TIME = 1.5
+
+
+def FindBridges(duration=FIND_TIME):
+  '''Listens for bridge heartbeats.
+
+  Returns:
+    Dict of bus number -> bridge IP address string.
+  '''
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  mreq = struct.pack('=4sl', socket.inet_aton(can_ethernet.MCAST_GRP),
+                     socket.INADDR_ANY)
+  sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+  sock.bind(('', can_ethernet.MCAST_PORT))
+  buf = bytearray(can_ethernet.BUFFER_SIZE)
+  bridges = {}
+  overtime = time.time() + duration
+  try:
+    while True:
+      remaining = overtime - time.time()
+      if remaining <= 0:
+        break
+      if not select.select([sock], [], [], remaining)[0]:
+        continue
+      n, addr = sock.recvfrom_into(buf)
+      if n < can_ethernet.HEADER_SIZE + can_ethernet.FRAME_SIZE:
+        continue
+      for frame in can_ethernet.DecodeFrames(buf, can_ethernet.HEADER_SIZE,
+                                             n):
+        if frame[2] == can_ethernet.can_msg_pb2.TRITIUM_HEARTBEAT:
+          bridges[buf[7] & 0x0F] = addr[0]
+  finally:
+    sock.close()
+  return bridges
+
+
+class busManager():
+  '''One canEthernet, and so one CanInterface process, per CAN bus.
+
+  Each bridge on the network tags its datagrams with its bus number. Every
+  worker only decodes the datagrams of its own bus, so the receive work is
+  spread over as many processes as there are bridges. Transmits go to the
+  worker of the bus they are meant for. All the workers share one rx
+  event, so a consumer can wait on every bus at once.
+  '''
+
+  def __init__(self, logger=None):
+    if logger:
+      self.logger = logger
+    else:
+      self.logger = logging
+    self.buses = {}
+
+  def Connect(self, bitrate, buses=None, log_dir=None,
+              **kwargs):
+    '''Starts a worker per bus.
+
+    Args:
+      bitrate: CAN bitrate set on every bridge.
+      buses: Bus numbers to connect to, the buses heard from within
+        FIND_TIME if None.
+      log_dir: Each bus logs to its own bus<n> directory under log_dir,
+        nothing is captured if None.
+      kwargs: Passed to canEthernet.Connect.
+    '''
+    self.Close()
+    if buses is None:
+      buses = sorted(FindBridges())
+      self.logger.info('Found bridges for buses %s', buses)
+    self.rx_event = multiprocessing.Event()
+    for bus in buses:
+      can = can_ethernet.canEthernet(self.logger, bus)
+      bus_log_dir = os.path.join(log_dir, 'bus%d' % bus) if log_dir else None
+      can.Connect(bitrate, log_dir=bus_log_dir, rx_event=self.rx_event,
+                  **kwargs)
+      self.buses[bus] = can
+
+  def Bus(self, bus):
+    '''Returns the canEthernet of a bus, for mppt, eeprom and the like.'''
+    return self.buses[bus]
+
+  def SendPkt(self, bus, pkt):
+    self.buses[bus].SendPkt(pkt)
+
+  def WaitForPacket(self, bus, match_pkt, timeout=1):
+    return self.buses[bus].WaitForPacket(match_pkt, timeout)
+
+  def GrabAll(self):
+    '''Pulls everything the workers have delivered.
+
+    Returns:
+      List of (bus, can_msg_pb2.CanMessage), in arrival order per bus.
+    '''
+    pkts = []
+    for bus, can in self.buses.iteritems():
+      for frame in can.rx_ring.GetAll():
+        pkts.append((bus, can_ethernet.FrameToPkt(frame)))
+    return pkts
+
+  def WaitForRx(self, timeout):
+    '''Blocks until any bus has frames waiting or timeout expires.'''
+    self.rx_event.clear()
+    for can in self.buses.itervalues():
+      if can.rx_ring.Pending():
+        return True
+    return self.rx_event.wait(timeout)
+
+  def GetStats(self):
+    '''Returns a dict of bus -> canEthernet.GetStats(), plus a 'total'
+    entry summing the counters over every bus.'''
+    stats = {}
+    total = {}
+    for bus, can in self.buses.iteritems():
+      stats[bus] = can.GetStats()
+      for key, value in stats[bus].iteritems():
+        if key not in ('bus', 'bridge_ip'):
+          total[key] = total.get(key, 0) + value
+    stats['total'] = total
+    return stats
+
+  def Close(self):
+    for can in self.buses.itervalues():
+      can.Close()
+    self.buses = {}
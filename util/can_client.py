@@ -0,0 +1,519 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import collections
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+import can_ethernet
+
+# Longest the pump thread sleeps without looking at its deadlines; new
+# requests wake it early, this only bounds a missed wakeup.
+POLL_TIME = 0.1
+
+# Defaults for Request()
+REQUEST_TIMEOUT = 1.0
+REQUEST_RETRIES = 1
+
+# Frames a frameStream buffers before dropping new ones
+STREAM_SIZE = 1024
+
+
+class CancelledError(Exception):
+  pass
+
+
+class canFuture():
+  '''Result of a request that may not have completed yet.
+
+  Completed by the client's pump thread, or by whoever calls SetResult,
+  SetException or Cancel first; later attempts are ignored. Callbacks run
+  in the thread that completes the future, usually the pump thread, so they
+  must not block.
+  '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.event = threading.Event()
+    self.result = None
+    self.exception = None
+    self.cancelled = False
+    self.callbacks = []
+    # set by canClient so Cancel() can withdraw the request
+    self.on_cancel = None
+
+  def Done(self):
+    return self.event.is_set()
+
+  def Cancelled(self):
+    return self.cancelled
+
+  def Result(self, timeout=None):
+    '''Waits for the future and returns its result.
+
+    Raises:
+      can_ethernet.TimeoutError if timeout expires first or the request
+      timed out, CancelledError if it was cancelled, or whatever exception
+      the request or a Then() function raised.
+    '''
+    if not self.event.wait(timeout):
+      raise can_ethernet.TimeoutError()
+    if self.cancelled:
+      raise CancelledError()
+    if self.exception is not None:
+      raise self.exception
+    return self.result
+
+  def Error(self, timeout=None):
+    # the exception the future failed with, None if it succeeded
+    self.event.wait(timeout)
+    return self.exception
+
+  def Complete(self, result=None, exception=None, cancelled=False):
+    with self.lock:
+      if self.event.is_set():
+        return False
+      self.result = result
+      self.exception = exception
+      self.cancelled = cancelled
+      self.event.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception:
+        logging.exception('canFuture callback failed')
+    return True
+
+  def SetResult(self, result):
+    return self.Complete(result)
+
+  def SetException(self, exception):
+    return self.Complete(exception=exception)
+
+  def Cancel(self):
+    '''Withdraws the request, returns False if it had already completed.'''
+    if not self.Complete(cancelled=True):
+      return False
+    if self.on_cancel is not None:
+      self.on_cancel(self)
+    return True
+
+  def AddDoneCallback(self, fn):
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(fn)
+        return
+    fn(self)
+
+  def Then(self, fn):
+    '''Returns a future of fn(result), failing the same way this one does.
+
+    If fn returns a canFuture, e.g. from a follow up request, the returned
+    future completes with it. Cancelling the returned future cancels
+    whichever of the two is outstanding.
+    '''
+    chained = canFuture()
+    chained.on_cancel = lambda _: self.Cancel()
+
+    def Chain(f):
+      if f.cancelled:
+        chained.Cancel()
+      elif f.exception is not None:
+        chained.SetException(f.exception)
+      else:
+        try:
+          result = fn(f.result)
+        except Exception as e:
+          chained.SetException(e)
+          return
+        if isinstance(result, canFuture):
+          chained.on_cancel = lambda _: result.Cancel()
+          result.AddDoneCallback(chained.Follow)
+        else:
+          chained.SetResult(result)
+    self.AddDoneCallback(Chain)
+    return chained
+
+  def Follow(self, f):
+    # completes this future the way f completed
+    self.Complete(f.result, f.exception, f.cancelled)
+
+
+def Resolved(result):
+  '''Returns a future that has already completed with result.'''
+  future = canFuture()
+  future.SetResult(result)
+  return future
+
+
+def Gather(futures):
+  '''Returns a future of the list of results of futures, in their order.
+
+  Fails with the first exception any of them fails with. Cancelling the
+  returned future cancels the ones still outstanding.
+  '''
+  futures = list(futures)
+  gathered = canFuture()
+  gathered.on_cancel = lambda _: [f.Cancel() for f in futures]
+  if not futures:
+    gathered.SetResult([])
+    return gathered
+  remaining = [len(futures)]
+  lock = threading.Lock()
+
+  def Collect(f):
+    if f.cancelled:
+      gathered.Cancel()
+      return
+    if f.exception is not None:
+      gathered.SetException(f.exception)
+      return
+    with lock:
+      remaining[0] -= 1
+      if remaining[0]:
+        return
+    gathered.SetResult([g.result for g in futures])
+  for f in futures:
+    f.AddDoneCallback(Collect)
+  return gathered
+
+
+class pendingRequest():
+
+  def __init__(self, client, tx, reply_id, match, timeout, retries,
+               exclusive):
+    self.tx = tx
+    self.reply_id = reply_id
+    self.match = match
+    self.timeout = timeout
+    self.retries = retries
+    self.exclusive = exclusive
+    self.attempts = 0
+    self.deadline = None
+    self.sent = None
+    self.future = canFuture()
+    self.future.request = self
+    self.future.on_cancel = client.Withdraw
+
+
+class frameStream():
+  '''Iterator over the frames received on a set of ids.
+
+  Frames arrive as can_msg_pb2.CanMessage. Iteration blocks until the next
+  frame arrives and stops once the stream is closed. Frames that arrive
+  while the buffer is full are dropped and counted.
+  '''
+
+  def __init__(self, client, ids, maxsize=STREAM_SIZE):
+    self.client = client
+    self.ids = ids
+    self.queue = Queue.Queue(maxsize)
+    self.closed = False
+    self.dropped = 0
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    pkt = self.Get()
+    if pkt is None:
+      raise StopIteration()
+    return pkt
+
+  def Get(self, timeout=None):
+    '''Returns the next frame, or None once the stream is closed.
+
+    Raises:
+      can_ethernet.TimeoutError if timeout expires first.
+    '''
+    if self.closed and self.queue.empty():
+      return None
+    try:
+      return self.queue.get(True, timeout)
+    except Queue.Empty:
+      raise can_ethernet.TimeoutError()
+
+  def Put(self, pkt):
+    try:
+      self.queue.put_nowait(pkt)
+    except Queue.Full:
+      self.dropped += 1
+
+  def Close(self):
+    if self.closed:
+      return
+    self.client.Unsubscribe(self)
+    self.closed = True
+    try:
+      # wake a reader blocked in Get()
+      self.queue.put_nowait(None)
+    except Queue.Full:
+      pass
+
+
+class canClient():
+  '''Request/response client that keeps many requests in flight at once.
+
+  A pump thread takes every frame the interface process receives and hands
+  it to the oldest pending request on that id whose match accepts it, and to
+  any frameStream subscribed to the id. Requests that go unanswered are sent
+  again, then fail with can_ethernet.TimeoutError.
+
+  Requests made exclusive are only sent once no other request is waiting
+  on the same reply id, for replies that cannot be told apart (e.g. EEPROM
+  reads from firmware that does not echo the index).
+
+  While the client is started it is the only reader of the canEthernet, so
+  WaitForPacket and the queue dict must not be used alongside it, and
+  frames sent from other threads go through Send(). Frames nobody asked for
+  are counted and dropped.
+
+  Example:
+    client = canClient(can)
+    client.Start()
+    futures = [client.Request(tx) for tx in requests]
+    replies = Gather(futures).Result(2)
+  '''
+
+  def __init__(self, can):
+    self.can = can
+    self.lock = threading.Lock()
+    # canEthernet.SendPkt feeds a single producer ring
+    self.tx_lock = threading.Lock()
+    # reply id -> pendingRequests sent and waiting for a reply, oldest first
+    self.pending = collections.defaultdict(list)
+    # reply id -> exclusive pendingRequests not sent yet
+    self.queued = collections.defaultdict(collections.deque)
+    # (deadline, seq, pendingRequest) of every request sent
+    self.deadlines = []
+    self.seq = itertools.count()
+    # id -> frameStreams
+    self.streams = collections.defaultdict(list)
+    self.thread = None
+    self.stop = False
+    self.n_requests = 0
+    self.n_replies = 0
+    self.n_resent = 0
+    self.n_timeouts = 0
+    self.n_unclaimed = 0
+
+  def Start(self):
+    if self.thread is not None:
+      return
+    self.can.GrabAllPackets()
+    self.stop = False
+    self.thread = threading.Thread(target=self.Pump, name='canClient')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Close(self):
+    '''Stops the pump thread, cancels every request and closes every
+    stream. The canEthernet is left connected.'''
+    if self.thread is None:
+      return
+    self.stop = True
+    self.can.rx_event.set()
+    self.thread.join()
+    self.thread = None
+    with self.lock:
+      requests = [r for rs in self.pending.values() for r in rs]
+      requests += [r for rs in self.queued.values() for r in rs]
+      streams = [s for ss in self.streams.values() for s in ss]
+    for r in requests:
+      r.future.Cancel()
+    for s in streams:
+      s.Close()
+
+  def Request(self, tx, match=None, timeout=REQUEST_TIMEOUT,
+              retries=REQUEST_RETRIES, reply_id=None, exclusive=False):
+    '''Sends tx and returns a canFuture of the reply.
+
+    Args:
+      tx: can_msg_pb2.CanMessage to send.
+      match: Function of a received CanMessage returning whether it is the
+        reply, by default any frame on reply_id is.
+      timeout: Seconds to wait for the reply per attempt.
+      retries: Number of times tx is sent before giving up.
+      reply_id: Id the reply comes back on, defaults to tx.id.
+      exclusive: Hold tx back until nothing else waits on reply_id.
+    Returns:
+      canFuture resolving to the reply CanMessage.
+    '''
+    if reply_id is None:
+      reply_id = tx.id
+    request = pendingRequest(self, tx, reply_id, match, timeout,
+                             max(retries, 1), exclusive)
+    with self.lock:
+      self.n_requests += 1
+      if exclusive and (self.pending[reply_id] or self.queued[reply_id]):
+        self.queued[reply_id].append(request)
+        return request.future
+      self.pending[reply_id].append(request)
+    self.Transmit(request)
+    return request.future
+
+  def Send(self, pkt):
+    '''Sends pkt without waiting for anything back.'''
+    with self.tx_lock:
+      self.can.SendPkt(pkt)
+
+  def Subscribe(self, ids, maxsize=STREAM_SIZE):
+    '''Returns a frameStream of the frames received on ids, which may be a
+    single id. Frames answering a request are not streamed.'''
+    if isinstance(ids, (int, long)):
+      ids = [ids]
+    stream = frameStream(self, list(ids), maxsize)
+    with self.lock:
+      for can_id in stream.ids:
+        self.streams[can_id].append(stream)
+    return stream
+
+  def Unsubscribe(self, stream):
+    with self.lock:
+      for can_id in stream.ids:
+        if stream in self.streams.get(can_id, []):
+          self.streams[can_id].remove(stream)
+          if not self.streams[can_id]:
+            del self.streams[can_id]
+
+  def Withdraw(self, future):
+    # on_cancel of a request's future
+    request = future.request
+    with self.lock:
+      if request in self.pending.get(request.reply_id, []):
+        self.pending[request.reply_id].remove(request)
+      elif request in self.queued.get(request.reply_id, []):
+        self.queued[request.reply_id].remove(request)
+    self.SendQueued(request.reply_id)
+
+  def Transmit(self, request):
+    request.attempts += 1
+    request.sent = time.time()
+    request.deadline = request.sent + request.timeout
+    with self.lock:
+      heapq.heappush(self.deadlines,
+                     (request.deadline, next(self.seq), request))
+    self.Send(request.tx)
+    # the pump may be asleep until a later deadline
+    self.can.rx_event.set()
+
+  def SendQueued(self, reply_id):
+    # sends the next exclusive request once nothing waits on reply_id
+    with self.lock:
+      if self.pending.get(reply_id) or not self.queued.get(reply_id):
+        return
+      request = self.queued[reply_id].popleft()
+      self.pending[reply_id].append(request)
+    self.Transmit(request)
+
+  def Pump(self):
+    can = self.can
+    while not self.stop:
+      # Clear before looking at the ring so a delivery that races with the
+      # check still leaves the event set for the wait below.
+      can.rx_event.clear()
+      if not can.rx_ring.Pending():
+        can.rx_event.wait(self.NextWait())
+      frames = can.rx_ring.GetAll()
+      if frames:
+        self.Dispatch(frames)
+      self.Expire()
+
+  def NextWait(self):
+    with self.lock:
+      if not self.deadlines:
+        return POLL_TIME
+      return min(max(self.deadlines[0][0] - time.time(), 0), POLL_TIME)
+
+  def Dispatch(self, frames):
+    done = []
+    with self.lock:
+      for frame in frames:
+        pkt = can_ethernet.FrameToPkt(frame)
+        for request in self.pending.get(pkt.id, ()):
+          if request.match is None or request.match(pkt):
+            self.pending[pkt.id].remove(request)
+            done.append((request, pkt))
+            break
+        else:
+          streams = self.streams.get(pkt.id)
+          if streams:
+            for stream in streams:
+              stream.Put(pkt)
+          else:
+            self.n_unclaimed += 1
+      self.n_replies += len(done)
+    # complete outside the lock, callbacks may make new requests
+    for request, pkt in done:
+      request.future.SetResult(pkt)
+      if request.exclusive:
+        self.SendQueued(request.reply_id)
+
+  def Expire(self):
+    now = time.time()
+    resend = []
+    failed = []
+    with self.lock:
+      while self.deadlines and self.deadlines[0][0] <= now:
+        deadline, _, request = heapq.heappop(self.deadlines)
+        if request.future.Done() or deadline != request.deadline:
+          # answered, cancelled or sent again since
+          continue
+        if request.attempts < request.retries:
+          resend.append(request)
+          continue
+        if request in self.pending.get(request.reply_id, []):
+          self.pending[request.reply_id].remove(request)
+        failed.append(request)
+      self.n_resent += len(resend)
+      self.n_timeouts += len(failed)
+    for request in resend:
+      self.Transmit(request)
+    for request in failed:
+      request.future.SetException(can_ethernet.TimeoutError(
+          'no reply to 0x%03x after %d attempts' % (request.tx.id,
+                                                    request.attempts)))
+      if request.exclusive:
+        self.SendQueued(request.reply_id)
+
+  def GetStats(self):
+    with self.lock:
+      return {'requests': self.n_requests,
+              'replies': self.n_replies,
+              'resent': self.n_resent,
+              'timeouts': self.n_timeouts,
+              'unclaimed': self.n_unclaimed,
+              'pending': sum(len(rs) for rs in self.pending.values()),
+              'queued': sum(len(rs) for rs in self.queued.values()),
+              'streams': sum(len(ss) for ss in self.streams.values())}
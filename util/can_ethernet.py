@@ -26,11 +26,15 @@ either expressed or implied, of Dilithium Power Systems LLC.
 
 """
 
+import binascii
+import collections
+import can_log
 import can_msg_pb2
-import copy
+import can_ring
+import latency
 import logging
 import multiprocessing
-import Queue
+import select
 import socket
 import struct
 import time
@@ -48,6 +52,42 @@ TIMEOUT = 2.0
 UDP_MODE = 1
 TCP_MODE = 2
 
+# Datagram layout: a 16 byte header (bus id, reserved, sender MAC) followed by
+# any number of 14 byte frames (identifier, flags, DLC, 8 data bytes).
+HEADER_SIZE = 16
+FRAME = struct.Struct('>IBB8s')
+FRAME_SIZE = FRAME.size
+BUS_ID = struct.Struct('>Q')
+MAC = struct.Struct('<IH')
+
+# Transmit batching: frames per datagram and how long to wait for a batch to
+# fill once the first frame is pending. Lingering delays every lone request,
+# so by default only frames already queued are batched.
+MAX_BATCH = (BUFFER_SIZE - HEADER_SIZE) // FRAME_SIZE
+LINGER = 0.0
+LINGER_POLL = 0.0001
+
+# The interface process blocks in select() until a datagram or a doorbell
+# arrives; the timeout only bounds how long a missed wakeup or a kill request
+# can go unnoticed.
+SELECT_TIMEOUT = 0.1
+DOORBELL_ADDR = '127.0.0.1'
+
+# Received frames are only kept for ids a request went out on, or that
+# someone waits on, in the last EXPECT_TIME seconds; anything else is
+# dropped. At most MAX_BUFFERED frames are kept per id, the oldest going
+# first, and buffers nobody expects frames on any more are swept away every
+# SWEEP_TIME seconds, so memory stays flat however long the tool runs.
+EXPECT_TIME = 5.0
+MAX_BUFFERED = 64
+SWEEP_TIME = 1.0
+
+# Flag bits
+FLAG_HEARTBEAT = 0x80
+FLAG_SETTINGS = 0x40
+FLAG_RTR = 0x02
+FLAG_EXTENDED = 0x01
+
 
 class PacketFormatError(Exception):
   pass
@@ -57,158 +97,352 @@ class TimeoutError(Exception):
   pass
 
 
+def FlagsToType(flags):
+  '''Maps a frame flags byte onto a can_msg_pb2.PktTypeEnum value.'''
+  if flags & FLAG_SETTINGS:
+    return can_msg_pb2.TRITIUM_SETTINGS
+  elif flags & FLAG_HEARTBEAT:
+    return can_msg_pb2.TRITIUM_HEARTBEAT
+  rtr_f = bool(flags & FLAG_RTR)
+  extended_f = bool(flags & FLAG_EXTENDED)
+  if rtr_f and extended_f:
+    return can_msg_pb2.EXT_RTR
+  elif rtr_f:
+    return can_msg_pb2.STD_RTR
+  elif extended_f:
+    return can_msg_pb2.EXT
+  return can_msg_pb2.STD
+
+# Precomputed so the receive path does a single tuple lookup per frame.
+FLAG_TYPES = tuple(FlagsToType(f) for f in xrange(256))
+
+
+def DecodeFrames(msg, idx=0, length=None, timestamp=None):
+  '''Decodes every complete frame of a datagram in one pass.
+
+  Args:
+    msg: bytearray, memoryview or str holding the datagram.
+    idx: Offset of the first frame.
+    length: Number of valid bytes in msg, defaults to len(msg).
+    timestamp: Receive time in ms applied to every frame, defaults to now.
+  Returns:
+    List of (timestamp, id, type, dlc, data) tuples, data being a str of
+    dlc bytes.
+  '''
+  if length is None:
+    length = len(msg)
+  if timestamp is None:
+    timestamp = int(time.time() * 1000)
+  unpack_from = FRAME.unpack_from
+  flag_types = FLAG_TYPES
+  frames = []
+  for offset in xrange(idx, length - FRAME_SIZE + 1, FRAME_SIZE):
+    can_id, flags, dlc, data = unpack_from(msg, offset)
+    if dlc > 8:
+      dlc = 8
+    frames.append((timestamp, can_id, flag_types[flags], dlc, data[:dlc]))
+  return frames
+
+
+def FrameToPkt(frame):
+  '''Builds a can_msg_pb2.CanMessage from a DecodeFrames tuple.'''
+  pkt = can_msg_pb2.CanMessage()
+  pkt.timestamp, pkt.id, pkt.type, pkt.dlc, data = frame
+  pkt.data.extend(bytearray(data))
+  return pkt
+
+
+def PktToFrame(pkt):
+  '''Flattens a can_msg_pb2.CanMessage into a DecodeFrames style tuple.'''
+  # Enforce DLC == length(data)
+  if pkt.dlc:
+    if pkt.dlc != len(pkt.data):
+      raise PacketFormatError('bad dlc\n%s' % unicode(pkt))
+  else:
+    pkt.dlc = len(pkt.data)
+  if pkt.dlc > 8:
+    raise PacketFormatError('bad dlc\n%s' % unicode(pkt))
+
+  # Check if the data section is good
+  try:
+    data = str(bytearray(pkt.data))
+  except ValueError:
+    raise PacketFormatError('bad data\n%s' % unicode(pkt))
+  return (pkt.timestamp, pkt.id, pkt.type, pkt.dlc, data)
+
+
+class pendingReply():
+  '''A packet someone waits for: the first received on pkt_id that match
+  accepts, packets received before since being stale.'''
+
+  def __init__(self, pkt_id, match=None, since=None):
+    self.pkt_id = pkt_id
+    self.match = match
+    self.since = None if since is None else int(since * 1000)
+    self.pkt = None
+    # while tracing, the time.time() the packet was read off the socket,
+    # dequeued from the rx ring and matched
+    self.received = None
+    self.dequeued = None
+    self.matched = None
+
+  def Stale(self, pkt):
+    return self.since is not None and pkt.timestamp < self.since
+
+  def Accepts(self, pkt):
+    return (not self.Stale(pkt) and
+            (self.match is None or self.match(pkt)))
+
+
 class CanInterface():
 
-  def __init__(self, tx_q, rx_q, kill):
-    self.tx_q = tx_q
-    self.rx_q = rx_q
+  def __init__(self, tx_ring, rx_ring, kill, rx_event=None,
+               doorbell_port=None, max_batch=MAX_BATCH, linger=LINGER,
+               log_dir=None, bus=None, bridge_ip=None,
+               send_counts=None):
+    self.tx_ring = tx_ring
+    self.rx_ring = rx_ring
     self.kill = kill
+    self.rx_event = rx_event
+    self.doorbell_port = doorbell_port
+    self.max_batch = max(1, min(max_batch, MAX_BATCH))
+    self.linger = linger
     self.n_pkts_rx = 0
     self.n_pkts_tx = 0
-    self.can_log = can_msg_pb2.CanLogMessage()
+    self.n_datagrams_tx = 0
+    if log_dir:
+      self.can_log = can_log.CanLogWriter(log_dir)
+    else:
+      self.can_log = None
     logging.basicConfig(level=logging.INFO)
-    self.bus_number = None
+    # With a bus given only that bus's datagrams are handled, otherwise the
+    # bus is learnt from the first header seen.
+    self.bus = bus
+    self.bus_number = bus
+    self.n_other_bus = 0
+    # Address of the bridge, shared with canEthernet as an int
+    self.bridge_ip = bridge_ip
+    self.bridge_addr = None
+    self.rx_buf = bytearray(BUFFER_SIZE)
+    # time from the tx ring to the socket, while the tx ring is stamped
+    if send_counts is not None:
+      self.send_latency = latency.latencyHistogram(counts=send_counts)
+    else:
+      self.send_latency = None
     self.Connect()
     self.udp_rx_sock.setblocking(0)
+    self.doorbell_sock.setblocking(0)
     self.run()
 
   def run(self):
+    socks = [self.udp_rx_sock, self.doorbell_sock]
     while not self.kill.value:
-      self.Receive()
-      if self.bus_number:
-        self.Send()
+      try:
+        readable = select.select(socks, [], [], SELECT_TIMEOUT)[0]
+      except select.error:
+        continue
+      if self.udp_rx_sock in readable:
+        if self.ReceiveAll() and self.rx_event is not None:
+          self.rx_event.set()
+      if self.doorbell_sock in readable:
+        self.DrainDoorbell()
+      if self.bus_number is not None:
+        while self.tx_ring.Pending():
+          self.Send()
+      if self.can_log is not None:
+        self.can_log.Poll()
     self.Close()
 
+  def ReceiveAll(self, limit=64):
+    '''Drains up to limit waiting datagrams, returns the frames received.'''
+    n_frames = 0
+    for _ in xrange(limit):
+      got = self.Receive()
+      if got is None:
+        break
+      n_frames += got
+    return n_frames
+
   def Receive(self):
+    '''Handles one datagram, returns its frame count or None if none waited.'''
     try:
-      rx, srv_sock = self.udp_rx_sock.recvfrom(BUFFER_SIZE)
-      msg = bytearray(rx)
-      [client_id, idx, mac] = self.ParsePacketHeader(msg)
-      if mac != self.mac:
-        self.ParsePackets(msg, idx)
+      n, srv_addr = self.udp_rx_sock.recvfrom_into(self.rx_buf)
+    except socket.error:
+      return None
+    if (self.bus is not None and n >= HEADER_SIZE and
+        self.rx_buf[7] & 0x0F != self.bus):
+      # Another bridge's traffic, its own worker handles it
+      self.n_other_bus += 1
+      return 0
+    try:
+      [client_id, idx, mac] = self.ParsePacketHeader(self.rx_buf, n)
+    except PacketFormatError:
+      return 0
+    if mac == self.mac:
+      return 0
+    if srv_addr[0] != self.bridge_addr:
+      self.SetBridge(srv_addr[0])
+    return self.ParsePackets(self.rx_buf, idx, n)
+
+  def SetBridge(self, addr):
+    self.bridge_addr = addr
+    logging.info('Bus %s bridge at %s', self.bus_number, addr)
+    if self.bridge_ip is not None:
+      self.bridge_ip.value = struct.unpack('>I', socket.inet_aton(addr))[0]
+
+  def DrainDoorbell(self):
+    try:
+      while True:
+        self.doorbell_sock.recv(64)
     except socket.error:
       pass
 
-  def ParsePackets(self, msg, idx):
-    while (idx + 14) <= len(msg):
-      rawpkt = msg[idx:idx + 14]
-      pkt = self.ParsePacket(rawpkt)
-      self.n_pkts_rx += 1
-      self.can_log.log.extend([pkt])
-      try:
-        self.rx_q.put(pkt.SerializeToString())
-        logging.debug('RECV:\n %s', unicode(pkt))
-      except:
-        logging.warning('DROPPED PACKET')
-      idx += 14
-
-  def ParsePacketHeader(self, msg):
-    if len(msg) == 30 or ((len(msg) - 30) % 14) == 0:
-      self.bus_id = msg[1:8]
-      self.bus_number = msg[7] & 0x0F
-      client_id = ''.join('{:02x}'.format(x) for x in msg[10:16])
-      mac = int(
-          ''.join('{:02x}'.format(x) for x in copy.copy(msg[10:16])[::-1]), 16)
-      idx = 16
-      logging.debug('rx client_id: %s', client_id)
-      logging.debug('rx mac:       %x', mac)
-      logging.debug('my mac:       %x', self.mac)
-    elif len(msg) % 14 == 0:
+  def ParsePackets(self, msg, idx, length=None):
+    frames = DecodeFrames(msg, idx, length)
+    self.n_pkts_rx += len(frames)
+    if self.can_log is not None:
+      self.can_log.Write(frames)
+    dropped = len(frames) - self.rx_ring.PutMany(frames)
+    if dropped:
+      logging.warning('DROPPED %d PACKETS', dropped)
+    return len(frames) - dropped
+
+  def ParsePacketHeader(self, msg, length=None):
+    if length is None:
+      length = len(msg)
+    client_id = None
+    mac = None
+    if length >= HEADER_SIZE and ((length - HEADER_SIZE) % FRAME_SIZE) == 0:
+      if self.bus is None:
+        self.bus_id = BUS_ID.unpack_from(msg, 0)[0]
+        self.bus_number = msg[7] & 0x0F
+      mac_lo, mac_hi = MAC.unpack_from(msg, 10)
+      mac = mac_lo | (mac_hi << 32)
+      client_id = binascii.hexlify(msg[10:16])
+      idx = HEADER_SIZE
+    elif length % FRAME_SIZE == 0:
       # Packets this length are likely valid
       idx = 0
     else:
-      dbg_msg = ''.join('{:02x}'.format(x) for x in msg)
-      logging.debug(dbg_msg)
-      logging.debug('msg len: %d', len(msg)) 
+      logging.debug('msg len: %d', length)
       raise PacketFormatError()
     return [client_id, idx, mac]
-  
+
   def ParsePacket(self, msg):
-    pkt = can_msg_pb2.CanMessage()
-    pkt.timestamp = int(time.time() * 1000)
-    pkt.id = int(''.join('{:02x}'.format(x) for x in msg[0:4]), 16)
-    pkt.dlc = int('{:02x}'.format(msg[5]), 16)
-
-    # Seperate the flags.
-    flags = msg[4]
-    heartbeat_f = bool((msg[4] & 0x80) >> 7)
-    settings_f = bool((msg[4] & 0x40) >> 6)
-    rtr_f = bool((msg[4] & 0x02) >> 1)
-    extended_f = bool(msg[4] & 0x01)
-   
-    if not (settings_f or heartbeat_f):
-      if not rtr_f and not extended_f:
-        pkt.type = can_msg_pb2.STD
-      elif not rtr_f and extended_f:
-        pkt.type = can_msg_pb2.EXT
-      elif rtr_f and not extended_f:
-        pkt.type = can_msg_pb2.STD_RTR
-      elif rtr_f and extended_f:
-        pkt.type = can_msg_pb2.EXT_RTR
-    elif settings_f:
-      pkt.type = can_msg_pb2.TRITIUM_SETTINGS
-    elif heartbeat_f:
-      pkt.type = can_msg_pb2.TRITIUM_HEARTBEAT
-
-    # Append the data
-    data_str = ''.join('{:02x}'.format(x) for x in msg[6:14])
-    for i in xrange(pkt.dlc):
-      pkt.data.append(int(data_str[2 * i:2 * i + 2], 16))
-    
-    if not heartbeat_f:
-      logging.debug('RECV:\n' + unicode(pkt))
+    pkt = FrameToPkt(DecodeFrames(msg, 0, FRAME_SIZE)[0])
+    if pkt.type != can_msg_pb2.TRITIUM_HEARTBEAT:
+      logging.debug('RECV:\n%s', pkt)
     else:
       logging.debug('TRITIUM_HEARTBEAT')
     return pkt
-  
+
   def Send(self):
-    # Try to deque a packet
-    try:
-      pkt = can_msg_pb2.CanMessage()
-      pkt.ParseFromString(self.tx_q.get_nowait())
-      logging.debug('Send Deenqueued')
-      self.SendPkt(pkt)
-    except Queue.Empty:
-      return
+    # Drain the tx ring into as few datagrams as possible
+    stamps = None
+    if self.send_latency is not None and self.tx_ring.stamping.value:
+      stamps = []
+    frames = self.DequeueBatch(stamps)
+    if frames:
+      logging.debug('Send Deenqueued %d', len(frames))
+      self.SendFrames(frames)
+      if stamps:
+        now = time.time()
+        for stamp in stamps:
+          if stamp:
+            self.send_latency.record(now - stamp)
+
+  def DequeueBatch(self, stamps=None):
+    '''Pulls up to max_batch frames off the tx ring.
+
+    Once the first frame is in hand, waits at most linger seconds for more
+    to show up before giving up on filling the batch. The publish times
+    of the frames are appended to stamps if given.
+    '''
+    frames = self.tx_ring.GetAll(self.max_batch, stamps)
+    if frames and self.linger > 0:
+      overtime = time.time() + self.linger
+      while len(frames) < self.max_batch and time.time() < overtime:
+        more = self.tx_ring.GetAll(self.max_batch - len(frames), stamps)
+        if more:
+          frames.extend(more)
+        else:
+          time.sleep(LINGER_POLL)
+    return frames
+
+  def EncodeFrame(self, frame, msg, offset):
+    '''Validates frame and packs it as a 14 byte frame into msg at offset.'''
+    timestamp, can_id, pkt_type, dlc, data = frame
 
-  def SendPkt(self, pkt):
     # Check if the type is ok and calculate the max id number
-    if pkt.type in [can_msg_pb2.STD, can_msg_pb2.STD_RTR,
+    if pkt_type in [can_msg_pb2.STD, can_msg_pb2.STD_RTR,
                     can_msg_pb2.TRITIUM_HEARTBEAT,
                     can_msg_pb2.TRITIUM_SETTINGS]:
       max_id = 2 ** 11
-    elif pkt.type in [can_msg_pb2.EXT, can_msg_pb2.EXT_RTR]:
+    elif pkt_type in [can_msg_pb2.EXT, can_msg_pb2.EXT_RTR]:
       max_id = 2 ** 29
     else:
-      raise Exception('unknown packet type')
+      raise PacketFormatError('unknown packet type')
 
     # Check if the identifier is in range
-    if not 0 <= pkt.id <= max_id:
-      raise Exception('bad id\n%s', unicode(pkt))
+    if not 0 <= can_id <= max_id:
+      raise PacketFormatError('bad id 0x%x' % can_id)
 
-    # Enforce DLC == length(data)
-    if pkt.dlc:
-      if pkt.dlc != len(pkt.data):
-        raise Exception('bad dlc\n%s', unicode(pkt))
-    else:
-      pkt.dlc = len(pkt.data)
+    # Form the flags byte
+    flags = 0
+    if pkt_type == can_msg_pb2.TRITIUM_HEARTBEAT:
+      flags |= FLAG_HEARTBEAT
+    if pkt_type == can_msg_pb2.TRITIUM_SETTINGS:
+      flags |= FLAG_SETTINGS
+    if pkt_type in [can_msg_pb2.STD_RTR, can_msg_pb2.EXT_RTR]:
+      flags |= FLAG_RTR
+    if pkt_type in [can_msg_pb2.EXT, can_msg_pb2.EXT_RTR]:
+      flags |= FLAG_EXTENDED
+
+    # Add the data if appropriate, RTR frames go out zero filled
+    if flags & FLAG_RTR:
+      data = ''
+    FRAME.pack_into(msg, offset, can_id, flags, dlc, data)
+
+  def SendFrames(self, frames):
+    '''Sends frames, packing as many per UDP datagram as fit.'''
+    if self.socket_mode != UDP_MODE:
+      for frame in frames:
+        self.SendFrame(frame)
+      return
+
+    # Magic number
+    client_id = 0x0054726974697560 | self.bus_number
+
+    msg = bytearray(HEADER_SIZE + len(frames) * FRAME_SIZE)
+    BUS_ID.pack_into(msg, 0, client_id)
+    MAC.pack_into(msg, 10, self.mac & 0xffffffff, self.mac >> 32)
+    offset = HEADER_SIZE
+    for frame in frames:
+      try:
+        self.EncodeFrame(frame, msg, offset)
+      except PacketFormatError as e:
+        logging.error('Dropping unsendable packet: %s', e)
+        continue
+      logging.debug('SEND: %s', frame)
+      offset += FRAME_SIZE
+    if offset == HEADER_SIZE:
+      return
+
+    # Send it
+    self.udp_tx_sock.sendto(msg[:offset], (MCAST_GRP, MCAST_PORT))
+    self.n_pkts_tx += (offset - HEADER_SIZE) // FRAME_SIZE
+    self.n_datagrams_tx += 1
 
-    # Check if the data section is good
-    if pkt.type in [can_msg_pb2.STD, can_msg_pb2.EXT]:
-      for i in xrange(pkt.dlc):
-        if not 0 <= pkt.data[i] <= 0xff:
-          raise Exception('bad data\n%s', unicode(pkt))
+  def SendFrame(self, frame):
+    if(self.socket_mode == UDP_MODE):
+      self.SendFrames([frame])
+      return
 
     # Magic number
     client_id = 0x0054726974697560 | self.bus_number
 
     # write the packet type
-    if(self.socket_mode == UDP_MODE):
-      msg = bytearray(30)
-      msgoffset = 16
-      struct.pack_into('>Q', msg, 0, client_id)
-      struct.pack_into('<Q', msg, 10, int(self.mac))
-    elif(self.socket_mode == TCP_MODE and self.first_msg == True):
+    if(self.socket_mode == TCP_MODE and self.first_msg == True):
       msg = bytearray(38)
       msgoffset = 38 - 14
       # Check if the forwarding range is ok
@@ -231,44 +465,11 @@ class CanInterface():
     else:
       raise Exception('Unrecognized socket mode')
 
-    # Add the identifier
-    struct.pack_into('>I', msg, msgoffset, pkt.id)
-
-    # Add the flags
-    heartbeat_f = pkt.type == can_msg_pb2.TRITIUM_HEARTBEAT
-    settings_f = pkt.type == can_msg_pb2.TRITIUM_SETTINGS
-    rtr_f = pkt.type in [can_msg_pb2.STD_RTR, can_msg_pb2.EXT_RTR]
-    extended_f = pkt.type in [can_msg_pb2.EXT, can_msg_pb2.EXT_RTR]
-
-    # Form the flags byte
-    E = extended_f
-    R = rtr_f << 1
-    S = settings_f << 6
-    H = heartbeat_f << 7
-    flags = E | R | S | H
-
-    struct.pack_into('>B', msg, 4 + msgoffset, flags)
-
-    # Add the data length code
-    struct.pack_into('>B', msg, 5 + msgoffset, pkt.dlc)
-
-    # Add the data if appropriate
-    if pkt.type in [can_msg_pb2.STD, can_msg_pb2.EXT,
-                    can_msg_pb2.TRITIUM_SETTINGS,
-                    can_msg_pb2.TRITIUM_HEARTBEAT]:
-        for i in xrange(pkt.dlc):
-            struct.pack_into('>B', msg, 6 + i + msgoffset, pkt.data[i])
+    self.EncodeFrame(frame, msg, msgoffset)
 
     # Send it
-    logging.debug('SEND:\n' + unicode(pkt))
-    if(self.socket_mode == UDP_MODE):
-      self.udp_tx_sock.sendto(msg, (MCAST_GRP, MCAST_PORT))
-      dbg_msg = 'UDP :' + ''.join('{:02x}'.format(x) for x in msg)
-      logging.debug(dbg_msg)
-    elif(self.socket_mode == TCP_MODE):
-      self.tcp_sock.send(msg)
-      dbg_msg = 'TCP :' + ''.join('{:02x}'.format(x) for x in msg)
-      logging.debug(dbg_msg)
+    logging.debug('SEND: %s', frame)
+    self.tcp_sock.send(msg)
     self.n_pkts_tx += 1
 
   def Connect(self):
@@ -293,6 +494,13 @@ class CanInterface():
     # Set up UDP transmitter.
     self.udp_tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.udp_tx_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+
+    # Loopback socket canEthernet pokes when it queues frames for us, so the
+    # select() in run() wakes for transmits as well as receives.
+    self.doorbell_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.doorbell_sock.bind((DOORBELL_ADDR, 0))
+    if self.doorbell_port is not None:
+      self.doorbell_port.value = self.doorbell_sock.getsockname()[1]
   
     # Get the MAC address of the local adapter.
     msg = bytearray(8)
@@ -304,18 +512,23 @@ class CanInterface():
     logging.info('Closing Sockets')
     self.udp_tx_sock.close()
     self.udp_rx_sock.close()
-    logging.info('Writing Log')
-    f = open('can_log.bin', 'w')
-    f.write(self.can_log.SerializeToString())
-    f.close()
+    self.doorbell_sock.close()
+    if self.can_log is not None:
+      logging.info('Flushing Log')
+      self.can_log.Close()
     logging.info('Packets Received: %d', self.n_pkts_rx)
-    logging.info('Packets Sent: %d', self.n_pkts_tx)
+    logging.info('Packets Sent: %d in %d datagrams', self.n_pkts_tx,
+                 self.n_datagrams_tx)
+    if self.n_other_bus:
+      logging.info('Datagrams for other buses: %d', self.n_other_bus)
 
 class canEthernet():
 
-  def __init__(self, logger=None):
+  def __init__(self, logger=None, bus=None):
 
     self.bridgeIP = 0
+    # bus number to talk to, None for whichever bridge is heard first
+    self.bus = bus
 
     # initialize variables
     self.txPackets = 0
@@ -326,11 +539,30 @@ class canEthernet():
     self.fwd_range = 0
     self.first_msg = True
 
-    # initialize packet queue dict
-    self.pkt_queue_dict = dict()
-
-    # the queue dict allows grabbing packets in the order they were received,
-    # indexed by their id
+    # the queue dict lets packets be grabbed in the order they were
+    # received, indexed by their id: id -> deque of the packets nobody has
+    # claimed yet, and id -> time until which packets on it are kept
+    self.buffers = dict()
+    self.expected = dict()
+    self.expect_all = False
+    # id -> pendingReplys registered by WaitForPacket, oldest first
+    self.pending = dict()
+    self.next_sweep = 0
+    self.n_unsolicited = 0
+    self.n_evicted = 0
+
+    # latency tracing, off by default; id -> time.time() the last request
+    # on it was enqueued. The interface process records the send stage on
+    # send_counts, the same counts for every interface Connect() starts, so
+    # the histograms outlive a reconnect
+    self.tracing = False
+    self.send_counts = multiprocessing.RawArray(
+        'L', latency.latencyHistogram.size())
+    self.latency = latency.latencyTracer(
+        latency.latencyHistogram(counts=self.send_counts))
+    self.sentAt = dict()
+    self.report_time = latency.REPORT_TIME
+    self.next_report = None
 
     if logger:
       self.logger = logger
@@ -338,17 +570,31 @@ class canEthernet():
       self.logger = logging
 
 
-  def Connect(self, bitrate):
-    # New Threaded Can Interface
+  def Connect(self, bitrate, max_batch=MAX_BATCH, linger=LINGER,
+              ring_capacity=can_ring.RING_CAPACITY, log_dir=None,
+              rx_event=None):
+    # New Threaded Can Interface, capturing every frame received under
+    # log_dir if given
     self.Cleanup()
-    self.manager = multiprocessing.Manager()
-    self.kill = self.manager.Value('b', False)
-    self.tx_q = self.manager.Queue(1000)
-    self.rx_q = self.manager.Queue(1000)
+    self.kill = multiprocessing.RawValue('b', False)
+    self.tx_ring = can_ring.FrameRing(ring_capacity)
+    self.rx_ring = can_ring.FrameRing(ring_capacity)
+    # rx_event may be shared with other connections, see can_bus
+    if rx_event is None:
+      rx_event = multiprocessing.Event()
+    self.rx_event = rx_event
+    self.doorbell_port = multiprocessing.RawValue('i', 0)
+    self.bridge_ip = multiprocessing.RawValue('I', 0)
+    self.tx_ring.Stamp(self.tracing)
+    self.rx_ring.Stamp(self.tracing)
+    self.doorbell_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.iface = multiprocessing.Process(target=CanInterface,
-        args=(self.tx_q, self.rx_q, self.kill))
+        args=(self.tx_ring, self.rx_ring, self.kill, self.rx_event,
+              self.doorbell_port, max_batch, linger, log_dir, self.bus,
+              self.bridge_ip, self.send_counts))
     self.iface.start()
     self.SetBitrate(bitrate)
+    self.bridgeIP = self.bridge_ip.value
 
   def SetBitrate(self, bitrate):
     
@@ -365,7 +611,7 @@ class canEthernet():
     pkt.data.extend([0x85, upper_byte, lower_byte])
 
     #Enqueue the packet
-    self.tx_q.put(pkt.SerializeToString())
+    self.SendPkt(pkt)
 
     # Wait for a return heartbeat packet
     match_pkt = can_msg_pb2.CanMessage()
@@ -376,18 +622,18 @@ class canEthernet():
  
   def FlushQueueType(self, match_pkt):
     self.GrabAllPackets()
-    while True:
-      if self.GetPacketFromQueueDict(match_pkt.id) is None:
-        return
-      else:
-        self.GrabAllPackets()
+    self.buffers.pop(match_pkt.id, None)
 
-  def WaitForPacket(self, match_pkt, timeout=1):
+  def WaitForPacket(self, match_pkt, timeout=1, match=None, since=None):
     ''' Waits for a specified packet to come across the bus.
 
     Args:
       pkt: Type can_msg_pb2.CanMessage. Will try to match the id and type.
       timeout: How long to wait for the packet.
+      match: Function of a received CanMessage returning whether it is the
+        packet wanted, by default any packet on the id is.
+      since: time.time() the request was sent, packets received before it
+        are stale replies to an earlier request and are dropped.
     Returns:
       pkt: Type can_msg_pb2.CanMessage.
     Raises:
@@ -395,69 +641,234 @@ class canEthernet():
     '''
 
     overtime = time.time() + timeout
-    while True:
-      pkt = self.GetPacketFromQueueDict(match_pkt.id)
-      if pkt:
-        return pkt
-      else:
-        self.GrabAllPackets()
-      if time.time() > overtime:
+    self.Expect(match_pkt.id, timeout)
+    reply = self.Register(match_pkt.id, match, since)
+    while reply.pkt is None:
+      remaining = overtime - time.time()
+      if remaining <= 0:
+        self.Unregister(reply)
         raise TimeoutError()
+      self.WaitForRx(remaining)
+    if self.tracing:
+      self.TraceReply(reply, since)
+    return reply.pkt
+
+  def WaitForRx(self, timeout):
+    '''Blocks until the interface process delivers frames or timeout expires,
+    then pulls whatever arrived into the queue dict.'''
+    # Clear before looking at the ring so a delivery that races with the
+    # check still leaves the event set for the wait below.
+    self.rx_event.clear()
+    if not self.rx_ring.Pending():
+      self.rx_event.wait(timeout)
+    self.GrabAllPackets()
 
-  def AddPacketToQueueDict(self, pkt):
-    if pkt.id in self.pkt_queue_dict.keys():
-      self.pkt_queue_dict[pkt.id].put(pkt)
-      logging.debug('Recv Added to Queue Dict')
+  def EnableLatency(self, on=True, report_time=latency.REPORT_TIME):
+    '''Turns latency tracing of requests answered through WaitForPacket on
+    or off, see latency.STAGES. While on, a summary is logged every
+    report_time seconds, never if report_time is None.'''
+    self.tracing = on
+    self.sentAt = dict()
+    self.report_time = report_time
+    if on and report_time:
+      self.next_report = time.time() + report_time
     else:
-      # The queue doesnt exist
-      self.pkt_queue_dict[pkt.id] = Queue.Queue()
-      # Recursive call
-      self.AddPacketToQueueDict(pkt)
+      self.next_report = None
+    if hasattr(self, 'rx_ring'):
+      self.tx_ring.Stamp(on)
+      self.rx_ring.Stamp(on)
+
+  def GetLatency(self, pkt_id=None):
+    '''Returns stage -> latency summary, for the replies on pkt_id if
+    given. Times are in seconds.'''
+    return self.latency.summary(pkt_id)
+
+  def TraceReply(self, reply, since):
+    # records the stages of a reply WaitForPacket is returning, from since
+    # or the time the last request on its id was enqueued
+    now = time.time()
+    pkt_id = reply.pkt_id
+    sent = self.sentAt.pop(pkt_id, None)
+    if since is not None:
+      sent = since
+    record = self.latency.record
+    # a reply taken from the buffers was not seen through the stages
+    if reply.received is not None:
+      if sent is not None:
+        record('bus', pkt_id, reply.received - sent)
+      record('ipc', pkt_id, reply.dequeued - reply.received)
+      record('parse', pkt_id, reply.matched - reply.dequeued)
+      record('wake', pkt_id, now - reply.matched)
+    if sent is not None:
+      record('total', pkt_id, now - sent)
+
+  def Expect(self, pkt_id, duration=EXPECT_TIME):
+    '''Keeps packets received on pkt_id for the next duration seconds.'''
+    until = time.time() + max(duration, EXPECT_TIME)
+    if self.expected.get(pkt_id, 0) < until:
+      self.expected[pkt_id] = until
+
+  def Register(self, pkt_id, match=None, since=None):
+    '''Returns a pendingReply for the first packet on pkt_id that match
+    accepts, already complete if one is buffered.'''
+    reply = pendingReply(pkt_id, match, since)
+    buf = self.buffers.get(pkt_id)
+    if buf:
+      for pkt in list(buf):
+        if reply.Stale(pkt):
+          buf.remove(pkt)
+        elif reply.Accepts(pkt):
+          buf.remove(pkt)
+          reply.pkt = pkt
+          return reply
+    self.pending.setdefault(pkt_id, []).append(reply)
+    return reply
+
+  def Unregister(self, reply):
+    replies = self.pending.get(reply.pkt_id)
+    if replies and reply in replies:
+      replies.remove(reply)
+      if not replies:
+        del self.pending[reply.pkt_id]
+
+  def AddPacketToQueueDict(self, pkt):
+    # a registered reply takes the packet first, returns the reply if one
+    # did
+    replies = self.pending.get(pkt.id)
+    if replies:
+      for reply in replies:
+        if reply.Accepts(pkt):
+          reply.pkt = pkt
+          self.Unregister(reply)
+          return reply
+    if not self.expect_all and pkt.id not in self.expected:
+      self.n_unsolicited += 1
+      return
+    buf = self.buffers.get(pkt.id)
+    if buf is None:
+      buf = self.buffers[pkt.id] = collections.deque(maxlen=MAX_BUFFERED)
+    elif len(buf) == MAX_BUFFERED:
+      self.n_evicted += 1
+    buf.append(pkt)
+    logging.debug('Recv Added to Queue Dict')
 
   def GetPacketFromQueueDict(self, pkt_id):
-    if pkt_id in self.pkt_queue_dict.keys():
-      try:
-        pkt = self.pkt_queue_dict[pkt_id].get_nowait()
-        logging.debug('Recv Pulled from Queue Dict')
-        return pkt
-      except Queue.Empty:
-        pass  
+    buf = self.buffers.get(pkt_id)
+    if buf:
+      logging.debug('Recv Pulled from Queue Dict')
+      return buf.popleft()
     return None
 
+  def Sweep(self):
+    '''Drops the buffers of ids nobody expects packets on any more.'''
+    now = time.time()
+    self.next_sweep = now + SWEEP_TIME
+    for pkt_id, until in self.expected.items():
+      if until < now and pkt_id not in self.pending:
+        del self.expected[pkt_id]
+        self.buffers.pop(pkt_id, None)
+    if self.expect_all:
+      for pkt_id in [i for i, buf in self.buffers.iteritems() if not buf]:
+        del self.buffers[pkt_id]
+
   def GrabAllPackets(self, timeout=1):
     '''Pull all of the outstanding packets from the rx queue and push to dict'''
     overtime = time.time() + timeout
     while True:
-      try:
-        # pull the next packet
-        pkt_str = self.rx_q.get_nowait()
-        pkt = can_msg_pb2.CanMessage()
-        pkt.ParseFromString(pkt_str)
-        logging.debug('Recv Deenqueued')
-
-        # push to queue dict structure
-        self.AddPacketToQueueDict(pkt)
-      except Queue.Empty:
+      # pull the outstanding packets
+      if self.tracing:
+        stamps = []
+        frames = self.rx_ring.GetAll(None, stamps)
+      else:
+        frames = self.rx_ring.GetAll()
+      if not frames:
         break
+      logging.debug('Recv Deenqueued %d', len(frames))
+
+      # push to queue dict structure
+      if self.tracing:
+        self.TracePackets(frames, stamps)
+      else:
+        for frame in frames:
+          self.AddPacketToQueueDict(FrameToPkt(frame))
       if time.time() > overtime:
         raise TimeoutError()
-
-  def SendPkt(self, pkt):
-    self.tx_q.put(pkt.SerializeToString())
+    if time.time() >= self.next_sweep:
+      self.Sweep()
+      if self.next_report is not None and time.time() >= self.next_report:
+        self.next_report = time.time() + self.report_time
+        self.latency.report(self.logger)
+
+  def TracePackets(self, frames, stamps):
+    # as GrabAllPackets does, noting when the replies it completes were
+    # read off the socket, dequeued and matched
+    dequeued = time.time()
+    for frame, received in zip(frames, stamps):
+      reply = self.AddPacketToQueueDict(FrameToPkt(frame))
+      if reply is not None and received:
+        reply.received = received
+        reply.dequeued = dequeued
+        reply.matched = time.time()
+
+  def SendPkt(self, pkt, timeout=TIMEOUT):
+    frame = PktToFrame(pkt)
+    # replies come back on the id the request went out on
+    self.Expect(pkt.id)
+    if self.tracing:
+      self.sentAt[pkt.id] = time.time()
+    overtime = time.time() + timeout
+    while (self.tx_ring.Pending() >= self.tx_ring.capacity and
+           time.time() < overtime):
+      # The interface process is behind, give it a moment to drain
+      time.sleep(LINGER_POLL)
+    if not self.tx_ring.Put(frame):
+      logging.warning('DROPPED PACKET')
+      return
     logging.debug('Send Enqueued')
 
+    # The interface process may be asleep only if the ring was empty
+    if self.tx_ring.Pending() == 1:
+      self.RingDoorbell()
+
+  def RingDoorbell(self):
+    port = self.doorbell_port.value
+    if port:
+      try:
+        self.doorbell_sock.sendto('\0', (DOORBELL_ADDR, port))
+      except socket.error:
+        pass
+
+  def GetStats(self):
+    '''Returns frame and overrun counters for both rings.'''
+    return {'bus': self.bus,
+            'bridge_ip': self.bridge_ip.value,
+            'rx_frames': self.rx_ring.Total(),
+            'rx_overruns': self.rx_ring.Overruns(),
+            'rx_pending': self.rx_ring.Pending(),
+            'tx_frames': self.tx_ring.Total(),
+            'tx_overruns': self.tx_ring.Overruns(),
+            'tx_pending': self.tx_ring.Pending(),
+            'buffered': sum(len(buf) for buf in self.buffers.itervalues()),
+            'unsolicited': self.n_unsolicited,
+            'evicted': self.n_evicted}
+
   def Cleanup(self):
     # Housecleaning before Connnect or during Close
     if hasattr(self, 'kill'):
       self.kill.value = True
-    if hasattr(self, 'tx_q'):
+    if hasattr(self, 'doorbell_sock'):
+      self.RingDoorbell()
+    if hasattr(self, 'rx_ring'):
       self.GrabAllPackets()
-      del self.tx_q
-    if hasattr(self, 'tx_q'):
-      del self.rx_q
+      del self.rx_ring
+    if hasattr(self, 'tx_ring'):
+      del self.tx_ring
     if hasattr(self, 'iface'):
       self.iface.join()
       self.iface.terminate()
+    if hasattr(self, 'doorbell_sock'):
+      self.doorbell_sock.close()
+      del self.doorbell_sock
 
   def Close(self):
     self.logger.info('Closing Sockets')
@@ -0,0 +1,290 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import glob
+import logging
+import os
+import Queue
+import struct
+import threading
+import time
+
+import can_msg_pb2
+
+# Segment files start with a magic string, followed by length-delimited
+# records: a 2 byte little endian length, then a can_ring.RECORD style body
+# (timestamp ms, id, type, dlc, 8 data bytes).
+MAGIC = 'DPSCANL1'
+LENGTH = struct.Struct('<H')
+BODY = struct.Struct('<qIBB8s')
+RECORD = struct.Struct('<HqIBB8s')
+RECORD_SIZE = RECORD.size
+
+LOG_DIR = 'can_log'
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.canlog'
+# Sidecar written by can_log_index, removed together with its segment
+INDEX_SUFFIX = '.idx.npz'
+SEGMENT_SIZE = 16 * 1024 * 1024
+RETENTION = 64
+FSYNC_INTERVAL = 1.0
+QUEUE_DEPTH = 1024
+HANDOFF_FRAMES = 256
+HANDOFF_INTERVAL = 0.05
+READ_SIZE = 64 * 1024
+# Seconds Close() waits for the writer thread at each step
+CLOSE_TIMEOUT = 5.0
+
+
+def SegmentPaths(directory):
+  '''Returns the segment files in directory, oldest first.'''
+  return sorted(glob.glob(os.path.join(
+      directory, SEGMENT_PREFIX + '*' + SEGMENT_SUFFIX)))
+
+
+class CanLogWriter():
+  '''Streams frames to rotating segment files from a background thread.
+
+  Write() only collects frames; they are handed to the writer thread in
+  batches of HANDOFF_FRAMES, or by Poll() once HANDOFF_INTERVAL has passed,
+  so the interface process never blocks on the disk and does not pay a
+  thread wakeup per datagram. If the thread falls QUEUE_DEPTH batches
+  behind, further frames are dropped and counted rather than buffered
+  without bound. Segments are fsynced at most every
+  fsync_interval seconds and whenever one is closed; once more than
+  retention segments exist the oldest are deleted.
+  '''
+
+  def __init__(self, directory=LOG_DIR, segment_size=SEGMENT_SIZE,
+               retention=RETENTION, fsync_interval=FSYNC_INTERVAL):
+    self.directory = directory
+    self.segment_size = segment_size
+    self.retention = retention
+    self.fsync_interval = fsync_interval
+    self.n_frames = 0
+    self.n_dropped = 0
+    self.pending = []
+    self.pending_since = None
+    self.f = None
+    self.segment_bytes = 0
+    self.unsynced = False
+    self.last_sync = time.time()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.q = Queue.Queue(QUEUE_DEPTH)
+    self.thread = threading.Thread(target=self.run, name='CanLogWriter')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Write(self, frames):
+    '''Collects a list of frames for the writer thread.'''
+    if not frames:
+      return
+    if self.pending_since is None:
+      self.pending_since = time.time()
+    self.pending.extend(frames)
+    if len(self.pending) >= HANDOFF_FRAMES:
+      self.Handoff()
+
+  def Poll(self):
+    '''Hands over collected frames that have waited HANDOFF_INTERVAL.'''
+    if (self.pending_since is not None and
+        time.time() - self.pending_since >= HANDOFF_INTERVAL):
+      self.Handoff()
+
+  def Handoff(self):
+    if self.pending:
+      try:
+        self.q.put_nowait(self.pending)
+      except Queue.Full:
+        self.n_dropped += len(self.pending)
+    self.pending = []
+    self.pending_since = None
+
+  def Close(self, timeout=CLOSE_TIMEOUT):
+    '''Flushes everything written so far and stops the writer thread,
+    giving up after timeout seconds rather than hang on a thread that has
+    died or stalled.'''
+    self.Handoff()
+    if self.thread.is_alive():
+      try:
+        self.q.put(None, True, timeout)
+      except Queue.Full:
+        pass
+      else:
+        self.thread.join(timeout)
+    if self.thread.is_alive():
+      logging.error('CAN log writer did not stop, the capture may be '
+                    'incomplete')
+    elif self.f is not None:
+      logging.error('CAN log writer died, the capture may be incomplete')
+    if self.n_dropped:
+      logging.warning('CAN log dropped %d frames', self.n_dropped)
+
+  def run(self):
+    while True:
+      if self.unsynced:
+        # Only poll while there is something left to fsync
+        timeout = self.last_sync + self.fsync_interval - time.time()
+        try:
+          frames = self.q.get(True, max(timeout, 0))
+        except Queue.Empty:
+          self.Sync()
+          continue
+      else:
+        frames = self.q.get()
+      if frames is None:
+        break
+      self.WriteFrames(frames)
+      if self.q.empty():
+        # Hand the data to the OS so it survives the process dying
+        self.f.flush()
+      if time.time() - self.last_sync >= self.fsync_interval:
+        self.Sync()
+    self.CloseSegment()
+
+  def WriteFrames(self, frames):
+    buf = bytearray(len(frames) * RECORD_SIZE)
+    pack_into = RECORD.pack_into
+    length = BODY.size
+    offset = 0
+    for frame in frames:
+      pack_into(buf, offset, length, *frame)
+      offset += RECORD_SIZE
+    if self.f is None or self.segment_bytes >= self.segment_size:
+      self.Rotate(frames[0][0])
+    self.f.write(buf)
+    self.unsynced = True
+    self.segment_bytes += len(buf)
+    self.n_frames += len(frames)
+
+  def Sync(self):
+    if self.f is not None:
+      self.f.flush()
+      os.fsync(self.f.fileno())
+    self.unsynced = False
+    self.last_sync = time.time()
+
+  def CloseSegment(self):
+    if self.f is not None:
+      self.Sync()
+      self.f.close()
+      self.f = None
+
+  def Rotate(self, timestamp):
+    self.CloseSegment()
+    path = os.path.join(self.directory, '%s%013d%s' % (
+        SEGMENT_PREFIX, timestamp, SEGMENT_SUFFIX))
+    # Two segments opened within the same millisecond
+    while os.path.exists(path):
+      timestamp += 1
+      path = os.path.join(self.directory, '%s%013d%s' % (
+          SEGMENT_PREFIX, timestamp, SEGMENT_SUFFIX))
+    self.f = open(path, 'wb')
+    self.f.write(MAGIC)
+    self.segment_bytes = len(MAGIC)
+    logging.debug('CAN log segment %s', path)
+    for old in SegmentPaths(self.directory)[:-self.retention]:
+      try:
+        os.remove(old)
+        if os.path.exists(old + INDEX_SUFFIX):
+          os.remove(old + INDEX_SUFFIX)
+      except OSError as e:
+        logging.warning('Could not remove CAN log segment %s: %s', old, e)
+
+
+def ReadSegment(path):
+  '''Lazily yields the (timestamp, id, type, dlc, data) frames of a segment.
+
+  A record cut short by a crash ends the iteration quietly.
+  '''
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise IOError('Not a CAN log segment: %s' % path)
+    buf = ''
+    while True:
+      chunk = f.read(READ_SIZE)
+      if not chunk:
+        return
+      buf += chunk
+      offset = 0
+      while offset + LENGTH.size <= len(buf):
+        length = LENGTH.unpack_from(buf, offset)[0]
+        if length < BODY.size:
+          raise IOError('Corrupt CAN log segment: %s' % path)
+        end = offset + LENGTH.size + length
+        if end > len(buf):
+          break
+        timestamp, can_id, pkt_type, dlc, data = BODY.unpack_from(
+            buf, offset + LENGTH.size)
+        yield (timestamp, can_id, pkt_type, dlc, data[:dlc])
+        offset = end
+      buf = buf[offset:]
+
+
+class CanLogReader():
+  '''Iterates the frames stored in a CanLogWriter directory, oldest first.
+
+  Segments are opened one at a time and read in chunks, so memory use does
+  not depend on the size of the capture.
+  '''
+
+  def __init__(self, directory=LOG_DIR):
+    self.directory = directory
+
+  def Segments(self):
+    return SegmentPaths(self.directory)
+
+  def __iter__(self):
+    for path in self.Segments():
+      for frame in ReadSegment(path):
+        yield frame
+
+
+def ReadLegacyLog(path):
+  '''Yields the frames of a can_log.bin CanLogMessage written by older
+  versions. The whole message has to be parsed up front.'''
+  log = can_msg_pb2.CanLogMessage()
+  with open(path, 'rb') as f:
+    log.ParseFromString(f.read())
+  for pkt in log.log:
+    yield (pkt.timestamp, pkt.id, pkt.type, pkt.dlc,
+           str(bytearray(pkt.data[:pkt.dlc])))
+
+
+def ReadCapture(path):
+  '''Yields the frames of a capture directory, a single segment or a legacy
+  can_log.bin, whichever path names.'''
+  if os.path.isdir(path):
+    return iter(CanLogReader(path))
+  with open(path, 'rb') as f:
+    is_segment = f.read(len(MAGIC)) == MAGIC
+  if is_segment:
+    return ReadSegment(path)
+  return ReadLegacyLog(path)
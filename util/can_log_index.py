@@ -0,0 +1,241 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import logging
+import os
+
+import numpy as np
+
+import can_log
+
+# Matches can_log.RECORD, with data kept as raw bytes.
+RECORD_DTYPE = np.dtype([('length', '<u2'),
+                         ('timestamp', '<i8'),
+                         ('id', '<u4'),
+                         ('type', 'u1'),
+                         ('dlc', 'u1'),
+                         ('data', 'u1', (8,))])
+FRAME_FIELDS = ['timestamp', 'id', 'type', 'dlc', 'data']
+
+# Records summarized by one entry of the sparse index.
+BLOCK_SIZE = 4096
+INDEX_VERSION = 1
+
+
+class SegmentIndex():
+  '''Memory maps one segment and keeps a sparse index over it.
+
+  The index records, per block of BLOCK_SIZE records, the smallest and
+  largest timestamp, and per CAN id the blocks that contain it. It is
+  cached next to the segment and rebuilt when the segment changes size,
+  which covers the segment still being written.
+  '''
+
+  def __init__(self, path, block_size=BLOCK_SIZE):
+    self.path = path
+    self.block_size = block_size
+    self.size = os.path.getsize(path)
+    self.records = self.Map()
+    if not self.LoadIndex():
+      self.BuildIndex()
+      self.SaveIndex()
+
+  def Map(self):
+    count = (self.size - len(can_log.MAGIC)) // RECORD_DTYPE.itemsize
+    if count <= 0:
+      return np.zeros(0, dtype=RECORD_DTYPE)
+    records = np.memmap(self.path, dtype=RECORD_DTYPE, mode='r',
+                        offset=len(can_log.MAGIC), shape=(count,))
+    if not (records['length'] == can_log.BODY.size).all():
+      # Written by a newer layout; fall back to decoding it record by record
+      logging.warning('Irregular records in %s, decoding in full', self.path)
+      return self.Decode()
+    return records
+
+  def Decode(self):
+    frames = list(can_log.ReadSegment(self.path))
+    records = np.zeros(len(frames), dtype=RECORD_DTYPE)
+    for i, (timestamp, can_id, pkt_type, dlc, data) in enumerate(frames):
+      records[i] = (can_log.BODY.size, timestamp, can_id, pkt_type, dlc,
+                    tuple(bytearray(data.ljust(8, '\0'))))
+    return records
+
+  def IndexPath(self):
+    return self.path + can_log.INDEX_SUFFIX
+
+  def LoadIndex(self):
+    try:
+      cached = np.load(self.IndexPath())
+    except (IOError, ValueError):
+      return False
+    with cached:
+      if (int(cached['version']) != INDEX_VERSION or
+          int(cached['size']) != self.size or
+          int(cached['block_size']) != self.block_size):
+        return False
+      self.ts_min = cached['ts_min']
+      self.ts_max = cached['ts_max']
+      self.id_keys = cached['id_keys']
+      self.id_offsets = cached['id_offsets']
+      self.id_blocks = cached['id_blocks']
+    return True
+
+  def BuildIndex(self):
+    n_blocks = (len(self.records) + self.block_size - 1) // self.block_size
+    starts = np.arange(n_blocks) * self.block_size
+    timestamps = np.asarray(self.records['timestamp'])
+    if n_blocks:
+      self.ts_min = np.minimum.reduceat(timestamps, starts)
+      self.ts_max = np.maximum.reduceat(timestamps, starts)
+    else:
+      self.ts_min = np.zeros(0, dtype='<i8')
+      self.ts_max = np.zeros(0, dtype='<i8')
+
+    # Unique (id, block) pairs, grouped by id: a CSR style id -> blocks map
+    blocks = np.arange(len(self.records)) // self.block_size
+    pairs = np.unique(np.asarray(self.records['id']).astype('<i8') *
+                      max(n_blocks, 1) + blocks)
+    pair_ids = pairs // max(n_blocks, 1)
+    self.id_blocks = (pairs % max(n_blocks, 1)).astype('<i4')
+    self.id_keys, first = np.unique(pair_ids, return_index=True)
+    self.id_offsets = np.append(first, len(pairs)).astype('<i8')
+
+  def SaveIndex(self):
+    try:
+      np.savez(self.IndexPath(), version=INDEX_VERSION, size=self.size,
+               block_size=self.block_size, ts_min=self.ts_min,
+               ts_max=self.ts_max, id_keys=self.id_keys,
+               id_offsets=self.id_offsets, id_blocks=self.id_blocks)
+    except IOError as e:
+      logging.warning('Could not cache index for %s: %s', self.path, e)
+
+  def Ids(self):
+    return self.id_keys
+
+  def Blocks(self, can_id=None, t0=None, t1=None):
+    '''Block numbers that may hold matching records.'''
+    keep = np.ones(len(self.ts_min), dtype=bool)
+    if t0 is not None:
+      keep &= self.ts_max >= t0
+    if t1 is not None:
+      keep &= self.ts_min <= t1
+    if can_id is not None:
+      i = np.searchsorted(self.id_keys, can_id)
+      if i == len(self.id_keys) or self.id_keys[i] != can_id:
+        return np.zeros(0, dtype='<i4')
+      with_id = np.zeros(len(keep), dtype=bool)
+      with_id[self.id_blocks[self.id_offsets[i]:self.id_offsets[i + 1]]] = True
+      keep &= with_id
+    return np.flatnonzero(keep)
+
+  def Select(self, can_id=None, t0=None, t1=None):
+    '''Matching records, copied out of the mapping.'''
+    chunks = []
+    for start, stop in Runs(self.Blocks(can_id, t0, t1)):
+      chunk = self.records[start * self.block_size:stop * self.block_size]
+      mask = np.ones(len(chunk), dtype=bool)
+      if can_id is not None:
+        mask &= chunk['id'] == can_id
+      if t0 is not None:
+        mask &= chunk['timestamp'] >= t0
+      if t1 is not None:
+        mask &= chunk['timestamp'] <= t1
+      chunks.append(np.asarray(chunk[mask]))
+    if not chunks:
+      return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+
+def Runs(blocks):
+  '''Collapses sorted block numbers into (start, stop) runs.'''
+  if not len(blocks):
+    return []
+  breaks = np.flatnonzero(np.diff(blocks) != 1) + 1
+  starts = np.concatenate(([blocks[0]], blocks[breaks]))
+  stops = np.concatenate((blocks[breaks - 1], [blocks[-1]])) + 1
+  return zip(starts, stops)
+
+
+class CanLogIndex():
+  '''Indexed, memory mapped access to a CanLogWriter capture directory.
+
+  Only the index blocks that can hold matching frames are touched, so
+  pulling one id out of a time window of a multi-GB capture reads a few
+  slices instead of parsing every frame. Results are NumPy structured
+  arrays with timestamp, id, type, dlc and an (n, 8) data field.
+
+    idx = CanLogIndex('can_log')
+    state = idx.Select(0x603, t0, t1)
+    vin = state['data'][:, 0] + state['data'][:, 1] * 0x100
+  '''
+
+  def __init__(self, directory=can_log.LOG_DIR, block_size=BLOCK_SIZE):
+    self.directory = directory
+    self.block_size = block_size
+    self.segments = {}
+
+  def Segments(self):
+    '''Opens new segments and re-indexes ones that changed size.'''
+    paths = can_log.SegmentPaths(self.directory)
+    for path in paths:
+      seg = self.segments.get(path)
+      if seg is None or seg.size != os.path.getsize(path):
+        self.segments[path] = SegmentIndex(path, self.block_size)
+    for path in set(self.segments) - set(paths):
+      # Removed by retention
+      del self.segments[path]
+    return [self.segments[path] for path in paths]
+
+  def Ids(self):
+    ids = [seg.Ids() for seg in self.Segments()]
+    if not ids:
+      return np.zeros(0, dtype='<i8')
+    return np.unique(np.concatenate(ids))
+
+  def TimeRange(self):
+    segs = [seg for seg in self.Segments() if len(seg.ts_min)]
+    if not segs:
+      return None
+    return (min(seg.ts_min.min() for seg in segs),
+            max(seg.ts_max.max() for seg in segs))
+
+  def Select(self, can_id=None, t0=None, t1=None):
+    '''Frames matching id (any if None) with t0 <= timestamp <= t1.'''
+    chunks = []
+    for seg in self.Segments():
+      if not len(seg.ts_min):
+        continue
+      if t0 is not None and seg.ts_max.max() < t0:
+        continue
+      if t1 is not None and seg.ts_min.min() > t1:
+        continue
+      chunks.append(seg.Select(can_id, t0, t1))
+    if not chunks:
+      return np.zeros(0, dtype=RECORD_DTYPE)[FRAME_FIELDS]
+    return np.concatenate(chunks)[FRAME_FIELDS]
@@ -0,0 +1,139 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import collections
+import time
+
+import can_ethernet
+import can_log
+
+# Frames handed over per GrabAllPackets call when replaying as fast as
+# possible.
+REPLAY_BATCH = 256
+# Transmitted packets kept for inspection.
+SENT_LOG = 1024
+
+
+class canReplay(can_ethernet.canEthernet):
+  '''Drives the canEthernet receive API from a recorded capture.
+
+  Anything written against canEthernet (GrabAllPackets, WaitForPacket, the
+  queue dict) can run against a capture directory, a single segment or a
+  legacy can_log.bin instead of a bridge. With speed=1.0 frames arrive at
+  the pace they were recorded, speed=N replays N times faster and speed=0
+  hands frames over as fast as the consumer takes them, which makes the
+  replay a throughput benchmark for everything above the transport.
+
+  Frames are delivered carrying the time they are delivered at rather than
+  the time they were captured, as live frames carry the time they were
+  received, so that requests made during the replay, e.g. an RTR with a
+  since, take the replies delivered after them as fresh.
+
+  Transmitted packets go nowhere; the most recent are kept in self.sent.
+  '''
+
+  def __init__(self, source, speed=1.0, logger=None):
+    can_ethernet.canEthernet.__init__(self, logger)
+    # nothing is asked for on a replay, so keep whatever it holds
+    self.expect_all = True
+    self.source = source
+    self.speed = speed
+    self.sent = collections.deque(maxlen=SENT_LOG)
+    self.n_replayed = 0
+    self.n_sent = 0
+    self.next_frame = None
+
+  def Connect(self, bitrate=None, **kwargs):
+    self.Cleanup()
+    self.logger.info('Replaying %s at %s', self.source,
+                     '%gx' % self.speed if self.speed else 'full speed')
+    self.frames = can_log.ReadCapture(self.source)
+    self.next_frame = next(self.frames, None)
+    if self.next_frame is not None:
+      self.first_ts = self.next_frame[0]
+    self.start = time.time()
+
+  def SetBitrate(self, bitrate):
+    # The capture was recorded at whatever rate the bus ran at
+    pass
+
+  def Finished(self):
+    return self.next_frame is None
+
+  def Due(self, frame):
+    '''Wall clock time at which frame is to be delivered.'''
+    return self.start + (frame[0] - self.first_ts) / (1000.0 * self.speed)
+
+  def GrabAllPackets(self, timeout=1):
+    '''Pushes every frame that is due into the queue dict.'''
+    now = time.time()
+    delivered = int(now * 1000)
+    frames = []
+    while self.next_frame is not None:
+      if self.speed:
+        if self.Due(self.next_frame) > now:
+          break
+      elif len(frames) >= REPLAY_BATCH:
+        break
+      frames.append((delivered,) + self.next_frame[1:])
+      self.next_frame = next(self.frames, None)
+    if self.tracing:
+      # the frames count as read off the socket as they are delivered
+      self.TracePackets(frames, [now] * len(frames))
+    else:
+      for frame in frames:
+        self.AddPacketToQueueDict(can_ethernet.FrameToPkt(frame))
+    self.n_replayed += len(frames)
+
+  def WaitForRx(self, timeout):
+    if self.next_frame is None:
+      # End of the capture, the bus has gone quiet
+      time.sleep(timeout)
+      return
+    if self.speed:
+      delay = self.Due(self.next_frame) - time.time()
+      if delay > 0:
+        time.sleep(min(delay, timeout))
+    self.GrabAllPackets()
+
+  def SendPkt(self, pkt, timeout=None):
+    self.sent.append(pkt)
+    if self.tracing:
+      self.sentAt[pkt.id] = time.time()
+    self.n_sent += 1
+
+  def GetStats(self):
+    return {'rx_frames': self.n_replayed,
+            'tx_frames': self.n_sent,
+            'finished': self.Finished()}
+
+  def Cleanup(self):
+    if hasattr(self, 'frames'):
+      del self.frames
+    self.next_frame = None
@@ -0,0 +1,143 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import ctypes
+import multiprocessing
+import struct
+import time
+
+# One frame per record: timestamp (ms), id, type, dlc, 8 data bytes, padded
+# out to 24 bytes.
+RECORD = struct.Struct('<qIBB8s2x')
+RECORD_SIZE = RECORD.size
+
+# Default number of records, must be a power of two.
+RING_CAPACITY = 4096
+
+# Slots in the shared counter block.
+HEAD = 0
+TAIL = 1
+OVERRUNS = 2
+
+
+class FrameRing():
+  '''Lock-free single-producer single-consumer ring of CAN frames.
+
+  The records and the head/tail counters live in shared memory so a ring
+  created before multiprocessing.Process.start() can be handed to the child
+  as an argument. Only the producer writes the head and only the consumer
+  writes the tail, so neither side needs a lock. Counters are 32 bit and
+  wrap; the capacity being a power of two keeps the arithmetic exact.
+
+  Frames are the (timestamp, id, type, dlc, data) tuples produced by
+  can_ethernet.DecodeFrames.
+
+  While stamping is on, the producer also notes the time.time() every
+  frame was published at, for latency tracing. Off, it costs a flag read
+  per PutMany().
+  '''
+
+  def __init__(self, capacity=RING_CAPACITY):
+    if capacity <= 0 or capacity & (capacity - 1):
+      raise ValueError('Ring capacity must be a power of two: %d' % capacity)
+    self.capacity = capacity
+    self.mask = capacity - 1
+    self.buf = multiprocessing.RawArray(ctypes.c_char,
+                                        capacity * RECORD_SIZE)
+    self.ctr = multiprocessing.RawArray(ctypes.c_uint32, 3)
+    self.stamps = multiprocessing.RawArray(ctypes.c_double, capacity)
+    self.stamping = multiprocessing.RawValue(ctypes.c_bool, False)
+
+  def Stamp(self, on):
+    '''Turns publish time stamping on or off, from either side.'''
+    if on and not self.stamping.value:
+      # no stamps left over from an earlier run
+      ctypes.memset(self.stamps, 0, ctypes.sizeof(self.stamps))
+    self.stamping.value = on
+
+  def Pending(self):
+    return (self.ctr[HEAD] - self.ctr[TAIL]) & 0xffffffff
+
+  def Total(self):
+    '''Number of frames ever written, modulo 2**32.'''
+    return self.ctr[HEAD]
+
+  def Overruns(self):
+    '''Number of frames dropped because the ring was full.'''
+    return self.ctr[OVERRUNS]
+
+  def Put(self, frame):
+    '''Producer side, returns False and counts an overrun if full.'''
+    return self.PutMany([frame]) == 1
+
+  def PutMany(self, frames):
+    '''Producer side, writes as many frames as fit and returns that count.'''
+    head = self.ctr[HEAD]
+    free = self.capacity - ((head - self.ctr[TAIL]) & 0xffffffff)
+    n = min(free, len(frames))
+    pack_into = RECORD.pack_into
+    buf = self.buf
+    mask = self.mask
+    for i in xrange(n):
+      pack_into(buf, ((head + i) & mask) * RECORD_SIZE, *frames[i])
+    if self.stamping.value:
+      now = time.time()
+      stamps = self.stamps
+      for i in xrange(n):
+        stamps[(head + i) & mask] = now
+    # Publish only after the records are in place.
+    self.ctr[HEAD] = (head + n) & 0xffffffff
+    if n < len(frames):
+      self.ctr[OVERRUNS] = (self.ctr[OVERRUNS] + len(frames) - n) & 0xffffffff
+    return n
+
+  def GetAll(self, limit=None, stamps=None):
+    '''Consumer side, returns every pending frame (at most limit).
+
+    With a list for stamps, the publish time of each frame is appended to
+    it, 0 for frames published while stamping was off.
+    '''
+    tail = self.ctr[TAIL]
+    n = (self.ctr[HEAD] - tail) & 0xffffffff
+    if limit is not None:
+      n = min(n, limit)
+    unpack_from = RECORD.unpack_from
+    buf = self.buf
+    mask = self.mask
+    frames = []
+    for i in xrange(n):
+      timestamp, can_id, pkt_type, dlc, data = unpack_from(
+          buf, ((tail + i) & mask) * RECORD_SIZE)
+      frames.append((timestamp, can_id, pkt_type, dlc, data[:dlc]))
+    if stamps is not None:
+      for i in xrange(n):
+        stamps.append(self.stamps[(tail + i) & mask])
+    # Hand the slots back only after they have been copied out.
+    self.ctr[TAIL] = (tail + n) & 0xffffffff
+    return frames
@@ -0,0 +1,187 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import csv
+import logging
+import os
+import tempfile
+import threading
+
+# The file MPPT Config.py and the provisioning tools read and write
+DEFAULT_FILE = 'configuration.csv'
+
+
+def formatValue(value):
+  # whole numbers in full, floats to the precision the EEPROM keeps
+  if isinstance(value, (int, long)):
+    return '{0:d}'.format(value)
+  return '{0:.7g}'.format(value)
+
+
+class configStore():
+  '''Unit configurations from a CSV file, indexed by serial number.
+
+  The file is read once and looked up in memory. Before every lookup the
+  file's size and mtime are checked, so edits made outside this process are
+  picked up. Updates rewrite the file through a temporary file and a
+  rename, so readers never see it half written.
+  '''
+
+  def __init__(self, path=DEFAULT_FILE):
+    self.path = os.path.abspath(path)
+    self.lock = threading.RLock()
+    self.header = []
+    # serial number -> row of strings, and the serials in file order
+    self.rows = {}
+    self.order = []
+    self.stat = None
+    self.load()
+
+  def load(self):
+    with self.lock:
+      stat = self.fileStat()
+      with open(self.path, 'rb') as f:
+        r = csv.reader(f)
+        try:
+          header = r.next()
+        except StopIteration:
+          header = []
+        rows = {}
+        order = []
+        for row in r:
+          if not row:
+            continue
+          try:
+            sn = int(float(row[header.index('serialNumber')]))
+          except (ValueError, IndexError):
+            logging.warning('%s: skipping row %s', self.path, row)
+            continue
+          if sn not in rows:
+            order.append(sn)
+          # the last row for a serial number wins
+          rows[sn] = row
+      self.header = header
+      self.rows = rows
+      self.order = order
+      self.stat = stat
+
+  def fileStat(self):
+    st = os.stat(self.path)
+    return (st.st_mtime, st.st_size)
+
+  def checkReload(self):
+    # reload if the file was changed under us
+    try:
+      stat = self.fileStat()
+    except OSError:
+      return
+    if stat != self.stat:
+      logging.info('%s changed on disk, reloading', self.path)
+      self.load()
+
+  def __contains__(self, serial_number):
+    return self.lookup(serial_number) is not None
+
+  def serialNumbers(self):
+    with self.lock:
+      self.checkReload()
+      return list(self.order)
+
+  def lookup(self, serial_number):
+    '''Returns the configuration of serial_number as a dict of column ->
+    float, or None if the file has none.'''
+    with self.lock:
+      self.checkReload()
+      row = self.rows.get(serial_number)
+      if row is None:
+        return None
+      return dict((key, float(value))
+                  for key, value in zip(self.header, row) if value != '')
+
+  def put(self, serial_number, values):
+    '''Stores the configuration of one unit, values being a dict of
+    column -> number, and saves the file.'''
+    self.putMany({serial_number: values})
+
+  def putMany(self, configurations):
+    '''Stores several units' configurations, {serial number: values}, with
+    a single rewrite of the file.'''
+    with self.lock:
+      self.checkReload()
+      for serial_number, values in configurations.iteritems():
+        values = dict(values)
+        values['serialNumber'] = serial_number
+        for key in values:
+          if key not in self.header:
+            self.header.append(key)
+        row = list(self.rows.get(serial_number, []))
+        row.extend([''] * (len(self.header) - len(row)))
+        for key, value in values.iteritems():
+          row[self.header.index(key)] = formatValue(value)
+        if serial_number not in self.rows:
+          self.order.append(serial_number)
+        self.rows[serial_number] = row
+      self.save()
+
+  def save(self):
+    with self.lock:
+      directory = os.path.dirname(self.path)
+      fd, temp = tempfile.mkstemp(prefix='.configuration-', suffix='.tmp',
+                                  dir=directory)
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          w = csv.writer(f, lineterminator='\n')
+          w.writerow(self.header)
+          for sn in self.order:
+            w.writerow(self.rows[sn])
+          f.flush()
+          os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+          # windows will not rename over an existing file
+          os.remove(self.path)
+        os.rename(temp, self.path)
+      except:
+        if os.path.exists(temp):
+          os.remove(temp)
+        raise
+      self.stat = self.fileStat()
+
+
+# One store per file, shared by everything in the process
+stores = {}
+storesLock = threading.Lock()
+
+
+def openStore(path=DEFAULT_FILE):
+  '''Returns the configStore for path, loading it on first use.'''
+  path = os.path.abspath(path)
+  with storesLock:
+    if path not in stores:
+      stores[path] = configStore(path)
+    return stores[path]
@@ -26,14 +26,18 @@ either expressed or implied, of Dilithium Power Systems LLC.
 
 """
 
+import collections
 import logging
-import struct
-import csv
 import sys
+import time
 
 sys.path.append('../util')
 
+import can_client
+import can_ethernet
 import can_msg_pb2
+import config_store
+import eeprom_schema
 
 
 class MpptEepromError(Exception):
@@ -44,51 +48,282 @@ def approxEqual(a, b, tol):
   return abs(float(a) - float(b)) < tol
 
 
+# EEPROM reads kept in flight per unit by readData() and readMany()
+WINDOW = 8
+READ_TIMEOUT = 2
+READ_RETRIES = 3
+
+
+class bulkRead():
+  '''Pipelined read of a whole EEPROM.
+
+  Keeps up to window requests in flight and matches replies to requests by
+  the index the firmware echoes in byte 7, or by issue order where it does
+  not. Whether a unit echoes is learnt from its first reply, so the first
+  request is for index 0 only when nothing else is wanted.
+
+  With the echo only the entries whose reply went missing are asked for
+  again. Without it a gap cannot be placed until the window times out, so
+  requests go out a window at a time, replies are held until the window is
+  complete and a window with a reply missing is asked for again whole, in
+  windows half the size.
+  '''
+
+  def __init__(self, ee, window=WINDOW, timeout=READ_TIMEOUT,
+               retries=READ_RETRIES, indices=None):
+    self.ee = ee
+    self.window = window
+    self.timeout = timeout
+    self.retries = retries
+    if indices is None:
+      indices = range(len(ee.schema))
+    self.todo = collections.deque(indices)
+    if ee.echoIndex is None and self.todo and self.todo[0] == 0:
+      self.todo.rotate(-1)
+    self.inflight = collections.OrderedDict()
+    # replies held until their window completes, issue order only
+    self.held = []
+    self.attempts = [0] * len(ee.schema)
+    self.start = time.time()
+    self.elapsed = None
+    self.failed = False
+    self.flush()
+
+  def flush(self):
+    # drop replies left over from earlier requests
+    rx = can_msg_pb2.CanMessage()
+    rx.id = self.ee.canAddress + 0x20
+    self.ee.can.FlushQueueType(rx)
+
+  def done(self):
+    return self.failed or (not self.todo and not self.inflight)
+
+  def deadline(self):
+    # when the oldest request in flight times out
+    if not self.inflight:
+      return None
+    return next(self.inflight.itervalues()) + self.timeout
+
+  def fill(self):
+    if not self.ee.echoIndex and self.inflight:
+      return
+    while self.todo and len(self.inflight) < self.window:
+      i = self.todo.popleft()
+      self.attempts[i] += 1
+      self.ee.requestPacket(i)
+      self.inflight[i] = time.time()
+
+  def collect(self):
+    # stores every reply that has arrived, returns whether there were any
+    got = False
+    while len(self.held) < len(self.inflight):
+      rx = self.ee.can.GetPacketFromQueueDict(self.ee.canAddress + 0x20)
+      if rx is None:
+        break
+      got = True
+      if len(rx.data) < 8:
+        continue
+      if self.ee.echoIndex is None:
+        if rx.data[7] != 0 and rx.data[7] in self.inflight:
+          self.ee.echoIndex = True
+        elif 0 not in self.inflight:
+          self.ee.echoIndex = False
+      if self.ee.echoIndex:
+        i = rx.data[7]
+        if i in self.inflight:
+          del self.inflight[i]
+          self.ee.storePacket(i, rx)
+        # otherwise a duplicate of an entry already asked for again
+        continue
+      self.held.append(rx)
+      if len(self.held) == len(self.inflight):
+        for i, rx in zip(self.inflight, self.held):
+          self.ee.storePacket(i, rx)
+        self.inflight.clear()
+        self.held = []
+    self.expire()
+    if self.done() and self.elapsed is None:
+      self.elapsed = time.time() - self.start
+    return got
+
+  def expire(self):
+    deadline = self.deadline()
+    if deadline is None or time.time() < deadline:
+      return
+    if self.ee.echoIndex:
+      overdue = [i for i, sent in self.inflight.iteritems()
+                 if sent + self.timeout <= time.time()]
+    else:
+      overdue = list(self.inflight)
+      self.held = []
+      self.flush()
+      if len(overdue) > 1:
+        # nothing says which entry went missing, so do not count the
+        # attempt and try again with smaller windows
+        for i in overdue:
+          self.attempts[i] -= 1
+        self.window = max(self.window // 2, 1)
+    for i in overdue:
+      del self.inflight[i]
+      if self.attempts[i] >= self.retries:
+        logging.error('Failed to read EEPROM %s from MPPT: 0x%03x' %
+                      (self.ee.schema[i].name, self.ee.canAddress))
+        self.failed = True
+        return
+    self.todo.extendleft(reversed(overdue))
+
+
+def runReads(reads):
+  # drives bulkReads sharing one canEthernet until they all finish
+  can = reads[0].ee.can
+  while True:
+    active = [r for r in reads if not r.done()]
+    if not active:
+      return
+    for r in active:
+      r.fill()
+    if any([r.collect() for r in active]):
+      continue
+    deadlines = [r.deadline() for r in active if r.deadline() is not None]
+    if deadlines:
+      can.WaitForRx(max(min(deadlines) - time.time(), 0))
+
+
+def readMany(eeproms, window=WINDOW, timeout=READ_TIMEOUT):
+  '''Reads the full contents of several MPPT EEPROMs at once.
+
+  Every unit has its own pipelined bulkRead running, so the whole sweep
+  costs about as long as reading the slowest unit.
+
+  Args:
+    eeproms: eeprom objects, all on the same canEthernet.
+    window: Requests kept in flight per unit.
+    timeout: Seconds to wait for each reply.
+  Returns:
+    Dict of eeprom -> seconds its read took. Units that stopped answering
+    are left out.
+  '''
+  reads = [bulkRead(ee, window, timeout) for ee in eeproms]
+  if reads:
+    runReads(reads)
+  # units whose firmware lays the EEPROM out differently are read again
+  again = [bulkRead(r.ee, window, timeout) for r in reads
+           if not r.failed and r.ee.checkSchema()]
+  if again:
+    runReads(again)
+  elapsed = dict((r.ee, r.elapsed) for r in reads if not r.failed)
+  for r in again:
+    if r.failed:
+      del elapsed[r.ee]
+    else:
+      elapsed[r.ee] += r.elapsed
+  return elapsed
+
+
+class provisionReport():
+  # outcome of eeprom.provision()
+
+  def __init__(self, canAddress):
+    self.canAddress = canAddress
+    # (key, old value, new value) for every field written
+    self.changed = []
+    # keys that already held the wanted value
+    self.unchanged = []
+    # (key, wanted value, value read back or None) for every write that
+    # did not take
+    self.failed = []
+    # keys the device has no field for or that it manages itself
+    self.ignored = []
+    # set if the unit could not be provisioned at all
+    self.error = None
+    self.elapsed = 0
+
+  def ok(self):
+    return not self.failed and self.error is None
+
+  def summary(self):
+    if self.error is not None:
+      return 'MPPT 0x%03X: %s' % (self.canAddress, self.error)
+    lines = ['MPPT 0x%03X: %d changed, %d unchanged, %d failed in %.3f s' % (
+        self.canAddress, len(self.changed), len(self.unchanged),
+        len(self.failed), self.elapsed)]
+    for key, old, new in self.changed:
+      lines.append('  %s: %s -> %s' % (key, repr(old), repr(new)))
+    for key, wanted, got in self.failed:
+      lines.append('  %s: wanted %s, read %s' % (key, repr(wanted),
+                                                  repr(got)))
+    return '\n'.join(lines)
+
+
+def provisionMany(targets, tol=0.001):
+  '''Brings several MPPTs in line with their target configurations.
+
+  Every image is fetched with one pipelined sweep and diffed against its
+  target, the fields that differ are written back to back across all the
+  units, and one more sweep reads them all back to verify.
+
+  Args:
+    targets: Dict of eeprom -> dict of key -> value, all on the same
+      canEthernet.
+    tol: How close a value read back has to be to the one written.
+  Returns:
+    Dict of eeprom -> provisionReport.
+  '''
+  start = time.time()
+  reports = dict((ee, provisionReport(ee.canAddress)) for ee in targets)
+  if not targets:
+    return reports
+
+  # one pipelined read of every image
+  reads = [bulkRead(ee) for ee in targets]
+  runReads(reads)
+
+  changes = {}
+  for r in reads:
+    if r.failed:
+      reports[r.ee].error = 'EEPROM read failed'
+      continue
+    changes[r.ee] = r.ee.planChanges(targets[r.ee], reports[r.ee])
+
+  # back to back writes, then one batched read to verify them all
+  for ee, changed in changes.iteritems():
+    for i, value in changed:
+      ee.writeValue(ee.schema[i].name, value)
+  verify = [bulkRead(ee, indices=[i for i, value in changed])
+            for ee, changed in changes.iteritems() if changed]
+  if verify:
+    runReads(verify)
+
+  for ee, changed in changes.iteritems():
+    for i, value in changed:
+      got = ee.device[i] if ee.fetched[i] is not None else None
+      if got is None or not approxEqual(got, value, tol):
+        reports[ee].failed.append((ee.schema[i].name, value, got))
+  for report in reports.itervalues():
+    report.elapsed = time.time() - start
+  return reports
+
+
 class eeprom():
   # function to initialize class - this is called on initialization of the
   # eeprom() object
 
-  def __init__(self, channel, baseid, can, mppt):
+  def __init__(self, channel, baseid, can, mppt, read=True, ttl=None,
+               schema=eeprom_schema.DEFAULT):
     self.canAddress = baseid + channel
     self.can = can
     self.mppt = mppt
-    self.data = [['serialNumber', 'int32', 0],
-           ['hardOutputVoltage', 'float', 0],
-           ['minOutputVoltage', 'float', 0],
-           ['maxOutputVoltage', 'float', 0],
-           ['constOutputVoltage', 'float', 0],
-           ['maxTemperature', 'float', 0],
-           ['hardCurrent', 'float', 0],
-           ['maxCurrent', 'float', 0],
-           ['scaleAmpsIn', 'float', 0],
-           ['offsetAmpsIn', 'float', 0],
-           ['scaleAmpsOut', 'float', 0],
-           ['offsetAmpsOut', 'float', 0],
-           ['scaleVoltsIn', 'float', 0],
-           ['offsetVoltsIn', 'float', 0],
-           ['scaleVoltsOut', 'float', 0],
-           ['offsetVoltsOut', 'float', 0],
-           ['constVoltageHyst', 'float', 0],
-           ['safetyVoltageHyst', 'float', 0],
-           ['safetyCurrentHyst', 'float', 0],
-           ['safetyTemperatureHyst', 'float', 0],
-           ['thermistorBeta', 'float', 0],
-           ['thermistorRo', 'float', 0],
-           ['thermistorRbias', 'float', 0],
-           ['thermistorTo', 'float', 0],
-           ['canBitrate', 'int32', 0],
-           ['canBaseAddress', 'int32', 0],
-           ['testMode', 'int32', 0],
-           ['POseconds', 'float', 0],
-           ['INCseconds', 'float', 0],
-           ['TRACKseconds', 'float', 0],
-           ['SWVersion', 'int32', 0],
-           ['syncCurrentHi', 'float', 0],
-           ['syncCurrentLow', 'float', 0],
-           ['autoSendRate', 'float', 0],
-           ]
+    self.ttl = ttl
+    self.useSchema(schema)
+    # whether read replies carry the index in byte 7, None until seen
+    self.echoIndex = None
+    # leave the read to the caller, e.g. readMany() during discovery
+    if not read:
+      return
     if True:
       self.readData()
+      if self.checkSchema():
+        self.readData()
       logging.info('Successfully read EEPROM Data from MPPT: 0x%03X' %
                    self.canAddress)
     else:
@@ -96,175 +331,260 @@ class eeprom():
                     self.canAddress)
       raise MpptEepromError('Failed to read MPPT EEPROM')
 
+  # this function will lay the values out by schema, dropping any cached
+  def useSchema(self, schema):
+    self.schema = schema
+    # self.device is a cache of the device: what each entry held when last
+    # read or written, and when it was last read, None if it has to be read
+    # again. With a ttl entries older than ttl seconds are read again too.
+    # self.values is what the caller sees, the device image with the
+    # values set locally that flush() has yet to write, marked dirty.
+    self.device = [0] * len(schema)
+    self.values = [0] * len(schema)
+    self.fetched = [None] * len(schema)
+    self.dirty = [False] * len(schema)
+
+  # this function will switch to the layout of the firmware that was just
+  # read, returns True if the values need reading again
+  def checkSchema(self):
+    if 'SWVersion' not in self.schema:
+      return False
+    schema = eeprom_schema.forVersion(self.getValue('SWVersion'))
+    if schema is self.schema:
+      return False
+    logging.info('MPPT 0x%03X uses the SW %d EEPROM layout' %
+                 (self.canAddress, schema.version))
+    self.useSchema(schema)
+    return True
+
   # this function will return the variable iindex of a named eeprom variable
   def getIndex(self, key):
-    for i in range(len(self.data)):
-      if(self.data[i][0] == key):
-        keyfound = 1
-        break
-    if(keyfound == 0):
-      raise AssertionError('failed to find key')
-    return i
+    try:
+      return self.schema.index[key]
+    except KeyError:
+      raise AssertionError('failed to find key %s' % key)
 
   # this function will return the value of a named variable
   def getValue(self, key):
-    i = self.getIndex(key)
-    return self.data[i][2]
+    return self.values[self.getIndex(key)]
+
+  # this function will return the value of a named variable as the device
+  # held it when last read, leaving out any local edit
+  def getDeviceValue(self, key):
+    return self.device[self.getIndex(key)]
 
   # this function will return the type of a named eeprom variable
   def getType(self, key):
-    i = self.getIndex(key)
-    return self.data[i][1]
+    return self.schema[self.getIndex(key)].type
 
   # this will print the full contants of the eeprom to the terminal
   def printContents(self):
-    for i in range(len(self.data)):
+    for f in self.schema:
       print(
         '{0:s} {1:s} = {2:g}'.format(
-          self.data[i][1],
-          self.data[i][0],
-          self.data[i][2]))
+          f.type,
+          f.name,
+          self.values[f.index]))
 
   # this function will read the contents of the eeprom on the device
   # and put it into the data structures
-  def readData(self):
-
-    for i in range(len(self.data)):
-      if(self.data[i][1] == 'int32'):
-        value = self.pktToInt32(self.getPacket(i))
-      elif(self.data[i][1] == 'float'):
-        value = self.pktToFloat(self.getPacket(i))
-      else:
-        raise Exception('no type match')
-      self.data[i][2] = value
+  def readData(self, window=WINDOW, indices=None):
+    read = bulkRead(self, window, indices=indices)
+    runReads([read])
+    if read.failed:
+      raise can_ethernet.TimeoutError()
+
+  # this function will read only the entries that are not fresh
+  def refresh(self, window=WINDOW):
+    stale = [i for i in range(len(self.schema)) if not self.isFresh(i)]
+    if stale:
+      self.readData(window, stale)
+
+  # this function will say whether entry i can be used without a read
+  def isFresh(self, i):
+    if self.dirty[i]:
+      return True
+    if self.fetched[i] is None:
+      return False
+    return self.ttl is None or time.time() - self.fetched[i] < self.ttl
+
+  # this function will force named entries, or all of them, to be read
+  # from the device next time
+  def invalidate(self, key=None):
+    if key is None:
+      self.fetched = [None] * len(self.schema)
+    else:
+      self.fetched[self.getIndex(key)] = None
 
   # this function will send a packet on the canbus to retrieve a single
   # variable value out of eeprom
   def getPacket(self, idx):
+    sent = time.time()
+    tx = self.requestPacket(idx)
+    if self.echoIndex:
+      match = lambda rx: len(rx.data) == 8 and rx.data[7] == idx
+    else:
+      match = None
+    rx = self.can.WaitForPacket(tx, 2, match, sent)
+    return rx
+
+  # this function will send the request for a single variable without
+  # waiting for the reply, the reply comes back on the same id
+  def requestPacket(self, idx):
+    tx = self.readRequest(idx)
+    self.can.SendPkt(tx)
+    return tx
+
+  # this function will build the request for a single variable
+  def readRequest(self, idx):
     tx = can_msg_pb2.CanMessage()
     tx.id = self.canAddress + 0x20
     tx.data.extend([0, 0, 0, 0, 0, 0, 0, idx])
-    self.can.SendPkt(tx)
-    rx = self.can.WaitForPacket(tx, 2)
-    return rx
+    return tx
 
-  # this function will read a single value from eeprom and return it as a
-  # number
-  def readValue(self, key):
+  # this function will read a single value through a can_client.canClient
+  # and return a future of it, from the cache if the entry is fresh
+  def requestValue(self, client, key, cached=True, timeout=READ_TIMEOUT,
+                   retries=READ_RETRIES):
     i = self.getIndex(key)
-    rawValue = self.getPacket(i)
-    if(self.data[i][1] == 'int32'):
-      value = self.pktToInt32(rawValue)
-    elif(self.data[i][1] == 'float'):
-      value = self.pktToFloat(rawValue)
+    if cached and self.isFresh(i):
+      return can_client.Resolved(self.values[i])
+    return self.requestIndex(client, i, timeout, retries)
+
+  # this function will ask for variable i through a can_client.canClient,
+  # the future resolves to its value once it is stored. Replies are told
+  # apart by the echoed index where the firmware echoes it, otherwise the
+  # requests to this unit go out one at a time.
+  def requestIndex(self, client, i, timeout=READ_TIMEOUT,
+                   retries=READ_RETRIES):
+    if self.echoIndex:
+      match = lambda rx: len(rx.data) == 8 and rx.data[7] == i
+    else:
+      match = lambda rx: len(rx.data) == 8
+
+    def store(rx):
+      if self.echoIndex is None and i != 0:
+        self.echoIndex = rx.data[7] == i
+      return self.storePacket(i, rx)
+    return client.Request(self.readRequest(i), match, timeout, retries,
+                          exclusive=not self.echoIndex).Then(store)
+
+  # this function will read the entries given, or the whole eeprom and
+  # again if its layout turns out to differ, through a can_client.canClient.
+  # The future resolves to the list of values read.
+  def requestData(self, client, indices=None, timeout=READ_TIMEOUT,
+                  retries=READ_RETRIES):
+    whole = indices is None
+    if whole:
+      indices = range(len(self.schema))
+    indices = list(indices)
+    rest = list(indices)
+    probe = [i for i in indices if i != 0][:1]
+
+    def gather(ignored=None):
+      return can_client.Gather([self.requestIndex(client, i, timeout,
+                                                  retries) for i in rest])
+    if self.echoIndex is None and probe:
+      # one reply says whether the rest can be asked for all at once
+      rest.remove(probe[0])
+      future = self.requestIndex(client, probe[0], timeout, retries).Then(
+          gather)
     else:
-      raise Exception('no type match')
-    self.data[i][2] = value
+      future = gather()
+    future = future.Then(lambda ignored: [self.values[i] for i in indices])
+    if not whole:
+      return future
+
+    def checkLayout(values):
+      if self.checkSchema():
+        return self.requestData(client, None, timeout, retries)
+      return values
+    return future.Then(checkLayout)
+
+  # this function will decode a reply packet for variable i and store it,
+  # a value set locally and not yet flushed stays visible over it
+  def storePacket(self, i, pkt):
+    value = self.schema.fields[i].decode(bytearray(pkt.data[0:4]))
+    self.fetched[i] = time.time()
+    self.device[i] = value
+    if not self.dirty[i]:
+      self.values[i] = value
     return value
 
+  # this function will read a single value from eeprom and return it as a
+  # number, from the cache if the entry is fresh. A value read from the
+  # device is returned as the device holds it, whatever edit is pending.
+  def readValue(self, key, cached=True):
+    i = self.getIndex(key)
+    if cached and self.isFresh(i):
+      return self.values[i]
+    return self.storePacket(i, self.getPacket(i))
+
+  # this function will set a value in the cache only, flush() writes it
+  def setValue(self, key, value):
+    i = self.getIndex(key)
+    self.values[i] = value
+    self.dirty[i] = True
+
+  # this function will write every value set since the last flush and
+  # return their names
+  def flush(self):
+    written = []
+    for f in self.schema:
+      if self.dirty[f.index]:
+        self.writeValue(f.name, self.values[f.index])
+        written.append(f.name)
+    return written
+
   # this function will write a single named value to eeprom
   def writeValue(self, key, value):
     i = self.getIndex(key)
-    if(self.data[i][1] == 'int32'):
-      bytes = self.int32ToPkt(value)
-    elif(self.data[i][1] == 'float'):
-      bytes = self.floatToPkt(value)
-    else:
-      raise Exception('no type match')
+    raw = self.schema.fields[i].encode(value)
     # create the packet structure
     tx = can_msg_pb2.CanMessage()
     tx.id = self.canAddress + 0x30
     
     # build the can packet payload with the magic number
-    tx.data.extend([bytes[3], bytes[2], bytes[1], bytes[0], 45, 78, 69, i])
+    tx.data.extend(bytearray(raw))
+    tx.data.extend([45, 78, 69, i])
     
     # send the packet on the bus
     self.can.SendPkt(tx)
 
+    # the device has the final say on what got stored, read it back next
+    # time it is asked for
+    self.device[i] = value
+    self.values[i] = value
+    self.dirty[i] = False
+    self.fetched[i] = None
+
   # this function will write the contents of the eeprom to a configuration
   # file
   def writeConfigurationToFile(self, file_name, overwrite):
     assert file_name is not None
     assert overwrite is not None
-    # read the file into memory
+    store = config_store.openStore(file_name)
     serial_number = self.readValue('serialNumber')
-    if(overwrite == True):
-      #update data to reflect the current values on the device
-      self.readData()
-
-      # open the config file and read it's contents into memory
-      f = open(file_name, 'r')
-      assert f is not None
-      lines = f.readlines()
-      f.close()
-
-      # open the config file for wiritng
-      f = open(file_name, 'w')
-      assert f is not None
-      csvReader = csv.reader(lines)
-      i = 0
-
-      # loop through the unit configurations and write the correct one
-      for row in csvReader:
-        l = ','.join(row)
-        if(i > 0):
-          # if the line corresopnds to the correct serial number
-          if(int(row[0]) == serial_number):
-            l = ''
-            #print 'config found - writing line'
-            configExists = True
-            for i in range(len(self.data)):
-              l += '{0:g},'.format(self.data[i][2])
-            l = l[:-1]
-        f.write(l + '\n')
-        #print l
-        i += 1
-      f.close()
-    else:
+    if serial_number in store and not overwrite:
       # if the config already exists - dont overwrite
       logging.info('Config File already contains entry - not overwriting')
-    if not configExists:
-      logging.info('%s written' % (file_name))
-    return
+      return
+    #update data to reflect the current values on the device
+    self.readData()
+    store.put(serial_number, dict(zip(self.schema.names(), self.device)))
+    logging.info('%s written' % (file_name))
 
   # read the configuration file and write to the device
   def loadConfigurationFromFile(self, file_name, serial_number):
     assert file_name is not None
     assert serial_number is not None
-    # load the config file into memory
-    f = open(file_name, 'r')
-    r = csv.reader(f)
-    header = r.next()
-
-    # loop through file to see if this serial number is in the file and
-    # find it's line index
-    confExists = False
-
-    i = 1
-    while True:
-      try:
-        row = r.next()
-        sn = int(row[header.index('serialNumber')])
-        if(serial_number == sn):
-          confExists = True
-          dataToWrite = row
-        i += 1
-      except StopIteration:
-        break
-
-    # if the config exists dataToWrite now contains the row where 
-    # the data exists
-    if not confExists:
+    target = config_store.openStore(file_name).lookup(serial_number)
+    if target is None:
       raise AssertionError('Configuration does not exist.')
-    else:
-      logging.info('Writing Configuration to Unit')
-
-      # write all the values to the eeprom on the device
-      for i in range(len(dataToWrite)):
-        # don't write the swversion variable - thats handled by the
-        # device only
-        if(header[i] != 'SWVersion'):
-          self.writeNewEEPROMValue(header[i], float(dataToWrite[i]))
+    logging.info('Writing Configuration to Unit')
+    report = self.provision(target)
+    logging.info(report.summary())
+    return report
 
   # confirm that the values were correctly written
   def confirmConfiguration(self, file_name, serial_number):
@@ -272,78 +592,54 @@ class eeprom():
       raise TypeError('Filename must be a string: %s', type(file_name))
     if not isinstance(serial_number, int):
       raise TypeError('Serial number must be an int: %s', type(serial_number))
-    
-    # load the config file into memory
-    f = open(file_name, 'r')
-    r = csv.reader(f)
-    header = r.next()
-
-    # loop through file to see if this serial number is in the file and
-    # find it's line index
-    confExists = False
-
-    i = 1
-    while True:
-      if True:
-        row = r.next()
-        sn = int(row[header.index('serialNumber')])
-        if serial_number == sn :
-          confExists = True
-          dataToWrite = row
-        i += 1
-      #except:
-       # break
-
-    # if the config exists dataToWrite now contains the row where
-    # the data exists
-    assert confExists
-
-    if confExists:
-      for i in range(len(dataToWrite)):
-        if(header[i] != 'SWVersion'):
-          self.confirmNewEEPROMValue(
-            header[i],
-            float(
-              dataToWrite[i]))
-    return
-
-  def floatToPkt(self, num):
-    assert num is not None
-    # convert a floating point number to its raw byte array
-    s = struct.pack('>f', num)
-    output = struct.unpack('BBBB', s)
-    return output
-
-  def int32ToPkt(self, num):
-    assert num is not None
-    # convert a 32 bit int to its array of bytes
-    s = struct.pack('>i', num)
-    output = struct.unpack('BBBB', s)
-    return output
-
-  def pktToFloat(self, pkt):
-    assert pkt is not None
-    # convert an array of bytes to a floating point number
-    s = struct.pack(
-      'BBBB',
-      pkt.data[3],
-      pkt.data[2],
-      pkt.data[1],
-      pkt.data[0])
-    output = struct.unpack('>f', s)[0]
-    return output
-
-  def pktToInt32(self, pkt):
-    assert pkt is not None
-    # convert an array of bytes to a 32bit int
-    temp = struct.pack(
-      'BBBB',
-      pkt.data[3],
-      pkt.data[2],
-      pkt.data[1],
-      pkt.data[0])
-    output = struct.unpack('>L', temp)[0]
-    return output
+
+    target = config_store.openStore(file_name).lookup(serial_number)
+    assert target is not None
+
+    confirmed = True
+    for key in self.schema.names():
+      if key in target and key != 'SWVersion':
+        confirmed &= self.confirmNewEEPROMValue(key, target[key])
+    return confirmed
+
+  # this function will bring the device in line with target, a dict of
+  # key -> value, writing only the fields that differ
+  def provision(self, target, tol=0.001):
+    return provisionMany({self: target}, tol)[self]
+
+  # this function will work out which fields differ from target, noting
+  # them in report, and return them as (index, value) pairs
+  def planChanges(self, target, report):
+    changed = []
+    index = self.schema.index
+    for key in sorted(target, key=lambda k: index.get(k, -1)):
+      # don't write the swversion variable - thats handled by the
+      # device only
+      if key not in index or key == 'SWVersion':
+        report.ignored.append(key)
+        continue
+      i = index[key]
+      value = target[key]
+      if self.schema[i].type == 'int32':
+        value = int(value)
+      # diff against the device, not against edits yet to be flushed
+      if approxEqual(self.device[i], value, 0.00001):
+        report.unchanged.append(key)
+        continue
+      report.changed.append((key, self.device[i], value))
+      changed.append((i, value))
+    return changed
+
+  # this function will list the (key, wanted, device value) of every field
+  # in target that the device image does not match
+  def compare(self, target, tol=0.001):
+    mismatched = []
+    for key in self.schema.names():
+      if key in target and key != 'SWVersion':
+        value = self.getDeviceValue(key)
+        if not approxEqual(value, target[key], tol):
+          mismatched.append((key, target[key], value))
+    return mismatched
 
   def writeNewEEPROMValue(self, key, newValue):
     # write a new value to the eeprom
@@ -361,9 +657,12 @@ class eeprom():
       logging.info('%s - reading %s' % (key, self.readValue(key)))
 
   def confirmNewEEPROMValue(self, key, new_value):
-    # confirm that the eeprom contains the specified value
-    current_value = self.readValue(key)
+    # confirm that the eeprom contains the specified value, asking the
+    # device rather than the cache
+    current_value = self.readValue(key, cached=False)
     if approxEqual(current_value, new_value, 0.001):
       logging.info('%s confirmed: %s' % (key, repr(new_value)))
+      return True
     else:
       logging.error('%s not confirmed: %s' % (key, repr(new_value)))
+      return False
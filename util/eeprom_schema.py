@@ -0,0 +1,163 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import collections
+import struct
+
+# Every EEPROM entry travels as 4 little endian bytes in bytes 0-3 of the
+# frame. int32 entries are read back unsigned.
+FLOAT = struct.Struct('<f')
+UINT32 = struct.Struct('<I')
+
+# Name and type of every EEPROM entry, in index order, as laid out by the
+# Photon firmware releases in fw_releases.
+PHOTON_LAYOUT = (
+    ('serialNumber', 'int32'),
+    ('hardOutputVoltage', 'float'),
+    ('minOutputVoltage', 'float'),
+    ('maxOutputVoltage', 'float'),
+    ('constOutputVoltage', 'float'),
+    ('maxTemperature', 'float'),
+    ('hardCurrent', 'float'),
+    ('maxCurrent', 'float'),
+    ('scaleAmpsIn', 'float'),
+    ('offsetAmpsIn', 'float'),
+    ('scaleAmpsOut', 'float'),
+    ('offsetAmpsOut', 'float'),
+    ('scaleVoltsIn', 'float'),
+    ('offsetVoltsIn', 'float'),
+    ('scaleVoltsOut', 'float'),
+    ('offsetVoltsOut', 'float'),
+    ('constVoltageHyst', 'float'),
+    ('safetyVoltageHyst', 'float'),
+    ('safetyCurrentHyst', 'float'),
+    ('safetyTemperatureHyst', 'float'),
+    ('thermistorBeta', 'float'),
+    ('thermistorRo', 'float'),
+    ('thermistorRbias', 'float'),
+    ('thermistorTo', 'float'),
+    ('canBitrate', 'int32'),
+    ('canBaseAddress', 'int32'),
+    ('testMode', 'int32'),
+    ('POseconds', 'float'),
+    ('INCseconds', 'float'),
+    ('TRACKseconds', 'float'),
+    ('SWVersion', 'int32'),
+    ('syncCurrentHi', 'float'),
+    ('syncCurrentLow', 'float'),
+    ('autoSendRate', 'float'),
+    )
+
+
+def toUint32(value):
+  # negative values go out two's complement
+  return int(value) & 0xffffffff
+
+# type name -> (struct, conversion applied before packing)
+CODECS = {
+    'float': (FLOAT, float),
+    'int32': (UINT32, toUint32),
+    }
+
+
+class field(collections.namedtuple('field', 'index name type codec coerce')):
+  '''One EEPROM entry with its codec compiled in.'''
+  __slots__ = ()
+
+  def encode(self, value):
+    '''Returns the 4 bytes value is written as.'''
+    return self.codec.pack(self.coerce(value))
+
+  def decode(self, raw, offset=0):
+    '''Returns the value held in the 4 bytes of raw at offset.'''
+    return self.codec.unpack_from(raw, offset)[0]
+
+
+class eepromSchema(object):
+  '''Immutable EEPROM layout of one range of firmware versions.
+
+  Args:
+    version: Lowest SWVersion using this layout.
+    layout: Sequence of (name, type) pairs in index order, type being one
+      of CODECS.
+  '''
+  __slots__ = ('version', 'fields', 'index')
+
+  def __init__(self, version, layout):
+    fields = []
+    for i, (name, data_type) in enumerate(layout):
+      codec, coerce = CODECS[data_type]
+      fields.append(field(i, name, data_type, codec, coerce))
+    object.__setattr__(self, 'version', version)
+    object.__setattr__(self, 'fields', tuple(fields))
+    object.__setattr__(self, 'index',
+                       dict((f.name, f.index) for f in fields))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('eepromSchema is immutable')
+
+  def __len__(self):
+    return len(self.fields)
+
+  def __iter__(self):
+    return iter(self.fields)
+
+  def __getitem__(self, key):
+    '''Field by index or by name.'''
+    if isinstance(key, basestring):
+      key = self.index[key]
+    return self.fields[key]
+
+  def __contains__(self, name):
+    return name in self.index
+
+  def names(self):
+    return [f.name for f in self.fields]
+
+
+# Known layouts, oldest first
+SCHEMAS = []
+
+
+def register(schema):
+  SCHEMAS.append(schema)
+  SCHEMAS.sort(key=lambda s: s.version)
+  return schema
+
+
+def forVersion(sw_version):
+  '''Returns the layout of firmware sw_version.'''
+  chosen = SCHEMAS[0]
+  for schema in SCHEMAS:
+    if schema.version <= sw_version:
+      chosen = schema
+  return chosen
+
+# Every release so far shares one layout
+DEFAULT = register(eepromSchema(0, PHOTON_LAYOUT))
@@ -0,0 +1,222 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+
+import logging
+
+import numpy as np
+
+# Stages of a request through canEthernet, each the time since the one
+# before:
+#   send  - enqueued on the tx ring until the datagram goes out, measured
+#           in the interface process
+#   bus   - enqueued until the reply is read off the socket: the tx ring,
+#           the bridge, the bus and the device answering
+#   ipc   - read off the socket until dequeued from the rx ring
+#   parse - dequeued until matched to the request, protobuf parse included
+#   wake  - matched until WaitForPacket returns it
+#   total - enqueued until WaitForPacket returns
+STAGES = ('send', 'bus', 'ipc', 'parse', 'wake', 'total')
+
+# Histogram resolution: latencies in whole microseconds, kept to 2
+# significant digits, up to a minute
+UNIT = 1e-6
+DIGITS = 2
+HIGHEST = 60.0
+
+# Seconds between the summaries logged while tracing
+REPORT_TIME = 60.0
+
+# Percentiles in a summary
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class latencyHistogram():
+  '''Log-linear latency histogram in the manner of HdrHistogram.
+
+  Values below 2 * 10**digits units get a bucket each, above that every
+  power of two is split in the same number of buckets, so any value is
+  kept to digits significant digits at a fixed size whatever the range.
+  Recording is a bit_length() and an increment. Values beyond highest
+  land in the last bucket.
+
+  counts can be a multiprocessing.RawArray of size() zeroed longs, e.g.
+  for a histogram written in another process.
+  '''
+
+  def __init__(self, digits=DIGITS, highest=HIGHEST, counts=None):
+    subBits = int(np.ceil(np.log2(2 * 10 ** digits)))
+    self.digits = digits
+    self.subBits = subBits
+    self.subCount = 1 << subBits
+    self.halfCount = self.subCount >> 1
+    self.nBuckets = self.index(int(highest / UNIT)) + 1
+    if counts is None:
+      counts = [0] * self.nBuckets
+    elif len(counts) != self.nBuckets:
+      raise ValueError('Need %d counts, got %d' % (self.nBuckets,
+                                                   len(counts)))
+    self.counts = counts
+
+  @staticmethod
+  def size(digits=DIGITS, highest=HIGHEST):
+    return latencyHistogram(digits, highest).nBuckets
+
+  def index(self, units):
+    if units < self.subCount:
+      return max(units, 0)
+    shift = units.bit_length() - self.subBits
+    return (self.subCount + (shift - 1) * self.halfCount +
+            (units >> shift) - self.halfCount)
+
+  def record(self, seconds):
+    units = int(seconds / UNIT)
+    if units < self.subCount:
+      i = max(units, 0)
+    else:
+      shift = units.bit_length() - self.subBits
+      i = min(self.subCount + (shift - 1) * self.halfCount +
+              (units >> shift) - self.halfCount, self.nBuckets - 1)
+    self.counts[i] += 1
+
+  def bounds(self):
+    '''Returns the lowest and highest value of every bucket in seconds.'''
+    i = np.arange(self.nBuckets)
+    shift = np.maximum((i - self.subCount) // self.halfCount + 1, 0)
+    sub = np.where(i < self.subCount, i,
+                   (i - self.subCount) % self.halfCount + self.halfCount)
+    low = sub << shift
+    return low * UNIT, (low + (1 << shift) - 1) * UNIT
+
+  def array(self):
+    return np.array(self.counts[:], dtype=np.int64)
+
+  def count(self):
+    return int(self.array().sum())
+
+  def add(self, other):
+    # merges other, of the same resolution, into this one
+    if other.nBuckets != self.nBuckets:
+      raise ValueError('Histograms of different resolution')
+    for i, n in enumerate(other.counts[:]):
+      if n:
+        self.counts[i] += n
+
+  def reset(self):
+    for i in xrange(self.nBuckets):
+      self.counts[i] = 0
+
+  def percentiles(self, percentiles=PERCENTILES):
+    '''Returns the highest value of the bucket every percentile falls in,
+    None for each if nothing was recorded.'''
+    counts = self.array()
+    total = counts.sum()
+    if not total:
+      return [None] * len(percentiles)
+    cumulative = np.cumsum(counts)
+    ranks = np.ceil(np.array(percentiles) / 100.0 * total)
+    i = np.searchsorted(cumulative, np.maximum(ranks, 1))
+    return list(self.bounds()[1][i])
+
+  def summary(self, percentiles=PERCENTILES):
+    '''Returns count, mean, max and the percentiles in seconds, the mean
+    being that of the bucket midpoints.'''
+    counts = self.array()
+    total = int(counts.sum())
+    result = {'count': total, 'mean': None, 'max': None}
+    for p in percentiles:
+      result['p%g' % p] = None
+    if not total:
+      return result
+    low, high = self.bounds()
+    result['mean'] = float((counts * (low + high) / 2).sum() / total)
+    result['max'] = float(high[np.flatnonzero(counts)[-1]])
+    for p, value in zip(percentiles, self.percentiles(percentiles)):
+      result['p%g' % p] = float(value)
+    return result
+
+
+class latencyTracer():
+  '''Latency histograms of every stage in STAGES, overall and per CAN id.
+
+  The send stage is measured in the interface process, which has no ids,
+  into send: a histogram on shared counts. The other stages are recorded
+  with record() as requests complete.
+  '''
+
+  def __init__(self, send=None):
+    self.stages = dict((stage, latencyHistogram()) for stage in STAGES)
+    if send is not None:
+      self.stages['send'] = send
+    # can id -> stage -> latencyHistogram
+    self.ids = {}
+
+  def record(self, stage, pkt_id, seconds):
+    self.stages[stage].record(seconds)
+    histograms = self.ids.get(pkt_id)
+    if histograms is None:
+      histograms = self.ids[pkt_id] = {}
+    histogram = histograms.get(stage)
+    if histogram is None:
+      histogram = histograms[stage] = latencyHistogram()
+    histogram.record(seconds)
+
+  def histogram(self, stage, pkt_id=None):
+    '''Returns the histogram of stage, for pkt_id if given, None if nothing
+    was recorded for it.'''
+    if pkt_id is None:
+      return self.stages[stage]
+    return self.ids.get(pkt_id, {}).get(stage)
+
+  def summary(self, pkt_id=None):
+    '''Returns stage -> latencyHistogram.summary() overall or for pkt_id.'''
+    result = {}
+    for stage in STAGES:
+      histogram = self.histogram(stage, pkt_id)
+      if histogram is not None:
+        result[stage] = histogram.summary()
+    return result
+
+  def reset(self):
+    for histogram in self.stages.itervalues():
+      histogram.reset()
+    self.ids = {}
+
+  def report(self, logger=logging):
+    # logs a line per stage, times in ms
+    logger.info('Latency (ms) %s', ' '.join(
+      '%9s' % name for name in ['count', 'mean'] +
+      ['p%g' % p for p in PERCENTILES] + ['max']))
+    for stage in STAGES:
+      s = self.stages[stage].summary()
+      if not s['count']:
+        continue
+      logger.info('  %-10s %9d %s', stage, s['count'], ' '.join(
+        '%9.3f' % (s[key] * 1000) for key in ['mean'] +
+        ['p%g' % p for p in PERCENTILES] + ['max']))
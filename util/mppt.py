@@ -31,9 +31,28 @@ import logging
 import struct
 import time
 
+import numpy as np
+
 import can_ethernet
 import can_msg_pb2
 
+# seconds an MPPT takes to come back after a reset
+RESET_TIME = 6
+
+# State reply payload: vin, iin, vout and temp as little endian 16 bit
+# counts of 1/100 V, 1/1000 A, 1/100 V and 1/100 degree
+STATE_FIELDS = ('vin', 'iin', 'vout', 'temp')
+STATE_COUNTS = (100.0, 1000.0, 100.0, 100.0)
+STATE_SCALE = np.array(STATE_COUNTS)
+STATE = struct.Struct('<HHHH')
+# Decoded states, time in seconds
+STATES_DTYPE = np.dtype([('time', '<f8'), ('id', '<u4'), ('vin', '<f8'),
+                         ('iin', '<f8'), ('vout', '<f8'), ('temp', '<f8')])
+
+# auto-sent states a tracker may miss before stateListener polls it
+QUIET_PERIODS = 3
+
+
 class MpptNotPresent(Exception):
   pass
 
@@ -44,7 +63,8 @@ class BadPacket(Exception):
 class mppt():
   # initialize tracker structure also initialize the eeprom
 
-  def __init__(self, channel, baseid, can):
+  def __init__(self, channel, baseid, can, detect=True, read=True):
+    self.channel = channel
     self.canAddress = baseid + channel
     self.can = can
     self.temp = 0
@@ -52,13 +72,19 @@ class mppt():
     self.vout = 0
     self.iin = 0
     self.iout = 0
+    # telemetry.telemetryRing every parsed state is appended to, if any
+    self.history = None
     
     # debug level
     self.debug = 0
 
-    self.found = self.detectMPPT()
+    # discoverMPPTs() has already seen the tracker answer
+    if detect:
+      self.found = self.detectMPPT()
+    else:
+      self.found = True
     if self.found:
-      self.ee = eeprom.eeprom(channel, baseid, can, self)
+      self.ee = eeprom.eeprom(channel, baseid, can, self, read)
     else:
       raise MpptNotPresent('MPPT 0x%03x not detected' % self.canAddress)
 
@@ -70,10 +96,11 @@ class mppt():
       tx.type = can_msg_pb2.STD_RTR
       tx.data.extend([0] * 8)
 
-      # send the packet
+      # send the packet, a reply older than it answered an earlier RTR
+      sent = time.time()
       self.can.SendPkt(tx)
       try:
-        rx = self.can.WaitForPacket(tx, timeout)
+        rx = self.can.WaitForPacket(tx, timeout, isState, sent)
       except can_ethernet.TimeoutError:
         return None
     return rx
@@ -98,6 +125,15 @@ class mppt():
     rx = self.RTRPacket(self.canAddress, 3, 0.1)
     self.parseStatePacket(rx)
 
+  # this function will poll the state through a can_client.canClient, the
+  # future resolves to this tracker once the reply is parsed
+  def requestStateData(self, client, timeout=0.1, retries=3):
+    def parse(rx):
+      self.parseStatePacket(rx)
+      return self
+    return client.Request(statePacket(self.canAddress), isState, timeout,
+                          retries).Then(parse)
+
   def setEnable(self, enable, leds='on'):
     # this function will send the packet to enable or disable the mppt
     param = 0
@@ -164,12 +200,26 @@ class mppt():
     if not pkt.id == self.canAddress:
       raise BadPacket('Address must = self.canAddress: %d' % pkt.id)
 
-    self.vin = float(pkt.data[1] * 0x100 + pkt.data[0]) / 100.0
-    self.vout = float(pkt.data[5] * 0x100 + pkt.data[4]) / 100.0
-    self.iin = float(pkt.data[3] * 0x100 + pkt.data[2]) / 1000.0
-    self.temp = float(pkt.data[7] * 0x100 + pkt.data[6]) / 100.0
+    # a single frame decodes faster without numpy, see decodeStates() for
+    # batches
+    vin, iin, vout, temp = STATE.unpack_from(bytearray(pkt.data))
+    vinScale, iinScale, voutScale, tempScale = STATE_COUNTS
+    self.vin = vin / vinScale
+    self.iin = iin / iinScale
+    self.vout = vout / voutScale
+    self.temp = temp / tempScale
 
-  def reset(self):
+    if self.history is not None:
+      if pkt.timestamp:
+        timestamp = pkt.timestamp / 1000.0
+      else:
+        timestamp = time.time()
+      self.history.append(timestamp, self.vin, self.iin, self.vout,
+                          self.temp)
+
+  def reset(self, wait=True):
+    # with wait=False the caller has to give the unit RESET_TIME to boot,
+    # so a whole rack can be reset at once
     logging.info('Resetting MPPT...')
     
     # create the packet structure
@@ -181,7 +231,341 @@ class mppt():
     # send the packet on the bus
 
     self.can.SendPkt(tx)
+    # the EEPROM may read differently once the unit comes back up
+    self.ee.invalidate()
+    if not wait:
+      return
     logging.info('Waiting for MPPT to initialize...')
-    time.sleep(6)
+    time.sleep(RESET_TIME)
     logging.info('Done.')
     
+
+
+def statePacket(canAddress):
+  # the RTR a tracker answers with its state
+  tx = can_msg_pb2.CanMessage()
+  tx.id = canAddress
+  tx.type = can_msg_pb2.STD_RTR
+  tx.data.extend([0] * 8)
+  return tx
+
+
+def decodeStates(data, ids=None, timestamps=None):
+  '''Decodes a batch of state frames in one go.
+
+  Args:
+    data: The 8 byte payloads back to back, as a str, bytearray or other
+      buffer, or an (n, 8) uint8 array such as the data field of
+      can_log_index.CanLogIndex.Select().
+    ids: CAN id of each frame, carried into the result if given.
+    timestamps: Receive time of each frame in ms, carried into the result
+      in seconds if given.
+  Returns:
+    Array of STATES_DTYPE, one entry per frame, id and time being 0 where
+    not given.
+  '''
+  values = stateValues(data)
+  states = np.zeros(len(values), dtype=STATES_DTYPE)
+  if ids is not None:
+    states['id'] = ids
+  if timestamps is not None:
+    states['time'] = np.asarray(timestamps) / 1000.0
+  for i, name in enumerate(STATE_FIELDS):
+    states[name] = values[:, i]
+  return states
+
+
+def stateValues(data):
+  # (n, 4) array of vin, iin, vout and temp from the payloads in data, as
+  # for decodeStates()
+  if isinstance(data, np.ndarray):
+    data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+  return np.frombuffer(data, dtype='<u2').reshape(-1, 4) / STATE_SCALE
+
+
+def selectStates(index, canAddress=None, t0=None, t1=None):
+  '''Decodes the state frames of a capture.
+
+  Args:
+    index: can_log_index.CanLogIndex of the capture.
+    canAddress: Only frames on this id if given; frames on other ids that
+      look like states, e.g. EEPROM replies, are not told apart otherwise.
+    t0, t1: Time window in ms, as for CanLogIndex.Select().
+  Returns:
+    decodeStates() array.
+  '''
+  records = index.Select(canAddress, t0, t1)
+  records = records[(records['type'] == can_msg_pb2.STD) &
+                    (records['dlc'] == 8)]
+  return decodeStates(records['data'], records['id'], records['timestamp'])
+
+
+def isState(rx):
+  # whether rx is a state reply rather than another node's RTR
+  return rx.type == can_msg_pb2.STD
+
+
+def requestMPPT(client, channel, baseid, read=True, timeout=0.1, retries=3):
+  '''Detects one MPPT and reads its EEPROM through a can_client.canClient.
+
+  Returns:
+    can_client.canFuture resolving to the mppt, or failing with
+    can_ethernet.TimeoutError if the tracker does not answer.
+  '''
+  def found(rx):
+    tracker = mppt(channel, baseid, client.can, detect=False, read=False)
+    tracker.parseStatePacket(rx)
+    if not read:
+      return tracker
+    return tracker.ee.requestData(client).Then(lambda values: tracker)
+
+  return client.Request(statePacket(baseid + channel), isState, timeout,
+                        retries).Then(found)
+
+
+class stateListener():
+  '''Keeps trackers' states up to date from the frames they auto-send.
+
+  A tracker with autoSendRate set sends its state at its CAN address that
+  many times a second without being asked, which costs half the bus
+  traffic of an RTR and its reply and takes the round trip out of the
+  telemetry path. update() consumes whatever has arrived, and polls with an
+  RTR only the trackers that have been quiet for QUIET_PERIODS of their
+  rate, or every time for those not auto-sending. Replies to those RTRs are
+  picked up by the next update(), so nothing waits on the bus.
+  '''
+
+  def __init__(self, can, trackers, quiet=QUIET_PERIODS):
+    self.can = can
+    self.quiet = quiet
+    self.trackers = {}
+    # CAN address -> auto-send rate in Hz as last read or written
+    self.rates = {}
+    # CAN address -> rate to put back on disable()
+    self.restore = {}
+    # CAN addresses given a rate of their own, which enable() and disable()
+    # leave alone
+    self.kept = set()
+    # rate set by enable(), None if the units keep their own
+    self.rate = None
+    # CAN address -> when a state last arrived, when an RTR last went out
+    self.lastHeard = {}
+    self.lastAsked = {}
+    # CAN addresses with an RTR not answered yet
+    self.asked = set()
+    self.nAutoSent = 0
+    self.nPolled = 0
+    for tracker in trackers:
+      self.add(tracker)
+
+  def add(self, tracker):
+    # starts listening to a tracker, e.g. one found after the others
+    address = tracker.canAddress
+    self.trackers[address] = tracker
+    self.rates[address] = self.readRate(tracker)
+    self.lastHeard[address] = 0
+    self.lastAsked[address] = 0
+    # auto-sent frames are not replies to anything, so ask for them kept
+    self.can.Expect(address)
+    if self.rate is not None:
+      self.enable(self.rate)
+
+  def readRate(self, tracker):
+    if 'autoSendRate' not in tracker.ee.schema:
+      return 0
+    return tracker.ee.getValue('autoSendRate')
+
+  def enable(self, rate):
+    '''Sets every tracker to auto-send at rate Hz.
+
+    Only units set to another rate, and not kept, are written. Firmware
+    that only reads the rate at boot carries on being polled until it is
+    next reset.
+    '''
+    self.rate = rate
+    for address, tracker in self.trackers.iteritems():
+      if 'autoSendRate' not in tracker.ee.schema or address in self.kept:
+        continue
+      if self.rates[address] != rate:
+        self.restore.setdefault(address, self.rates[address])
+        tracker.ee.writeValue('autoSendRate', rate)
+        self.rates[address] = rate
+
+  def inherit(self, other):
+    '''Takes over the rates other, a listener being replaced, has to put
+    back on disable() for the trackers this one listens to, and the
+    trackers it keeps on their own rate. Without it, units other set to
+    auto-send would read as set already and keep the rate for good.'''
+    self.kept.update(address for address in other.kept
+                     if address in self.trackers)
+    for address, rate in other.restore.iteritems():
+      if address in self.trackers and address not in self.kept:
+        self.restore.setdefault(address, rate)
+
+  def keep(self, address):
+    '''Leaves the tracker at address on the rate it was just given, e.g. by
+    writing its configuration, rather than have enable() overwrite it or
+    disable() put back the rate it had before.'''
+    if address not in self.trackers:
+      return
+    self.kept.add(address)
+    self.restore.pop(address, None)
+
+  def disable(self):
+    '''Puts back the rates enable() replaced.'''
+    for address, rate in self.restore.iteritems():
+      self.trackers[address].ee.writeValue('autoSendRate', rate)
+      self.rates[address] = rate
+    self.restore = {}
+    self.rate = None
+
+  def quietTime(self, address):
+    # seconds of silence before the tracker is polled, 0 to poll it on
+    # every update
+    rate = self.rates[address]
+    if rate <= 0:
+      return 0
+    return self.quiet / float(rate)
+
+  def update(self):
+    '''Parses every state that has arrived and polls the quiet trackers.
+
+    Returns:
+      The trackers whose state changed.
+    '''
+    self.can.GrabAllPackets()
+    now = time.time()
+    updated = []
+    for address, tracker in self.trackers.iteritems():
+      self.can.Expect(address)
+      heard = False
+      while True:
+        rx = self.can.GetPacketFromQueueDict(address)
+        if rx is None:
+          break
+        if not isState(rx):
+          continue
+        try:
+          tracker.parseStatePacket(rx)
+        except BadPacket:
+          continue
+        if address in self.asked:
+          self.asked.discard(address)
+          self.nPolled += 1
+        else:
+          self.nAutoSent += 1
+        self.lastHeard[address] = now
+        heard = True
+      if heard:
+        updated.append(tracker)
+      quiet = self.quietTime(address)
+      if quiet == 0 or (not heard and now - max(
+          self.lastHeard[address], self.lastAsked[address]) >= quiet):
+        self.can.SendPkt(statePacket(address))
+        self.lastAsked[address] = now
+        self.asked.add(address)
+    return updated
+
+
+class discoveryReport():
+  # outcome of a discoverMPPTs() sweep
+
+  def __init__(self, baseid, channels):
+    self.baseid = baseid
+    self.channels = list(channels)
+    # channel -> mppt object for every tracker found and read
+    self.trackers = {}
+    # channel -> seconds from the RTR to its reply
+    self.responseTimes = {}
+    # channel -> seconds the EEPROM read took
+    self.readTimes = {}
+    # channels that answered the RTR but not the EEPROM read
+    self.readFailed = []
+    self.elapsed = 0
+
+  def missing(self):
+    return [c for c in self.channels if c not in self.responseTimes]
+
+  def summary(self):
+    lines = ['Found %d of %d MPPTs in %.3f s' % (
+        len(self.trackers), len(self.channels), self.elapsed)]
+    for channel in sorted(self.responseTimes):
+      line = '  0x%03X RTR %6.1f ms' % (
+          self.baseid + channel, self.responseTimes[channel] * 1000)
+      if channel in self.readTimes:
+        line += ' EEPROM %6.1f ms' % (self.readTimes[channel] * 1000)
+      else:
+        line += ' EEPROM read failed'
+      lines.append(line)
+    return '\n'.join(lines)
+
+
+def discoverMPPTs(can, baseid, channels=range(16), window=0.1, retries=2):
+  '''Finds every MPPT on the bus in one sweep.
+
+  An RTR goes out to every candidate address at once and the replies are
+  collected in a single window, resending only to the addresses that stayed
+  quiet. The EEPROMs of the trackers found are then read together with
+  eeprom.readMany().
+
+  Args:
+    can: Connected canEthernet.
+    baseid: CAN base address of channel 0.
+    channels: Channel numbers to look for.
+    window: Seconds to wait for RTR replies per attempt.
+    retries: Number of RTR attempts.
+  Returns:
+    discoveryReport.
+  '''
+  start = time.time()
+  report = discoveryReport(baseid, channels)
+  quiet = list(report.channels)
+  states = {}
+  for _ in xrange(retries):
+    if not quiet:
+      break
+    # an old auto-sent state, or another node's RTR, on a candidate id is
+    # not a reply: drop what is buffered and, as RTRPacket does, take only
+    # states received after the RTRs went out
+    for channel in quiet:
+      can.FlushQueueType(statePacket(baseid + channel))
+    sent = time.time()
+    replies = {}
+    for channel in quiet:
+      tx = statePacket(baseid + channel)
+      replies[channel] = can.Register(tx.id, isState, sent)
+      can.SendPkt(tx)
+    overtime = sent + window
+    while replies:
+      for channel, reply in replies.items():
+        if reply.pkt is not None:
+          report.responseTimes[channel] = time.time() - sent
+          states[channel] = reply.pkt
+          quiet.remove(channel)
+          del replies[channel]
+      remaining = overtime - time.time()
+      if not replies or remaining <= 0:
+        break
+      can.WaitForRx(remaining)
+    for reply in replies.itervalues():
+      can.Unregister(reply)
+
+  for channel in quiet:
+    logging.info('Failed to Discover MPPT: 0x%03X' % (baseid + channel))
+  found = {}
+  for channel in sorted(states):
+    logging.info('MPPT Detected at address: 0x%03X' % (baseid + channel))
+    tracker = mppt(channel, baseid, can, detect=False, read=False)
+    try:
+      tracker.parseStatePacket(states[channel])
+    except BadPacket:
+      pass
+    found[tracker.ee] = tracker
+
+  for ee, elapsed in eeprom.readMany(found.keys()).iteritems():
+    tracker = found.pop(ee)
+    report.trackers[tracker.channel] = tracker
+    report.readTimes[tracker.channel] = elapsed
+  report.readFailed = sorted(tracker.channel for tracker in found.values())
+  report.elapsed = time.time() - start
+  return report
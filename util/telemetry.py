@@ -0,0 +1,174 @@
+"""Copyright (c) 2014, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+import numpy as np
+
+# Columns of every sample, power being vin * iin
+COLUMNS = ('time', 'vin', 'iin', 'vout', 'temp', 'power')
+TIME, VIN, IIN, VOUT, TEMP, POWER = range(len(COLUMNS))
+
+# Samples kept per tracker by default, a day at 2 Hz is about 170000
+DEPTH = 16384
+
+
+class telemetryRing():
+  '''Fixed depth history of one tracker's state samples.
+
+  Samples are stored column by column in a preallocated array twice the
+  depth, each written both at its slot and depth slots further on. Any run
+  of recent samples is then one contiguous slice, so last() and since()
+  hand out read-only views without copying and append() stays O(1).
+  Samples are expected in time order.
+  '''
+
+  def __init__(self, depth=DEPTH):
+    if depth <= 0:
+      raise ValueError('Depth must be positive: %d' % depth)
+    self.depth = depth
+    self.data = np.zeros((len(COLUMNS), 2 * depth))
+    # slot the next sample goes in, and samples ever appended
+    self.head = 0
+    self.count = 0
+
+  def __len__(self):
+    return min(self.count, self.depth)
+
+  def append(self, timestamp, vin, iin, vout, temp):
+    head = self.head
+    sample = (timestamp, vin, iin, vout, temp, vin * iin)
+    self.data[:, head] = sample
+    self.data[:, head + self.depth] = sample
+    self.head = (head + 1) % self.depth
+    self.count += 1
+
+  def extend(self, states):
+    '''Appends a batch of samples in time order, e.g. from
+    mppt.decodeStates(), given as a structured array with time, vin, iin,
+    vout and temp fields.'''
+    n = len(states)
+    if not n:
+      return
+    # only the last depth samples would survive anyway
+    kept = states[-self.depth:]
+    block = np.empty((len(COLUMNS), len(kept)))
+    for i, name in enumerate(COLUMNS[:POWER]):
+      block[i] = kept[name]
+    block[POWER] = block[VIN] * block[IIN]
+    slots = (self.head + np.arange(len(kept))) % self.depth
+    self.data[:, slots] = block
+    self.data[:, slots + self.depth] = block
+    self.head = (self.head + len(kept)) % self.depth
+    self.count += n
+
+  def last(self, n=None):
+    '''Returns a read-only (columns, n) view of the n most recent samples,
+    oldest first, or of every sample kept.'''
+    if n is None or n > len(self):
+      n = len(self)
+    end = self.head + self.depth
+    view = self.data[:, end - n:end]
+    view.flags.writeable = False
+    return view
+
+  def column(self, name, n=None):
+    return self.last(n)[COLUMNS.index(name)]
+
+  def since(self, start):
+    '''Returns a view of the samples taken at or after start.'''
+    view = self.last()
+    first = np.searchsorted(view[TIME], start)
+    return view[:, first:]
+
+  def latest(self):
+    '''Returns the most recent sample as a dict, None if there is none.'''
+    if not self.count:
+      return None
+    return dict(zip(COLUMNS, self.last(1)[:, 0]))
+
+  def aggregate(self, bucket, start=None):
+    '''Downsamples the history into buckets of bucket seconds.
+
+    Args:
+      bucket: Bucket width in seconds, buckets are aligned to multiples of
+        it.
+      start: Only samples at or after start are used, all if None.
+    Returns:
+      Dict with 'time' (start of each bucket), 'count' (samples in it) and
+      'min', 'max' and 'mean', each an array of one row per column after
+      time and one entry per bucket. Buckets without samples are left out.
+    '''
+    view = self.last() if start is None else self.since(start)
+    keys = np.floor(view[TIME] / bucket)
+    if not len(keys):
+      empty = np.zeros((len(COLUMNS) - 1, 0))
+      return {'time': np.zeros(0), 'count': np.zeros(0, dtype=int),
+              'min': empty, 'max': empty, 'mean': empty}
+    # samples are in time order, so each bucket is a contiguous run
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    values = view[TIME + 1:]
+    return {'time': keys[starts] * bucket,
+            'count': counts,
+            'min': np.minimum.reduceat(values, starts, axis=1),
+            'max': np.maximum.reduceat(values, starts, axis=1),
+            'mean': np.add.reduceat(values, starts, axis=1) / counts}
+
+
+class telemetryStore():
+  '''A telemetryRing per tracker, keyed by CAN address.
+
+  Once a tracker is tracked every state it parses is recorded, whichever
+  way it was polled.
+  '''
+
+  def __init__(self, depth=DEPTH):
+    self.depth = depth
+    self.rings = {}
+
+  def track(self, tracker):
+    # keeps the history of a tracker seen before, e.g. after rediscovery
+    ring = self.rings.get(tracker.canAddress)
+    if ring is None:
+      ring = self.rings[tracker.canAddress] = telemetryRing(self.depth)
+    tracker.history = ring
+    return ring
+
+  def ring(self, canAddress):
+    return self.rings[canAddress]
+
+  def addresses(self):
+    return sorted(self.rings)
+
+  def latest(self):
+    '''Returns a dict of CAN address -> most recent sample.'''
+    return dict((address, ring.latest())
+                for address, ring in self.rings.iteritems() if ring.count)
+
+  def __contains__(self, canAddress):
+    return canAddress in self.rings
@@ -0,0 +1,92 @@
+"""Copyright (c) 2016, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import bridge_emulator
+import can_log
+import can_msg_pb2
+import can_replay
+import eeprom
+import mppt
+
+BASEID = 0x600
+
+
+class replayTest(unittest.TestCase):
+  '''Requests made during a replay are answered by the captured replies.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.unit = bridge_emulator.photonEmulator(BASEID, 1234, BASEID)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def replay(self, frames):
+    # the first frame is due as soon as the replay starts, before anything
+    # has been asked for, so lead with another unit's traffic
+    other = (1000, BASEID + 1, can_msg_pb2.STD, 8, self.unit.StateData())
+    writer = can_log.CanLogWriter(self.directory)
+    writer.Write([other] + frames)
+    writer.Close()
+    can = can_replay.canReplay(self.directory, speed=1)
+    can.Connect()
+    return can
+
+  def testStateData(self):
+    # getStateData() sends an RTR per retry and waits on each reply
+    state = bridge_emulator.STATE.pack(1000, 5000, 2200, 3000)
+    can = self.replay([(ts, BASEID, can_msg_pb2.STD, 8, state)
+                       for ts in (1000, 1050, 1100)])
+    tracker = mppt.mppt(0, BASEID, can, detect=False, read=False)
+    tracker.getStateData()
+    self.assertEqual(tracker.vin, 10.0)
+    self.assertEqual(tracker.iin, 5.0)
+
+  def testBulkRead(self):
+    schema = self.unit.schema
+    replies = []
+    for i in range(1, len(schema)) + [0]:
+      request = (0, BASEID + 0x20, can_msg_pb2.STD, 8, '\0' * 7 + chr(i))
+      (can_id, _, data), = self.unit.Handle(request, 0)
+      replies.append((can_id, can_msg_pb2.STD, len(data), data))
+    can = self.replay([(1050 + n,) + reply
+                       for n, reply in enumerate(replies)])
+    tracker = mppt.mppt(0, BASEID, can, detect=False, read=False)
+    read = eeprom.bulkRead(tracker.ee, window=len(schema))
+    eeprom.runReads([read])
+    self.assertFalse(read.failed)
+    self.assertEqual(tracker.ee.getValue('serialNumber'), 1234)
+    self.assertEqual(tracker.ee.getValue('canBaseAddress'), BASEID)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,188 @@
+"""Copyright (c) 2014, Dilithium Power Systems LLC All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Dilithium Power Systems LLC.
+
+"""
+
+
+
+# Columns of the table, the values being those of mppt.stateListener updates
+COLUMNS = ('address', 'status', 'vin', 'iin', 'power', 'vout', 'temp')
+VALUE_COLUMNS = COLUMNS[2:]
+
+# What a table can be filtered by
+FILTERS = ('SN', 'Min Power', 'Max Power')
+
+
+def parseAddresses(text):
+  '''Parses a comma or space separated list of hex base addresses, e.g.
+  '0x600, 0x640'. Raises ValueError on anything else.'''
+  addresses = []
+  for word in text.replace(',', ' ').split():
+    address = int(word, 16)
+    if address < 0 or address > 0x7ff:
+      raise ValueError('CAN address out of range: %s' % word)
+    addresses.append(address)
+  return addresses
+
+
+class trackerRow():
+  # one tracker, or an address that answered but could not be read
+
+  def __init__(self, address, tracker=None, status=''):
+    self.address = address
+    self.tracker = tracker
+    self.status = status
+    self.sn = None
+    if tracker is not None:
+      self.sn = tracker.ee.getValue('serialNumber')
+      swRev = tracker.ee.getValue('SWVersion')
+      self.status = 'SN {0:d} SW {1:g}'.format(self.sn, swRev)
+    # (vin, iin, power, vout, temp), None until the first state
+    self.values = None
+    # text of every column as last shown
+    self.text = None
+
+  def power(self):
+    if self.values is None:
+      return 0
+    return self.values[2]
+
+  def key(self, column):
+    if column == 'address':
+      return self.address
+    if column == 'status':
+      return (self.sn is None, self.sn, self.status)
+    if self.values is None:
+      return None
+    return self.values[VALUE_COLUMNS.index(column)]
+
+  def render(self):
+    '''Returns the text of every column, None if it is what was last
+    rendered.'''
+    if self.values is None:
+      values = [''] * len(VALUE_COLUMNS)
+    else:
+      values = ['{0:g}'.format(value) for value in self.values]
+    text = tuple(['0x{0:03X}'.format(self.address), self.status] + values)
+    if text == self.text:
+      return None
+    self.text = text
+    return text
+
+
+class trackerTable():
+  '''Data behind the tracker table, whatever the number of trackers.
+
+  Rows are kept by CAN address and hold the latest values only; order()
+  gives the addresses that pass the filter in sort order, and render() on
+  a row tells whether its text changed at all, so the view only touches
+  the rows that need it.
+  '''
+
+  def __init__(self):
+    # address -> trackerRow
+    self.rows = {}
+    self.sortColumn = 'address'
+    self.reverse = False
+    self.filterField = None
+    self.filterValue = None
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, address):
+    return self.rows[address]
+
+  def __contains__(self, address):
+    return address in self.rows
+
+  def setTrackers(self, trackers, readFailed=()):
+    '''Replaces the rows with trackers, a dict of address -> mppt, and the
+    addresses in readFailed.'''
+    self.rows = {}
+    for address, tracker in trackers.iteritems():
+      self.rows[address] = trackerRow(address, tracker)
+    for address in readFailed:
+      self.rows[address] = trackerRow(address, status='Error Reading SN')
+
+  def trackers(self):
+    return dict((address, row.tracker) for address, row in
+                self.rows.iteritems() if row.tracker is not None)
+
+  def update(self, address, values):
+    if address in self.rows:
+      self.rows[address].values = values
+
+  def setSort(self, column):
+    # sorting by the same column again reverses it
+    if column not in COLUMNS:
+      raise ValueError('No such column: %s' % column)
+    if column == self.sortColumn:
+      self.reverse = not self.reverse
+    else:
+      self.sortColumn = column
+      self.reverse = False
+
+  def setFilter(self, field, text):
+    '''Keeps only the rows whose SN contains text, or whose power is at
+    least or at most text for the power filters. An empty text clears the
+    filter. Raises ValueError on a power that is not a number.'''
+    text = text.strip()
+    if not text:
+      self.filterField = None
+      self.filterValue = None
+      return
+    if field not in FILTERS:
+      raise ValueError('No such filter: %s' % field)
+    if field == 'SN':
+      self.filterValue = text
+    else:
+      self.filterValue = float(text)
+    self.filterField = field
+
+  def matches(self, row):
+    field = self.filterField
+    if field is None:
+      return True
+    if field == 'SN':
+      return row.sn is not None and self.filterValue in str(row.sn)
+    if row.values is None:
+      return False
+    if field == 'Min Power':
+      return row.power() >= self.filterValue
+    return row.power() <= self.filterValue
+
+  def live(self):
+    # whether the order can change with every state update
+    return self.sortColumn in VALUE_COLUMNS or self.filterField in FILTERS[1:]
+
+  def order(self):
+    column = self.sortColumn
+    rows = [row for row in self.rows.itervalues() if self.matches(row)]
+    # ties, and rows with no values yet, stay in address order
+    rows.sort(key=lambda row: row.address)
+    rows.sort(key=lambda row: row.key(column), reverse=self.reverse)
+    return [row.address for row in rows]